@@ -0,0 +1,293 @@
+import glob
+import json
+import logging
+import mimetypes
+import os
+import shutil
+import uuid
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class StoredObject:
+    """
+    An object opened for reading, body is a binary stream that is read once.
+    """
+    def __init__(self, body, content_type, size, etag=None):
+        self.body = body
+        self.content_type = content_type
+        self.size = size
+        self.etag = etag
+
+
+class S3Storage:
+    """
+    Storage backend on s3. Objects are addressed by bucket and key, dataframes are read and written with awswrangler.
+    boto3 and awswrangler are imported, and the client created, the first time they are used, so a function which
+    never reads a dataframe doesn't load awswrangler and its data libraries.
+    """
+    def __init__(self):
+        self._s3_client = None
+
+    @property
+    def s3_client(self):
+        if self._s3_client is None:
+            import boto3
+            self._s3_client = boto3.client('s3')
+        return self._s3_client
+
+    @property
+    def wr(self):
+        import awswrangler
+        return awswrangler
+
+    def uri(self, bucket, key):
+        if isinstance(key, list):
+            return [self.uri(bucket, i) for i in key]
+        return 's3://' + bucket + '/' + key
+
+    def open_object(self, bucket, key):
+        response = self.s3_client.get_object(Bucket=bucket, Key=key)
+        return StoredObject(response['Body'], response['ResponseMetadata']['HTTPHeaders']['content-type'],
+                            response['ContentLength'], response.get('ETag'))
+
+    def put_object(self, bucket, key, body):
+        self.s3_client.put_object(Bucket=bucket, Key=key, Body=body)
+
+    def create_multipart_upload(self, bucket, key):
+        return self.s3_client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+    def upload_part(self, bucket, key, upload_id, part_number, data):
+        response = self.s3_client.upload_part(Bucket=bucket, Key=key, PartNumber=part_number, UploadId=upload_id, Body=data)
+        return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+    def complete_multipart_upload(self, bucket, key, upload_id, parts):
+        self.s3_client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+
+    def abort_multipart_upload(self, bucket, key, upload_id):
+        self.s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+
+    def list_objects(self, bucket, prefix):
+        return [uri.split('/', 3)[3] for uri in self.wr.s3.list_objects(self.uri(bucket, prefix))]
+
+    def object_exists(self, bucket, key):
+        return self.wr.s3.does_object_exist(self.uri(bucket, key))
+
+    def delete_objects(self, bucket, keys):
+        #a delete request takes at most 1000 keys, missing keys are not an error
+        for i in range(0, len(keys), 1000):
+            self.s3_client.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in keys[i:i + 1000]], 'Quiet': True})
+
+    def read_csv(self, bucket, key, path_suffix=None, **kwargs):
+        return self.wr.s3.read_csv(self.uri(bucket, key), path_suffix=path_suffix, **kwargs)
+
+    def read_parquet(self, bucket, key, path_suffix=None, **kwargs):
+        return self.wr.s3.read_parquet(self.uri(bucket, key), path_suffix=path_suffix, **kwargs)
+
+    def read_csv_chunks(self, bucket, key, chunk_rows, **kwargs):
+        return self.wr.s3.read_csv(self.uri(bucket, key), chunksize=chunk_rows, **kwargs)
+
+    def read_parquet_chunks(self, bucket, key, chunk_rows, **kwargs):
+        return self.wr.s3.read_parquet(self.uri(bucket, key), chunked=chunk_rows, **kwargs)
+
+    def to_csv(self, df, bucket, key, **kwargs):
+        self.wr.s3.to_csv(df=df, path=self.uri(bucket, key), **kwargs)
+
+    def to_parquet(self, df, bucket, key, **kwargs):
+        self.wr.s3.to_parquet(df=df, path=self.uri(bucket, key), **kwargs)
+
+
+class LocalStorage:
+    """
+    Storage backend on the local filesystem. Each bucket is a folder under root, unless bucket_dirs maps it to
+    another folder. A key ending with / is a prefix and reads every file below it, like awswrangler does on s3.
+    pandas is imported when a dataframe is first read.
+    """
+    def __init__(self, root, bucket_dirs=None):
+        self.root = root
+        self.bucket_dirs = bucket_dirs or {}
+        self.uploads = {}
+
+    def path(self, bucket, key):
+        return os.path.join(self.bucket_dirs.get(bucket, os.path.join(self.root, bucket)), key)
+
+    def paths(self, bucket, key, path_suffix=None):
+        if isinstance(key, list):
+            return [self.path(bucket, i) for i in key]
+        if key.endswith('/') or key == '':
+            return [self.path(bucket, i) for i in self.list_objects(bucket, key) if path_suffix is None or i.endswith(path_suffix)]
+        return [self.path(bucket, key)]
+
+    def open_object(self, bucket, key):
+        path = self.path(bucket, key)
+        stat = os.stat(path)
+        #stands in for the s3 ETag, it changes whenever the file is written
+        etag = str(stat.st_mtime_ns) + '-' + str(stat.st_size)
+        return StoredObject(open(path, 'rb'), mimetypes.guess_type(path)[0], stat.st_size, etag)
+
+    def put_object(self, bucket, key, body):
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(body)
+
+    def create_multipart_upload(self, bucket, key):
+        upload_id = str(uuid.uuid4())
+        self.uploads[upload_id] = os.path.join(self.root, '.uploads', upload_id)
+        os.makedirs(self.uploads[upload_id])
+        return upload_id
+
+    def upload_part(self, bucket, key, upload_id, part_number, data):
+        with open(os.path.join(self.uploads[upload_id], str(part_number)), 'wb') as f:
+            f.write(data)
+        return {'ETag': str(part_number), 'PartNumber': part_number}
+
+    def complete_multipart_upload(self, bucket, key, upload_id, parts):
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            for part in sorted(parts, key=lambda part: part['PartNumber']):
+                with open(os.path.join(self.uploads[upload_id], str(part['PartNumber'])), 'rb') as part_file:
+                    shutil.copyfileobj(part_file, f)
+        self.abort_multipart_upload(bucket, key, upload_id)
+
+    def abort_multipart_upload(self, bucket, key, upload_id):
+        shutil.rmtree(self.uploads.pop(upload_id), ignore_errors=True)
+
+    def list_objects(self, bucket, prefix):
+        bucket_path = self.path(bucket, '')
+        files = glob.glob(os.path.join(glob.escape(bucket_path), '**'), recursive=True)
+        keys = sorted(os.path.relpath(i, bucket_path).replace(os.sep, '/') for i in files if os.path.isfile(i))
+        return [i for i in keys if i.startswith(prefix)]
+
+    def object_exists(self, bucket, key):
+        return os.path.isfile(self.path(bucket, key))
+
+    def delete_objects(self, bucket, keys):
+        for key in keys:
+            if os.path.isfile(self.path(bucket, key)):
+                os.remove(self.path(bucket, key))
+
+    def read_csv(self, bucket, key, path_suffix=None, **kwargs):
+        import pandas as pd
+        return pd.concat([pd.read_csv(i, **kwargs) for i in self.paths(bucket, key, path_suffix)], ignore_index=True)
+
+    def read_parquet(self, bucket, key, path_suffix=None, **kwargs):
+        import pandas as pd
+        return pd.concat([pd.read_parquet(i, **kwargs) for i in self.paths(bucket, key, path_suffix)], ignore_index=True)
+
+    def read_csv_chunks(self, bucket, key, chunk_rows, **kwargs):
+        import pandas as pd
+        with pd.read_csv(self.path(bucket, key), chunksize=chunk_rows, **kwargs) as reader:
+            yield from reader
+
+    def read_parquet_chunks(self, bucket, key, chunk_rows, columns=None):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(self.path(bucket, key)).iter_batches(batch_size=chunk_rows, columns=columns):
+            yield batch.to_pandas()
+
+    def to_csv(self, df, bucket, key, **kwargs):
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        df.to_csv(path, **kwargs)
+
+    def to_parquet(self, df, bucket, key, **kwargs):
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        df.to_parquet(path, **kwargs)
+
+
+class AWSMessaging:
+    """
+    Messaging backend on sqs and sns.
+    """
+    def __init__(self):
+        self._sqs_client = None
+        self._sns_client = None
+
+    @property
+    def sqs_client(self):
+        if self._sqs_client is None:
+            import boto3
+            self._sqs_client = boto3.client('sqs')
+        return self._sqs_client
+
+    @property
+    def sns_client(self):
+        if self._sns_client is None:
+            import boto3
+            self._sns_client = boto3.client('sns')
+        return self._sns_client
+
+    def send_message_batch(self, queue_url, entries):
+        response = self.sqs_client.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        return response.get('Successful', []), response.get('Failed', [])
+
+    def publish(self, topic_arn, message):
+        self.sns_client.publish(TargetArn=topic_arn, Message=message)
+
+
+class LocalMessaging:
+    """
+    Messaging backend for local runs, queued messages are kept in memory and notifications are logged.
+    """
+    def __init__(self):
+        self.messages = []
+
+    def send_message_batch(self, queue_url, entries):
+        successful = []
+        for entry in entries:
+            message_id = str(uuid.uuid4())
+            self.messages.append({'MessageId': message_id, 'Body': entry['MessageBody'], 'MessageAttributes': entry['MessageAttributes']})
+            successful.append({'Id': entry['Id'], 'MessageId': message_id})
+        return successful, []
+
+    def publish(self, topic_arn, message):
+        logger.info ('Notification: ' + message)
+
+
+class NotificationBuffer:
+    """
+    Collects the notifications of an invocation so they are published as one summary message instead of one per step.
+    """
+    def __init__(self, messaging, topic_arn):
+        self.messaging = messaging
+        self.topic_arn = topic_arn
+        self.messages = []
+
+    def add(self, message):
+        self.messages.append(message)
+
+    def flush(self):
+        """
+        Publishes the collected notifications as one message, nothing is sent when there are none.
+        """
+        if self.messages:
+            message = '\n\n'.join(self.messages)
+            self.messages = []
+            self.messaging.publish(self.topic_arn, message)
+
+
+def get_storage():
+    """
+    Creates the storage backend selected by the storage_backend environment variable, s3 (default) or local.
+    The local backend keeps its buckets under local_storage_root, bucket folders can be overridden with a json map
+    in local_bucket_dirs.
+    Returns:
+        storage: S3Storage or LocalStorage
+    """
+    if os.environ.get('storage_backend', 's3') == 'local':
+        return LocalStorage(os.environ['local_storage_root'], json.loads(os.environ.get('local_bucket_dirs', '{}')))
+    return S3Storage()
+
+
+def get_messaging():
+    """
+    Creates the messaging backend matching the storage_backend environment variable.
+    Returns:
+        messaging: AWSMessaging or LocalMessaging
+    """
+    if os.environ.get('storage_backend', 's3') == 'local':
+        return LocalMessaging()
+    return AWSMessaging()
@@ -0,0 +1,68 @@
+"""
+Peak memory and time of process_parsed_output over the splits of a day, with all hits in memory against chunked
+processing (processing_chunk_rows). The landing file is split by dq_check_split_file on local storage first, then each
+mode runs in a fresh process and reports the peak RSS it added and the revenue it found. Run from the repository root:
+    python benchmarks/bench_chunked.py --rows 1000000 3000000 --chunk-rows 100000
+"""
+import argparse
+import io
+import multiprocessing
+import time
+
+import bench_env
+import dq_check_split_file
+import metrics
+import process_parsed_output
+from generate_hit_data import generate_hits, rows_per_scale, to_tsv
+
+
+def write_splits(rows):
+    """
+    Splits synthetic hits into the intermediate bucket, as the DQ function does.
+    Arguments:
+        rows: int
+    Returns:
+        splits: list, keys of the split files
+    """
+    stream = io.BufferedReader(io.BytesIO(to_tsv(generate_hits(scale=rows / rows_per_scale))))
+    columns = dq_check_split_file.read_header(stream)
+    return dq_check_split_file.transform_split_files('landing', 'benchmark_%d.tsv' % rows, '', stream, columns)[1]
+
+
+def measure(chunk_rows, splits):
+    """
+    Processes the split files, in the process it is called in.
+    Arguments:
+        chunk_rows: int, 0 for all hits in memory
+        splits: list
+    Returns:
+        seconds: float
+        peak_mb: float, peak RSS added by the processing
+        revenue: float
+    """
+    process_parsed_output.processing_chunk_rows = chunk_rows
+    search_state = process_parsed_output.read_search_state('')
+    metrics.reset_peak_rss()
+    start_bytes = metrics.read_peak_rss()
+    start = time.perf_counter()
+    final_df, search_state = process_parsed_output.process_hits(dq_check_split_file.target_bucket, splits, search_state)
+    return time.perf_counter() - start, (metrics.read_peak_rss() - start_bytes) / 2 ** 20, final_df['revenue'].sum()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare in memory and chunked processing of a day of splits.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10 ** 6])
+    parser.add_argument('--chunk-rows', type=int, default=10 ** 5)
+    args = parser.parse_args()
+    print('mode\trows\tseconds\tpeak_mb\trevenue')
+    context = multiprocessing.get_context('spawn')
+    for rows in args.rows:
+        splits = write_splits(rows)
+        for name, chunk_rows in [('in memory', 0), ('chunked', args.chunk_rows)]:
+            with context.Pool(1) as pool:
+                seconds, peak_mb, revenue = pool.apply(measure, (chunk_rows, splits))
+            print('%s\t%d\t%.3f\t%.1f\t%.2f' % (name, rows, seconds, peak_mb, revenue))
+
+
+if __name__ == '__main__':
+    main()
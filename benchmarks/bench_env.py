@@ -0,0 +1,17 @@
+"""
+Configuration shared by the benchmarks. The pipeline modules read their configuration when they are imported, so each
+benchmark imports this module first. It gives them the same environment as local_batch.py, on local storage in a
+temporary folder.
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from local_batch import default_environment
+
+for name, value in default_environment.items():
+    os.environ.setdefault(name, value)
+os.environ.setdefault('storage_backend', 'local')
+os.environ.setdefault('local_storage_root', tempfile.mkdtemp())
@@ -0,0 +1,59 @@
+"""
+Benchmark of the intermediate split formats and codecs written by dq_check_split_file.
+Writes the same synthetic split in tsv and parquet, with every intermediate_compression of the format, through
+SplitWriter to local storage, then reports the bytes stored and the time to read and parse the processing columns back
+the way process_parsed_output does. Run from the repository root:
+    python benchmarks/bench_intermediate_format.py --rows 1000000
+"""
+import argparse
+import io
+import time
+
+import pandas as pd
+
+import bench_env
+import dq_check_split_file
+import process_parsed_output
+from bench_revenue_calc import make_hits
+
+
+def read_split(data, intermediate_format, intermediate_compression):
+    if intermediate_format == 'parquet':
+        df = pd.read_parquet(io.BytesIO(data), columns=process_parsed_output.processing_columns)
+    else:
+        df = pd.read_csv(io.BytesIO(data), sep='\t', usecols=process_parsed_output.processing_columns,
+                         dtype=process_parsed_output.split_read_dtypes,
+                         compression='gzip' if intermediate_compression == 'gzip' else None)
+    return process_parsed_output.compact_hits(df)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare tsv and parquet intermediate splits and their codecs.')
+    parser.add_argument('--rows', type=int, default=10 ** 6)
+    parser.add_argument('--chunk-rows', type=int, default=100000)
+    args = parser.parse_args()
+    split = make_hits(args.rows)
+    print('format\tcompression\tbytes\twrite_seconds\tread_parse_seconds')
+    for intermediate_format, intermediate_compression in [(i, j) for i, codecs in dq_check_split_file.intermediate_codecs.items() for j in codecs]:
+        dq_check_split_file.intermediate_format = intermediate_format
+        dq_check_split_file.intermediate_compression = intermediate_compression
+        start = time.perf_counter()
+        upload_pool = dq_check_split_file.UploadPool(1)
+        extension = '.gz' if intermediate_format == 'tsv' and intermediate_compression == 'gzip' else ''
+        writer = dq_check_split_file.SplitWriter('benchmark.' + intermediate_format + extension, upload_pool)
+        for i in range(0, len(split), args.chunk_rows):
+            writer.write_frame(split.iloc[i:i + args.chunk_rows])
+        writer.close()
+        writer.wait()
+        upload_pool.shutdown()
+        write_seconds = time.perf_counter() - start
+        with dq_check_split_file.storage.open_object(dq_check_split_file.target_bucket, writer.key).body as f:
+            data = f.read()
+        start = time.perf_counter()
+        read_split(data, intermediate_format, intermediate_compression)
+        read_seconds = time.perf_counter() - start
+        print('%s\t%s\t%d\t%.3f\t%.3f' % (intermediate_format, intermediate_compression, len(data), write_seconds, read_seconds))
+
+
+if __name__ == '__main__':
+    main()
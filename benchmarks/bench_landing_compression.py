@@ -0,0 +1,59 @@
+"""
+Throughput of compressed landing files in dq_check_split_file. The same synthetic landing file is stored uncompressed,
+with gzip and with zstd. For each codec the bytes stored, the time to stream the tsv content out of
+open_landing_stream and the time of the whole read and split of transform_split_files are reported, with the
+megabytes of tsv content per second. Run from the repository root:
+    python benchmarks/bench_landing_compression.py --rows 1000000
+"""
+import argparse
+import gzip
+import io
+import time
+
+import pyarrow as pa
+
+import bench_env
+import dq_check_split_file
+from backends import StoredObject
+from generate_hit_data import generate_hits, rows_per_scale, to_tsv
+
+#codec and the function compressing a landing file with it
+landing_compressors = [
+    ('none', lambda data: data),
+    ('gzip', lambda data: gzip.compress(data, compresslevel=6)),
+    ('zstd', lambda data: pa.Codec('zstd').compress(data, asbytes=True)),
+]
+
+
+def open_landing(data):
+    return dq_check_split_file.open_landing_stream(StoredObject(io.BytesIO(data), 'text/tab-separated-values', len(data)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare uncompressed, gzip and zstd landing files.')
+    parser.add_argument('--rows', type=int, default=10 ** 6)
+    args = parser.parse_args()
+    tsv = to_tsv(generate_hits(scale=args.rows / rows_per_scale))
+    megabytes = len(tsv) / 2 ** 20
+    print('codec\tbytes\tratio\tdecompress_seconds\tdecompress_mb_per_sec\tsplit_seconds\tsplit_mb_per_sec')
+    for codec, compress in landing_compressors:
+        data = compress(tsv)
+
+        start = time.perf_counter()
+        body, hit_data_stream, landing_codec = open_landing(data)
+        while hit_data_stream.read(2 ** 20):
+            pass
+        decompress_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        body, hit_data_stream, landing_codec = open_landing(data)
+        columns = dq_check_split_file.read_header(hit_data_stream)
+        dq_check_split_file.transform_split_files('landing', 'benchmark_' + codec + '.tsv', '', hit_data_stream, columns)
+        split_seconds = time.perf_counter() - start
+
+        print('%s\t%d\t%.1f\t%.3f\t%.0f\t%.3f\t%.1f' % (codec, len(data), len(tsv) / len(data), decompress_seconds,
+                                                        megabytes / decompress_seconds, split_seconds, megabytes / split_seconds))
+
+
+if __name__ == '__main__':
+    main()
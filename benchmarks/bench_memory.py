@@ -0,0 +1,74 @@
+"""
+Memory of the hit data per million rows, to size LambdaMemorySize from the number of hits a function gets.
+The DQ chunks are measured with every landing column against only the columns for analysis, and the splits read by
+process_parsed_output with the types pandas infers against the compact types of compact_hits. The peak RSS revenue_calc
+adds is given for the processor frames, it is taken from the process as arrow backed strings are not seen by tracemalloc.
+Every measurement runs in a fresh process so memory freed by an earlier one is not reused. Run from the repository root:
+    python benchmarks/bench_memory.py --rows 1000000
+"""
+import argparse
+import gc
+import io
+import multiprocessing
+
+import pandas as pd
+
+import bench_env
+import dq_check_split_file
+import metrics
+import process_parsed_output
+from bench_revenue_calc import make_hits
+from generate_hit_data import generate_hits, rows_per_scale, to_tsv
+
+
+def read_frame(representation, rows):
+    if representation.startswith('dq'):
+        landing = to_tsv(generate_hits(scale=rows / rows_per_scale))
+        if representation == 'dq all columns':
+            return pd.read_csv(io.BytesIO(landing), sep='\t', dtype={'product_list': str})
+        columns = dq_check_split_file.cols_for_analysis
+        return pd.read_csv(io.BytesIO(landing), sep='\t', usecols=columns, dtype={i: str for i in columns})
+    split = make_hits(rows).to_csv(sep='\t', index=False).encode('UTF-8')
+    if representation == 'processor inferred':
+        return pd.read_csv(io.BytesIO(split), sep='\t', usecols=process_parsed_output.processing_columns)
+    return process_parsed_output.compact_hits(pd.read_csv(io.BytesIO(split), sep='\t', usecols=process_parsed_output.processing_columns,
+                                                          dtype=process_parsed_output.split_read_dtypes))
+
+
+def measure(representation, rows):
+    """
+    Reads the frame of a representation and measures it, in the process it is called in.
+    Arguments:
+        representation: string
+        rows: int
+    Returns:
+        mb_per_million_rows: float
+        column_types: string
+        revenue_calc_peak_mb: float or None
+    """
+    df = read_frame(representation, rows)
+    mb_per_million_rows = df.memory_usage(deep=True).sum() / 2 ** 20 * 10 ** 6 / len(df)
+    column_types = ', '.join('%s %s' % (column, df[column].dtype) for column in df.columns)
+    if representation.startswith('dq'):
+        return mb_per_million_rows, column_types, None
+    gc.collect()
+    metrics.reset_peak_rss()
+    start_bytes = metrics.read_peak_rss()
+    process_parsed_output.revenue_calc(df)
+    return mb_per_million_rows, column_types, (metrics.read_peak_rss() - start_bytes) / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report memory per million hits of the DQ chunks and processor frames.')
+    parser.add_argument('--rows', type=int, default=10 ** 6)
+    args = parser.parse_args()
+    print('representation\tmb_per_million_rows\trevenue_calc_peak_mb\tcolumn_types')
+    context = multiprocessing.get_context('spawn')
+    for representation in ['dq all columns', 'dq columns for analysis', 'processor inferred', 'processor compact']:
+        with context.Pool(1) as pool:
+            mb_per_million_rows, column_types, peak_mb = pool.apply(measure, (representation, args.rows))
+        print('%s\t%.1f\t%s\t%s' % (representation, mb_per_million_rows, '' if peak_mb is None else '%.1f' % peak_mb, column_types))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+Benchmark of the product_list parsing in dq_check_split_file against the single product split it replaced.
+Both run over the product_list of synthetic hits with up to --max-products products per purchase, rows/sec and the
+total revenue each of them finds are reported. Run from the repository root:
+    python benchmarks/bench_product_list.py --sizes 100000 1000000 --max-products 3
+"""
+import argparse
+import time
+
+import pandas as pd
+
+import bench_env
+import dq_check_split_file
+from generate_hit_data import generate_hits, rows_per_scale
+
+
+def single_product_split(hit_data_df):
+    """
+    The former transform_chunk, it splits product_list on ';' into fixed columns so only the first product is kept whole.
+    """
+    hit_data_df_subset = hit_data_df[dq_check_split_file.cols_for_analysis].copy()
+    product_list_split = hit_data_df_subset['product_list'].str.split(';', expand=True)
+    columns = dq_check_split_file.product_list_split_cols
+    hit_data_df_subset[columns] = product_list_split.reindex(columns=range(len(columns)))
+    return hit_data_df_subset
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare product_list parsing throughput.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10 ** 5, 10 ** 6])
+    parser.add_argument('--max-products', type=int, default=3)
+    args = parser.parse_args()
+    print('parser\trows\tseconds\trows_per_sec\ttotal_revenue')
+    for rows in args.sizes:
+        hits = generate_hits(scale=rows / rows_per_scale, max_products=args.max_products)
+        hits['product_list'] = hits['product_list'].where(hits['product_list'] != '')
+        for name, transform in [('single_product_split', single_product_split),
+                                ('transform_chunk', dq_check_split_file.transform_chunk)]:
+            start = time.perf_counter()
+            transformed = transform(hits)
+            seconds = time.perf_counter() - start
+            total_revenue = pd.to_numeric(transformed['total_revenue'], errors='coerce').sum()
+            print('%s\t%d\t%.3f\t%.0f\t%.0f' % (name, rows, seconds, rows / seconds, total_revenue))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Benchmark for process_parsed_output.revenue_calc.
+Builds synthetic hit level data in the intermediate split layout and reports rows/sec of the attribution engine at each
+size. Run from the repository root:
+    python benchmarks/bench_revenue_calc.py --sizes 100000 1000000 10000000
+"""
+import argparse
+import time
+
+import pandas as pd
+
+import bench_env
+import dq_check_split_file
+import process_parsed_output
+from generate_hit_data import generate_hits, rows_per_scale
+
+
+def make_hits(rows, seed=0):
+    """
+    Creates a dataframe of synthetic hits in the intermediate split layout, sorted by ip and date_time in runs of
+    read_chunk_rows like dq_check_split_file writes them.
+    Arguments:
+        rows: int
+        seed: int
+    Returns:
+        df: pandas dataframe
+    """
+    hits = generate_hits(scale=rows / rows_per_scale, seed=seed)
+    chunk_rows = dq_check_split_file.read_chunk_rows
+    hits = pd.concat([dq_check_split_file.sort_hits(dq_check_split_file.transform_chunk(hits.iloc[i:i + chunk_rows]))
+                      for i in range(0, len(hits), chunk_rows)], ignore_index=True)
+    #numeric columns as the processor reads them back from the split files
+    for column in ['event_list', 'number_of_items', 'total_revenue']:
+        hits[column] = pd.to_numeric(hits[column], errors='coerce')
+    return hits
+
+
+def make_compact_hits(rows, seed=0):
+    """
+    Creates a dataframe of synthetic hits as process_parsed_output reads them from the splits.
+    Arguments:
+        rows: int
+        seed: int
+    Returns:
+        df: pandas dataframe
+    """
+    hits = make_hits(rows, seed)[process_parsed_output.processing_columns].copy()
+    return process_parsed_output.compact_hits(hits)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark revenue_calc throughput.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10 ** 5, 10 ** 6, 10 ** 7])
+    args = parser.parse_args()
+    print('rows\tseconds\trows_per_sec')
+    for rows in args.sizes:
+        df = make_compact_hits(rows)
+        start = time.perf_counter()
+        process_parsed_output.revenue_calc(df)
+        elapsed = time.perf_counter() - start
+        print('%d\t%.3f\t%.0f' % (rows, elapsed, rows / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark of the ordering and attribution of process_parsed_output against the global sort it replaced.
+hit_order merges the sorted runs dq_check_split_file writes in every split, attribute_revenue then takes one pass over
+the order. The former revenue_calc sorted a copy of all hits by ip and date_time and forward filled the last search
+within each ip group. Both run on hits as they come out of the splits (sorted runs) and on shuffled hits; time and the
+peak RSS they add are reported, each in a fresh process. Run from the repository root:
+    python benchmarks/bench_sort_merge.py --rows 1000000
+"""
+import argparse
+import gc
+import multiprocessing
+import time
+
+import pandas as pd
+
+import bench_env
+import metrics
+import process_parsed_output
+from bench_revenue_calc import make_compact_hits
+
+
+def global_sort_attribution(df):
+    """
+    The former sort and attribution of revenue_calc, without the search state.
+    """
+    df_sorted = df.sort_values(by=['ip', 'date_time'], ascending=True)
+    is_search = df_sorted['search_keyword'].notnull()
+    last_search = pd.DataFrame({
+        'search_engine_domain': df_sorted['search_engine_domain'].where(is_search),
+        'search_keyword': df_sorted['search_keyword'].where(is_search)
+    }).groupby(df_sorted['ip'], sort=False).ffill()
+    is_purchase = df_sorted['total_revenue'].notnull() & (df_sorted['event_list'] == 1)
+    output_df = last_search[is_purchase].astype(object).fillna('')
+    output_df['revenue'] = df_sorted.loc[is_purchase, 'total_revenue']
+    return output_df.reset_index(drop=True)
+
+
+def run_merge_attribution(df):
+    return process_parsed_output.attribute_revenue(df, process_parsed_output.hit_order(df))
+
+
+def measure(name, order, rows):
+    """
+    Builds parsed hits in the given order and times the ordering and attribution, in the process it is called in.
+    Arguments:
+        name: string, global_sort or run_merge
+        order: string, split runs or shuffled
+        rows: int
+    Returns:
+        seconds: float
+        peak_mb: float, peak RSS added by the ordering and attribution
+        revenue: float
+    """
+    df = make_compact_hits(rows)
+    if order == 'shuffled':
+        df = df.sample(frac=1, random_state=0).reset_index(drop=True)
+    referrer_df = process_parsed_output.parse_referrers(df['referrer'])
+    for column in ['search_engine_domain', 'search_keyword']:
+        df[column] = referrer_df[column]
+    attribution = global_sort_attribution if name == 'global_sort' else run_merge_attribution
+    gc.collect()
+    metrics.reset_peak_rss()
+    start_bytes = metrics.read_peak_rss()
+    start = time.perf_counter()
+    output_df = attribution(df)
+    seconds = time.perf_counter() - start
+    return seconds, (metrics.read_peak_rss() - start_bytes) / 2 ** 20, output_df['revenue'].sum()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the run merge ordering with the former global sort.')
+    parser.add_argument('--rows', type=int, default=10 ** 6)
+    args = parser.parse_args()
+    print('attribution\torder\trows\tseconds\trows_per_sec\tpeak_mb\trevenue')
+    context = multiprocessing.get_context('spawn')
+    for order in ['split runs', 'shuffled']:
+        for name in ['global_sort', 'run_merge']:
+            with context.Pool(1) as pool:
+                seconds, peak_mb, revenue = pool.apply(measure, (name, order, args.rows))
+            print('%s\t%s\t%d\t%.3f\t%.0f\t%.1f\t%.0f' % (name, order, args.rows, seconds, args.rows / seconds, peak_mb, revenue))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Cold start cost of each lambda handler module: the time to import it, which is when the modules read their
+configuration and build their storage and messaging backends, in a fresh python process as a new lambda container does.
+The S3 and SQS backends are used, with the environment of local_batch.py, and the heavy modules loaded by the import are
+listed. A budget in seconds can be given per module, the benchmark exits non zero when the median is over it, so it can
+guard the cold start in a build. Run from the repository root:
+    python benchmarks/bench_startup.py --repeats 5 --budget publish_sqs=0.2 dq_check_split_file=0.3
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+repository_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, repository_root)
+
+from local_batch import default_environment
+
+handler_modules = ['publish_sqs', 'dq_check_split_file', 'process_parsed_output']
+
+#modules that take a noticeable part of a cold start when they are imported
+heavy_modules = ['boto3', 'botocore', 'awswrangler', 'pandas', 'numpy', 'pyarrow']
+
+#run in the fresh process, prints the import time and the heavy modules it loaded
+import_script = '''
+import json, sys, time
+start = time.perf_counter()
+import %s
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'loaded': [i for i in %r if i in sys.modules]}))
+'''
+
+
+def measure(module):
+    """
+    Imports a handler module in a fresh python process.
+    Arguments:
+        module: string
+    Returns:
+        seconds: float
+        loaded: list, heavy modules loaded by the import
+    """
+    environment = dict(os.environ, **default_environment)
+    environment.update({'storage_backend': 's3', 'AWS_DEFAULT_REGION': environment.get('AWS_DEFAULT_REGION', 'us-west-2')})
+    output = subprocess.check_output([sys.executable, '-c', import_script % (module, heavy_modules)],
+                                     cwd=repository_root, env=environment)
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    return result['seconds'], result['loaded']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the cold start import of each lambda handler module.')
+    parser.add_argument('--modules', nargs='+', default=handler_modules)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--budget', nargs='+', default=[], help='module=seconds, largest median import time allowed')
+    args = parser.parse_args()
+    budgets = {name: float(seconds) for name, seconds in (i.split('=') for i in args.budget)}
+    over_budget = []
+    print('module\tmedian_seconds\tmax_seconds\tbudget\theavy_modules_loaded')
+    for module in args.modules:
+        runs = [measure(module) for i in range(args.repeats)]
+        seconds = [i[0] for i in runs]
+        median = statistics.median(seconds)
+        budget = budgets.get(module)
+        if budget is not None and median > budget:
+            over_budget.append(module)
+        print('%s\t%.3f\t%.3f\t%s\t%s' % (module, median, max(seconds), '' if budget is None else budget,
+                                        ','.join(runs[-1][1]) or '-'))
+    if over_budget:
+        print('over budget: ' + ', '.join(over_budget))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+Micro-benchmark suite for the hot paths of the pipeline: header read and column check, transform_split_files,
+referrer parsing and revenue_calc. Each function is timed at every size, then run again under tracemalloc for its peak
+memory. Results are written as json with the git commit, and can be compared with the results of another commit.
+Run from the repository root:
+    python benchmarks/bench_suite.py --sizes 100000 1000000 --output results.json --compare baseline.json
+"""
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+
+import pandas as pd
+
+import bench_env
+import dq_check_split_file
+import process_parsed_output
+from bench_revenue_calc import make_compact_hits
+from generate_hit_data import generate_hits, rows_per_scale, to_tsv
+
+
+def landing_stream(data):
+    stream = io.BufferedReader(io.BytesIO(data))
+    dq_check_split_file.read_header(stream)
+    return stream
+
+
+def check_columns(data):
+    stream = io.BufferedReader(io.BytesIO(data))
+    dq_check_split_file.check_file_columns(dq_check_split_file.read_header(stream))
+
+
+def split_files(data):
+    columns = dq_check_split_file.read_header(io.BufferedReader(io.BytesIO(data)))
+    dq_check_split_file.transform_split_files('landing', 'benchmark.tsv', '', landing_stream(data), columns)
+
+
+def parse_referrers(df):
+    process_parsed_output.cached_parse_referrer.cache_clear()
+    process_parsed_output.parse_referrers(df['referrer'])
+
+
+def revenue_calc(df):
+    process_parsed_output.revenue_calc(df.copy())
+
+
+#benchmarked function and the input it takes, landing file bytes or a split dataframe
+benchmarks = [
+    ('check_file_columns', check_columns, 'landing'),
+    ('transform_split_files', split_files, 'landing'),
+    ('parse_referrers', parse_referrers, 'split'),
+    ('revenue_calc', revenue_calc, 'split'),
+]
+
+
+def measure(fn, data):
+    """
+    Times one call of fn, then calls it again under tracemalloc to get its peak memory.
+    Arguments:
+        fn: function
+        data: input of fn
+    Returns:
+        seconds: float
+        peak_bytes: int
+    """
+    gc.collect()
+    start = time.perf_counter()
+    fn(data)
+    seconds = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    fn(data)
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak_bytes
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline):
+    """
+    Prints the time and peak memory of each result relative to the matching baseline result.
+    Arguments:
+        results: Dict
+        baseline: Dict
+    """
+    baseline_results = {(i['function'], i['rows']): i for i in baseline['results']}
+    print('\nfunction\trows\ttime_ratio\tpeak_memory_ratio\t(vs %s)' % baseline.get('commit'))
+    for result in results['results']:
+        old = baseline_results.get((result['function'], result['rows']))
+        if old is not None:
+            print('%s\t%d\t%.2f\t%.2f' % (result['function'], result['rows'], result['seconds'] / old['seconds'],
+                                          result['peak_bytes'] / max(old['peak_bytes'], 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time and profile the memory of the pipeline hot paths.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10 ** 4, 10 ** 5, 10 ** 6])
+    parser.add_argument('--functions', nargs='+', default=[i[0] for i in benchmarks])
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='results json of an earlier run to compare with')
+    args = parser.parse_args()
+
+    results = {'commit': git_commit(), 'created': datetime.now().isoformat(), 'python': platform.python_version(),
+               'pandas': pd.__version__, 'results': []}
+    print('function\trows\tseconds\trows_per_sec\tpeak_mb')
+    for rows in args.sizes:
+        inputs = {'landing': to_tsv(generate_hits(scale=rows / rows_per_scale)), 'split': make_compact_hits(rows)}
+        for name, fn, input_name in benchmarks:
+            if name not in args.functions:
+                continue
+            seconds, peak_bytes = measure(fn, inputs[input_name])
+            results['results'].append({'function': name, 'rows': rows, 'seconds': seconds,
+                                       'rows_per_sec': rows / seconds, 'peak_bytes': peak_bytes})
+            print('%s\t%d\t%.3f\t%.0f\t%.1f' % (name, rows, seconds, rows / seconds, peak_bytes / 2 ** 20))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Exact keyword revenue against the space saving summaries of aggregation_mode top_k, on attributed purchases with a long
+tail of keywords. The purchases are cut into splits, each split is aggregated on its own and the splits are merged, as
+merge_partials does. For each capacity the time, the keywords held and the accuracy of the top k are reported: the share
+of the true top k found, the largest revenue_error relative to the revenue, and whether every true revenue is within
+the bounds given. Run from the repository root:
+    python benchmarks/bench_top_k.py --purchases 1000000 --keywords 500000 --capacities 1000 10000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import bench_env
+import process_parsed_output
+
+
+def make_purchases(purchases, keywords, zipf=1.2, seed=0):
+    """
+    Creates attributed purchases whose keywords follow a zipf distribution.
+    Arguments:
+        purchases: int
+        keywords: int, number of distinct keywords
+        zipf: float, exponent of the keyword distribution
+        seed: int
+    Returns:
+        df: pandas dataframe
+    """
+    rng = np.random.default_rng(seed)
+    weights = 1 / np.arange(1, keywords + 1) ** zipf
+    keyword = rng.choice(keywords, size=purchases, p=weights / weights.sum())
+    engines = np.array(['google.com', 'bing.com', 'yahoo.com'], dtype=object)
+    return pd.DataFrame({
+        'search_engine_domain': engines[keyword % len(engines)],
+        'search_keyword': pd.Series(keyword).map('keyword %d'.__mod__).astype(object).values,
+        'revenue': rng.integers(1, 300, purchases).astype('float64'),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare exact and top_k keyword revenue aggregation.')
+    parser.add_argument('--purchases', type=int, default=10 ** 6)
+    parser.add_argument('--keywords', type=int, default=5 * 10 ** 5)
+    parser.add_argument('--zipf', type=float, default=1.2, help='exponent of the keyword distribution')
+    parser.add_argument('--splits', type=int, default=8)
+    parser.add_argument('--top-k', type=int, default=100)
+    parser.add_argument('--capacities', type=int, nargs='+', default=[10 ** 3, 10 ** 4, 10 ** 5])
+    args = parser.parse_args()
+    purchases = make_purchases(args.purchases, args.keywords, args.zipf)
+    splits = [purchases.iloc[i::args.splits] for i in range(args.splits)]
+
+    start = time.perf_counter()
+    exact = pd.concat([i.groupby(process_parsed_output.output_keys)['revenue'].sum() for i in splits])
+    exact = exact.groupby(level=[0, 1]).sum().sort_values(ascending=False)
+    print('mode\tcapacity\tseconds\tkeywords_held\ttop_k_recall\tmax_relative_error\twithin_bounds')
+    print('exact\t\t%.3f\t%d\t1.000\t0.0000\tTrue' % (time.perf_counter() - start, len(exact)))
+
+    for capacity in args.capacities:
+        process_parsed_output.sketch_capacity = max(capacity, args.top_k)
+        start = time.perf_counter()
+        summary = process_parsed_output.merge_revenue_summaries([process_parsed_output.summarize_revenue(i) for i in splits])
+        seconds = time.perf_counter() - start
+        top = summary.head(args.top_k)
+        recall = len(top.index.intersection(exact.index[:args.top_k])) / args.top_k
+        relative_error = (top['revenue_error'] / top['revenue']).max()
+        truth = exact.reindex(summary.index)
+        within = ((truth <= summary['revenue']) & (truth >= summary['revenue'] - summary['revenue_error'])).all()
+        if len(exact) > len(summary):
+            within = within and exact.drop(summary.index).max() <= summary['revenue_floor'].iloc[0]
+        print('top_k\t%d\t%.3f\t%d\t%.3f\t%.4f\t%s' % (capacity, seconds, len(summary), recall, relative_error, within))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Deterministic generator of synthetic hit level data shaped like data.tsv, for benchmarks and load tests.
+Visitors arrive from google, bing or yahoo searches or from internal pages, some of their hits are product views, cart
+events and purchases with one or more products in product_list. Run from the repository root:
+    python benchmarks/generate_hit_data.py --scale 10 --output hits.tsv
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+#scale 1 generates this many hits
+rows_per_scale = 100000
+
+columns = ['hit_time_gmt', 'date_time', 'user_agent', 'ip', 'event_list', 'geo_city', 'geo_region', 'geo_country',
+           'pagename', 'page_url', 'product_list', 'referrer']
+
+search_urls = {
+    'google': 'http://www.google.com/search?hl=en&client=firefox-a&rls=org.mozilla%3Aen-US%3Aofficial&q={}&aq=f&oq=&aqi=',
+    'bing': 'http://www.bing.com/search?q={}&go=&form=QBLH&qs=n',
+    'yahoo': 'http://search.yahoo.com/search?p={}&toggle=1&cop=mss&ei=UTF-8&fr=yfp-t-701',
+}
+
+keywords = ['Ipod', 'ipod', 'Zune', 'cd+player', 'ipod+nano', 'ipod+touch', 'headphones', 'mp3+player', 'zune+32gb',
+            'portable+speaker', 'usb+cable', 'car+charger']
+
+internal_pages = [
+    ('Home', 'http://www.esshopzilla.com'),
+    ('Hot Buys', 'http://www.esshopzilla.com/hotbuys/'),
+    ('Search Results', 'http://www.esshopzilla.com/search/?k=Ipod'),
+    ('Shopping Cart', 'http://www.esshopzilla.com/cart/'),
+    ('Checkout', 'https://www.esshopzilla.com/checkout/'),
+]
+
+products = [('Electronics', 'Ipod - Nano - 8GB', 190), ('Electronics', 'Ipod - Touch - 32GB', 290),
+            ('Electronics', 'Zune - 32GB', 250), ('Electronics', 'Zune - 328GB', 280), ('Audio', 'Headphones', 40),
+            ('Accessories', 'USB Cable', 10)]
+
+user_agents = ['Mozilla/5.0 (Windows; U; Windows NT 5.1; en-US; rv:1.9.0.10) Gecko/2009042316 Firefox/3.0.10',
+               'Mozilla/5.0 (Macintosh; U; Intel Mac OS X 10_4_11; en) AppleWebKit/525.27.1 (KHTML, like Gecko) Version/3.2.1 Safari/525.27.1',
+               'Mozilla/4.0 (compatible; MSIE 7.0; Windows NT 5.1)']
+
+geos = [('Salem', 'OR', 'US'), ('Rochester', 'NY', 'US'), ('Salt Lake City', 'UT', 'US'), ('Duncan', 'OK', 'US'),
+        ('Toronto', 'ON', 'CA'), ('London', 'ENG', 'GB')]
+
+
+def pick(rng, values, size, p=None):
+    return np.asarray(values, dtype=object)[rng.choice(len(values), size=size, p=p)]
+
+
+def product_strings(rng, size, with_revenue):
+    product_ids = rng.integers(0, len(products), size)
+    quantity = rng.integers(1, 4, size)
+    category = np.array([i[0] for i in products], dtype=object)[product_ids]
+    name = np.array([i[1] for i in products], dtype=object)[product_ids]
+    price = np.array([i[2] for i in products])[product_ids]
+    revenue = pd.Series(price * quantity).astype(str).values if with_revenue else ''
+    return category + ';' + name + ';' + pd.Series(quantity).astype(str).values + ';' + revenue + ';'
+
+
+def generate_hits(scale=1.0, visitors=None, searches_per_purchase=3.0, purchase_rate=0.02, engine_mix=None,
+                  max_products=3, seed=0):
+    """
+    Generates synthetic hits in the landing file layout.
+    Arguments:
+        scale: float, number of hits in multiples of rows_per_scale
+        visitors: int, number of distinct ip, a tenth of the hits by default
+        searches_per_purchase: float, hits with a search engine referrer per purchase
+        purchase_rate: float, share of hits that are purchases
+        engine_mix: Dict of engine name to share of the search referrers, google/bing/yahoo
+        max_products: int, purchases have between 1 and max_products products in product_list
+        seed: int
+    Returns:
+        df: pandas dataframe
+    """
+    rng = np.random.default_rng(seed)
+    rows = max(int(scale * rows_per_scale), 1)
+    visitors = visitors or max(rows // 10, 1)
+    engine_mix = engine_mix or {'google': 0.6, 'bing': 0.25, 'yahoo': 0.15}
+
+    visitor = rng.integers(0, visitors, rows)
+    hit_time_gmt = 1254033280 + np.sort(rng.integers(0, 86400, rows))
+    ip = pd.Series(visitor).map(lambda i: '%d.%d.%d.%d' % (1 + (i >> 24) % 223, i >> 16 & 255, i >> 8 & 255, i & 255)).values
+    geo = np.array(geos, dtype=object)[visitor % len(geos)]
+    user_agent = np.asarray(user_agents, dtype=object)[visitor % len(user_agents)]
+
+    kind = rng.random(rows)
+    search_rate = min(purchase_rate * searches_per_purchase, 1 - purchase_rate)
+    is_purchase = kind < purchase_rate
+    is_search = (kind >= purchase_rate) & (kind < purchase_rate + search_rate)
+    is_product_view = ~is_purchase & ~is_search & (rng.random(rows) < 0.2)
+
+    engines = list(engine_mix)
+    engine = pick(rng, engines, rows, p=np.array([engine_mix[i] for i in engines]) / sum(engine_mix.values()))
+    keyword = pick(rng, keywords, rows)
+    search_referrer = np.empty(rows, dtype=object)
+    for name in engines:
+        template = search_urls[name].split('{}')
+        search_referrer[engine == name] = template[0] + keyword[engine == name] + template[1]
+    page = rng.integers(0, len(internal_pages), rows)
+    page_url = np.array([i[1] for i in internal_pages], dtype=object)[page]
+    referrer = np.where(is_search, search_referrer, page_url)
+    referrer[is_purchase] = 'https://www.esshopzilla.com/checkout/?a=confirm'
+
+    product_count = rng.integers(1, max_products + 1, rows)
+    purchase_products = product_strings(rng, rows, True)
+    for i in range(1, max_products):
+        purchase_products = np.where(product_count > i, purchase_products + ',' + product_strings(rng, rows, True), purchase_products)
+    product_list = np.where(is_purchase, purchase_products, np.where(is_product_view, product_strings(rng, rows, False), ''))
+    event_list = np.where(is_purchase, '1', np.where(is_product_view, '2', pick(rng, ['', '', '11', '12'], rows)))
+    pagename = np.where(is_purchase, 'Order Complete', np.array([i[0] for i in internal_pages], dtype=object)[page])
+
+    return pd.DataFrame({
+        'hit_time_gmt': hit_time_gmt,
+        'date_time': pd.to_datetime(hit_time_gmt, unit='s').strftime('%Y-%m-%d %H:%M:%S'),
+        'user_agent': user_agent,
+        'ip': ip,
+        'event_list': event_list,
+        'geo_city': geo[:, 0],
+        'geo_region': geo[:, 1],
+        'geo_country': geo[:, 2],
+        'pagename': pagename,
+        'page_url': np.where(is_purchase, 'https://www.esshopzilla.com/checkout/?a=confirm', page_url),
+        'product_list': product_list,
+        'referrer': referrer,
+    }, columns=columns)
+
+
+def to_tsv(df):
+    """
+    Renders generated hits the way the landing files are written.
+    Arguments:
+        df: pandas dataframe
+    Returns:
+        bytes
+    """
+    return df.to_csv(sep='\t', index=False).encode('UTF-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic hit level data shaped like data.tsv.')
+    parser.add_argument('--scale', type=float, default=1.0, help='hits in multiples of %d' % rows_per_scale)
+    parser.add_argument('--visitors', type=int, default=None)
+    parser.add_argument('--searches-per-purchase', type=float, default=3.0)
+    parser.add_argument('--purchase-rate', type=float, default=0.02)
+    parser.add_argument('--engine-mix', default='google=0.6,bing=0.25,yahoo=0.15')
+    parser.add_argument('--max-products', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+    engine_mix = {name: float(share) for name, share in (i.split('=') for i in args.engine_mix.split(','))}
+    df = generate_hits(args.scale, args.visitors, args.searches_per_purchase, args.purchase_rate, engine_mix,
+                       args.max_products, args.seed)
+    with open(args.output, 'wb') as f:
+        f.write(to_tsv(df))
+
+
+if __name__ == '__main__':
+    main()
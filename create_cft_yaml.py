@@ -6,6 +6,8 @@ from troposphere.constants import NUMBER, STRING
 from troposphere.iam import Policy, Role
 from troposphere.sqs import Queue
 import yaml
+import json
+from search_engines import default_search_engine_rules
 
 t = Template()
 
@@ -34,6 +36,28 @@ Timeout = t.add_parameter(
     )
 )
 
+SQSBatchSize = t.add_parameter(
+    Parameter(
+        "SQSBatchSize",
+        Type=NUMBER,
+        Description="Number of sqs messages handed to one invocation of the process parsed output Lambda Function",
+        Default="10",
+        MinValue=1,
+        MaxValue=10000,
+    )
+)
+
+SQSBatchWindow = t.add_parameter(
+    Parameter(
+        "SQSBatchWindow",
+        Type=NUMBER,
+        Description="Seconds sqs messages are gathered for before a batch is handed over, required above 10 messages",
+        Default="5",
+        MinValue=0,
+        MaxValue=300,
+    )
+)
+
 Landings3Bucket = t.add_parameter(
     Parameter(
         "Landings3Bucket",
@@ -77,8 +101,14 @@ ProcessParsedLambdaFunction = t.add_resource(
         Runtime="python3.9",
         MemorySize=Ref(MemorySize),
         Timeout=Ref(Timeout),
-        Environment = Environment(Variables={'SQSURL': Ref("SQSforPublish"), 'final_bucket' : Ref(Processeds3Bucket), 'SNSTopicArn': Ref("DQSnstopic"),
-        'final_output_file_name':'_SearchKeywordPerformance.tsv'}),
+        Environment = Environment(Variables={'final_bucket' : Ref(Processeds3Bucket), 'SNSTopicArn': Ref("DQSnstopic"),
+        'final_output_file_name':'_SearchKeywordPerformance.tsv', 'referrer_cache_size' : '100000',
+        'intermediate_format' : 'parquet', 'checkpoint_prefix' : 'checkpoint/',
+        'search_engine_rules' : json.dumps(default_search_engine_rules),
+        'aggregation_mode' : 'exact', 'top_k' : '100', 'sketch_capacity' : '10000', 'processing_chunk_rows' : '0',
+        'rollup_dimensions' : '["date", "search_engine_domain", "search_keyword", "geo_country", "category"]',
+        'rollup_file_name' : '_RevenueRollup.parquet', 'attribution_models' : '["last"]', 'time_decay_half_life_hours' : '168',
+        'output_compression' : 'none'}),
         Layers = ['arn:aws:lambda:us-west-2:336392948345:layer:AWSDataWrangler-Python39:8', 'arn:aws:lambda:us-west-2:506446423536:layer:pandas:1']
     )
 )
@@ -88,7 +118,9 @@ EventSourceMapping = t.add_resource(
     EventSourceMapping("EventSourceMapping",
                         EventSourceArn = GetAtt("SQSforPublish", "Arn"),
                         FunctionName = GetAtt("ProcessParsedLambdaFunction", "Arn"),
-                        BatchSize = 1
+                        BatchSize = Ref(SQSBatchSize),
+                        MaximumBatchingWindowInSeconds = Ref(SQSBatchWindow),
+                        FunctionResponseTypes = ['ReportBatchItemFailures']
                         )
 
     )
@@ -105,9 +137,13 @@ DQLambdaFunction = t.add_resource(
         MemorySize=Ref(MemorySize),
         Timeout=Ref(Timeout),
         Environment = Environment(Variables={'SNSTopicArn': Ref("DQSnstopic"), 'target_bucket' : Ref(Intermediates3Bucket), 'file_type' : 'text/tab-separated-values',
-        'cols_for_analysis' : '["date_time", "ip", "event_list", "product_list", "referrer"]',
+        'cols_for_analysis' : '["date_time", "ip", "event_list", "geo_country", "product_list", "referrer"]',
         'expected_columns': '["hit_time_gmt", "date_time", "user_agent", "ip", "event_list", "geo_city", "geo_region", "geo_country" , "pagename", "page_url", "product_list", "referrer"]',
-        'product_list_split_cols' : '["category", "product_name", "number_of_items", "total_revenue", "custom_event"]'}),
+        'product_list_split_cols' : '["category", "product_name", "number_of_items", "total_revenue", "custom_event"]',
+        'read_chunk_rows' : '100000', 'split_target_rows' : '500000', 'split_target_bytes' : '0', 'multipart_part_bytes' : '8388608',
+        'split_partitions' : '8', 'intermediate_format' : 'parquet', 'intermediate_compression' : 'zstd', 'upload_concurrency' : '8',
+        'cache_ttl_seconds' : '604800', 'cache_prefix' : 'cache/',
+        'dq_thresholds' : '{"malformed_rate": 0.01, "null_rate": {"date_time": 0.01, "ip": 0.01}, "invalid_rate": {"date_time": 0.01, "ip": 0.01, "total_revenue": 0.01}}'}),
         Layers = ['arn:aws:lambda:us-west-2:336392948345:layer:AWSDataWrangler-Python39:8']
     )
 )
@@ -213,6 +249,21 @@ LambdaExecutionRole = t.add_resource(
                     ],
                 },
             ),
+            Policy(
+                PolicyName="s3ListAccessProcessed",
+                PolicyDocument={
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Action": "s3:ListBucket",
+                            "Resource": [
+                                        {"Fn::Join": ["", ["arn:aws:s3:::", {"Ref":"Processeds3Bucket"} ]]}
+                                        ],
+                            "Effect": "Allow",
+                        }
+                    ],
+                },
+            ),
             Policy(
                 PolicyName="snsAccess",
                 PolicyDocument={
@@ -304,8 +355,8 @@ SQSPublishLambdaFunction = t.add_resource(
         Runtime="python3.9",
         MemorySize=Ref(MemorySize),
         Timeout=Ref(Timeout),
-        Environment = Environment(Variables={'SNSTopicArn': Ref("DQSnstopic"), 'SQSURL': Ref(SQSforPublish) }),
-        Layers = ['arn:aws:lambda:us-west-2:336392948345:layer:AWSDataWrangler-Python39:8']
+        #publish_sqs only needs boto3, which the lambda runtime has, so it is deployed without the data layers
+        Environment = Environment(Variables={'SNSTopicArn': Ref("DQSnstopic"), 'SQSURL': Ref(SQSforPublish) })
     )
 )
 
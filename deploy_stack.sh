@@ -1,5 +1,9 @@
 aws s3 mb s3://hit-level-data-lambda-codebase
 
+zip -j dq_check_split_file.zip dq_check_split_file.py backends.py metrics.py
+zip -j publish_sqs.zip publish_sqs.py backends.py metrics.py
+zip -j process_parsed_output.zip process_parsed_output.py backends.py metrics.py search_engines.py
+
 aws s3 cp dq_check_split_file.zip s3://hit-level-data-lambda-codebase
 aws s3 cp publish_sqs.zip s3://hit-level-data-lambda-codebase
 aws s3 cp process_parsed_output.zip s3://hit-level-data-lambda-codebase
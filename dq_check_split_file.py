@@ -1,22 +1,30 @@
+import hashlib
+import itertools
 import json
-import boto3
 import logging
+import math
 import os
-import numpy as np
-from io import StringIO
+import threading
+import time
+import zlib
+from io import BufferedReader, RawIOBase
 from datetime import date
-import awswrangler as wr
+from concurrent.futures import ThreadPoolExecutor
+from backends import get_storage, get_messaging, NotificationBuffer
+from metrics import Metrics
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-#boto clients for aws services
+#storage and messaging backends, s3 and sns unless run locally
 try:
-    s3_client = boto3.client('s3')
-    sns_client = boto3.client('sns')
+    storage = get_storage()
+    messaging = get_messaging()
 except Exception as e:
     logger.error ('Failed! Issue in making boto client connections with AWS resources ' + str(e))
     raise e
+#codecs the splits of each intermediate_format can be compressed with, parquet compresses inside the file
+intermediate_codecs = {'tsv': ['none', 'gzip'], 'parquet': ['none', 'snappy', 'gzip', 'zstd']}
 #environment variables in lambda passed from CFT
 try:
     target_bucket = os.environ['target_bucket']
@@ -25,27 +33,113 @@ try:
     expected_columns = json.loads(os.environ['expected_columns'])
     cols_for_analysis = json.loads(os.environ['cols_for_analysis'])
     product_list_split_cols = json.loads(os.environ['product_list_split_cols'])
+    read_chunk_rows = int(os.environ.get('read_chunk_rows', 100000))
+    split_target_rows = int(os.environ.get('split_target_rows', 500000))
+    split_target_bytes = int(os.environ.get('split_target_bytes', 0))
+    multipart_part_bytes = int(os.environ.get('multipart_part_bytes', 8 * 1024 * 1024))
+    split_partitions = int(os.environ.get('split_partitions', 0))
+    intermediate_format = os.environ.get('intermediate_format', 'tsv')
+    upload_concurrency = int(os.environ.get('upload_concurrency', 8))
+    cache_ttl_seconds = int(os.environ.get('cache_ttl_seconds', 0))
+    cache_prefix = os.environ.get('cache_prefix', 'cache/')
+    dq_thresholds = json.loads(os.environ.get('dq_thresholds', '{}'))
+    if intermediate_format not in ('tsv', 'parquet'):
+        raise ValueError('intermediate_format should be tsv or parquet, got ' + intermediate_format)
+    intermediate_compression = os.environ.get('intermediate_compression', 'snappy' if intermediate_format == 'parquet' else 'none')
+    if intermediate_compression not in intermediate_codecs[intermediate_format]:
+        raise ValueError('intermediate_compression of ' + intermediate_format + ' splits should be one of ' +
+                         ', '.join(intermediate_codecs[intermediate_format]) + ', got ' + intermediate_compression)
 except Exception as e:
     logger.error ('Failed! Issue with reading environment variables in DQ Lambda function ' + str(e))
     raise e
+#file extension of the splits, tsv splits compressed with gzip end with .gz
+split_extension = '.' + intermediate_format + ('.gz' if intermediate_compression == 'gzip' and intermediate_format == 'tsv' else '')
+metrics = Metrics('dq_check_split_file')
+notifications = NotificationBuffer(messaging, snstopicarn)
+
+#version of the code and of the configuration shaping the splits, a result cache entry is reused only by the same version
+with open(__file__, 'rb') as f:
+    cache_version = hashlib.sha256(f.read() + json.dumps([expected_columns, cols_for_analysis, product_list_split_cols,
+        split_target_rows, split_target_bytes, split_partitions, intermediate_format, intermediate_compression,
+        dq_thresholds]).encode('UTF-8')).hexdigest()
 
 def lambda_handler(event, context):
     """
     This acts as the main driver function, calling DQ functions and sending notification based on results.
     It accepts events and context as argument from the AWS services calling the lambda function.
+    Every record of the event is processed, a failed file doesn't stop the others and the invocation fails once all
+    records were tried, listing the files that failed. Reports of files that failed DQ are sent as one notification at
+    the end of the invocation, the report of a file that passed travels with its splits into the final summary.
+    Stage metrics are emitted at the end of every invocation.
     Arguments:
         event: Dict
         context: Dict
     Returns:
         Dict
     """
+    metrics.start(context)
+    status = 'Failed'
     try:
-        bucket_name = event['Records'][0]['s3']['bucket']['name']
-        file_name = event['Records'][0]['s3']['object']['key']
-        response = s3_client.get_object(Bucket=bucket_name, Key=file_name)
-        msg = ''
+        failures = {}
+        for record in event['Records']:
+            bucket_name = record['s3']['bucket']['name']
+            file_name = record['s3']['object']['key']
+            try:
+                dq_split_file(bucket_name, file_name)
+            except Exception as e:
+                failures['s3://' + bucket_name + '/' + file_name] = e
+        if failures:
+            notifications.add('Failed! DQ and split has issue for ' + str(len(failures)) + ' of ' + str(len(event['Records'])) +
+                              ' files.\n' + '\n'.join(key + ': ' + str(error) for key, error in failures.items()))
+            raise Exception(str(len(failures)) + ' of ' + str(len(event['Records'])) + ' files failed. ' +
+                            ' '.join(key + ': ' + str(error) for key, error in failures.items()))
+        status = 'Succeeded'
+        return {
+            'statusCode': 200,
+            'body': json.dumps('DQ complete and file split was successful.')
+        }
+    except Exception as e:
+        logger.error ('Failed! DQ Lambda handler has issue ' + str(e))
+        raise e
+    finally:
+        with metrics.stage('notify'):
+            send_dq_report()
+        metrics.emit(status)
+
+
+def dq_split_file(bucket_name, file_name):
+    """
+    Runs the DQ checks on one landing file. When they pass, the file is split and the indicator file is written with
+    the DQ report, otherwise the report is buffered for the notification.
+    With cache_ttl_seconds set, content already split by the same code and configuration within the TTL is not split
+    again, the report of the cache hit points to the existing splits and nothing downstream is triggered.
+    Arguments:
+        bucket_name: string
+        file_name: string
+    """
+    try:
+        landing_object = storage.open_object(bucket_name, file_name)
+        with metrics.stage('cache_lookup'):
+            cache_key = result_cache_key(landing_object)
+            cache_entry = read_cache_entry(cache_key)
+        if cache_entry is not None:
+            landing_object.body.close()
+            logger.info ('Cache hit, s3://' + bucket_name + '/' + file_name + ' was already split.')
+            notifications.add('DQ report of s3://' + bucket_name + '/' + file_name + ':\nCache hit! The same content was split at ' +
+                              time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(cache_entry['Created'])) + ' UTC into ' +
+                              str(len(cache_entry['Splits'])) + ' files, indicator file s3://' + target_bucket + '/' +
+                              cache_entry['Indicator'] + '. DQ and split are skipped.')
+            return
+        profile = DQProfile()
+        with metrics.stage('read_header') as stage:
+            body, hit_data_stream, codec = open_landing_stream(landing_object, profile)
+            actual_columns = read_header(hit_data_stream)
+            stage.bytes_read = body.bytes_read
+        msg = 'Cache miss. ' if cache_key is not None else ''
+        if codec is not None:
+            msg += 'File is compressed with ' + codec + '. '
         dq_flag = True
-        if check_file_format(response):
+        if check_file_format(landing_object, codec):
             logger.info ('File format looks good.')
             msg += 'File format looks good. '
         else:
@@ -53,7 +147,7 @@ def lambda_handler(event, context):
             msg += 'File format has issue. '
             dq_flag = False
 
-        if check_file_columns(response):
+        if check_file_columns(actual_columns):
             logger.info('File columns look good.')
             msg += 'File columns look good. '
         else:
@@ -61,106 +155,879 @@ def lambda_handler(event, context):
             msg += 'File columns has issue. '
             dq_flag = False
         if dq_flag:
-            msg = transform_split_files(bucket_name, file_name, msg)
-        send_dq_report(msg)
-        return {
-            'statusCode': 200,
-            'body': json.dumps('DQ complete and file split was successful.')
-        }
+            try:
+                msg, splits = transform_split_files(bucket_name, file_name, msg, hit_data_stream, actual_columns, profile,
+                                                    landing_object.size, body)
+            except SplitUploadError as e:
+                notifications.add('DQ report of s3://' + bucket_name + '/' + file_name + ':\n' + msg + '\nFailed! ' + str(len(e.failures)) + ' splits could not be uploaded.\n' + str(e))
+                raise e
+            msg += profile.report(actual_columns)
+            violations = profile.violations(actual_columns)
+            if violations:
+                logger.error('Data quality profile has issue.')
+                msg += '\nData quality profile has issue: ' + '; '.join(violations) + '. The splits are deleted and not published.'
+                delete_splits(splits)
+                dq_flag = False
+            else:
+                logger.info('Data quality profile looks good.')
+                msg += '\nData quality profile looks good.'
+        hit_data_stream.close()
+        msg = 'DQ report of s3://' + bucket_name + '/' + file_name + ':\n' + msg
+        msg += '\nBytes read from s3://' + bucket_name + '/' + file_name + ' : ' + str(body.bytes_read) + ' of ' + str(landing_object.size) + '.'
+        if codec is not None:
+            msg += ' They were decompressed to ' + str(hit_data_stream.raw.bytes_read) + ' bytes.'
+        if dq_flag:
+            indicator_key = write_indicator_file(splits, msg)
+            write_cache_entry(cache_key, indicator_key, splits)
+        else:
+            notifications.add(msg)
     except Exception as e:
-        logger.error ('Failed! DQ Lambda handler has issue ' + str(e))
+        logger.error ('Failed! DQ of s3://' + bucket_name + '/' + file_name + ' has issue ' + str(e))
         raise e
 
 
-def check_file_format(response):
+def check_file_format(landing_object, codec=None):
     """
-    Checks file format of the incoming file with expected.
+    Checks file format of the incoming file with expected. A compressed file may also have the content type of its
+    codec, its content is checked by the column checks once decompressed.
     Arguments:
-        response: s3 get object
+        landing_object: StoredObject
+        codec: string, codec the file is compressed with, None when it is not
     Returns:
         Boolean
     """
     try:
-        ContentType = response['ResponseMetadata']['HTTPHeaders']['content-type']
+        ContentType = landing_object.content_type
         if ContentType == file_type:
             return True
+        elif codec is not None and ContentType in compressed_content_types:
+            return True
         else:
             return False
     except Exception as e:
         logger.error ('Failed! Issue with checking file format ' + str(e))
         raise e
 
-def check_file_columns(response):
+class CountingStream(RawIOBase):
+    """
+    Wraps the body of the landing object so it can be buffered and read once, counting the bytes pulled from storage,
+    or wraps the decompressed content of a compressed body, counting the bytes decompressed.
+    The bytes are also handed to the DQ profile, if there is one, to count the fields of every line.
+    """
+    def __init__(self, body, profile=None):
+        self.body = body
+        self.profile = profile
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.body.read(len(buffer))
+        buffer[:len(data)] = data
+        self.bytes_read += len(data)
+        if self.profile is not None:
+            self.profile.count_fields(data)
+        return len(data)
+
+    def close(self):
+        self.body.close()
+        super().close()
+
+
+#magic bytes starting a compressed landing file and the codec it is decompressed with
+landing_codecs = {b'\x1f\x8b': 'gzip', b'\x28\xb5\x2f\xfd': 'zstd'}
+#content types a compressed landing file may be stored with, besides file_type
+compressed_content_types = ['application/gzip', 'application/x-gzip', 'application/zstd', 'application/octet-stream', 'binary/octet-stream']
+
+
+def open_landing_stream(landing_object, profile=None):
+    """
+    Opens the body of a landing object to be read once. gzip and zstd files, told by their magic bytes, are
+    decompressed by pyarrow as they are read, so neither the compressed nor the decompressed file is held in memory.
+    Arguments:
+        landing_object: StoredObject
+        profile: DQProfile, gets the bytes of the tsv content
+    Returns:
+        body: CountingStream, counts the bytes pulled from storage
+        hit_data_stream: buffered stream of the tsv content
+        codec: string, None when the file is not compressed
+    """
+    try:
+        body = CountingStream(landing_object.body)
+        compressed_stream = BufferedReader(body)
+        magic = compressed_stream.peek(4)[:4]
+        codec = next((codec for prefix, codec in landing_codecs.items() if magic.startswith(prefix)), None)
+        if codec is None:
+            return body, BufferedReader(CountingStream(compressed_stream, profile)), None
+        import pyarrow as pa
+        content = pa.CompressedInputStream(pa.PythonFile(compressed_stream, mode='r'), codec)
+        return body, BufferedReader(CountingStream(content, profile)), codec
+    except Exception as e:
+        logger.error ('Failed! Issue with opening landing file ' + str(e))
+        raise e
+
+
+def read_header(hit_data_stream):
+    """
+    Reads only the header line of the incoming file, leaving the stream positioned at the first data row.
+    Arguments:
+        hit_data_stream: buffered landing object stream
+    Returns:
+        actual_columns: list
+    """
+    try:
+        return hit_data_stream.readline().decode('UTF-8').rstrip('\r\n').split('\t')
+    except Exception as e:
+        logger.error ('Failed! Issue with reading file header ' + str(e))
+        raise e
+
+def check_file_columns(actual_columns):
     """
     Checks file columns of the incoming file with expected.
     Arguments:
-        response: s3 get object
+        actual_columns: list
     Returns:
         Boolean
     """
     try:
-        contents = response['Body'].read().decode('UTF-8')
-        actual_columns = contents.split('\n')[0].split('\t')
         if len(actual_columns) != len(expected_columns):
             return False
         else:
-            for i in expected_columns:
-                if i in actual_columns:
-                    return True
-                else:
-                    return False
+            return all(i in actual_columns for i in expected_columns)
     except Exception as e:
         logger.error ('Failed! Issue with checking file columns ' + str(e))
         raise e
 
-def send_dq_report(msg):
+#patterns the values of the columns for analysis should fully match, checked with vectorized string operations
+ipv4_octet_pattern = r'(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)'
+column_patterns = {
+    'ip': r'(?:' + ipv4_octet_pattern + r'\.){3}' + ipv4_octet_pattern + r'|[0-9A-Fa-f.]*:[0-9A-Fa-f:.]*',
+    'date_time': r'\d{4}-(?:0[1-9]|1[0-2])-(?:0[1-9]|[12]\d|3[01]) (?:[01]\d|2[0-3]):[0-5]\d:[0-5]\d',
+    'event_list': r'\d+(?:,\d+)*',
+}
+
+
+class DQProfile:
     """
-    Sends an sns notification updating about DQ results.
-    Arguments:
-        msg: string
+    Row level data quality profile of a landing file, built during the read of the split stage so the data is not read
+    again. The landing stream hands it every block of bytes, the tabs of every line are counted with numpy and lines
+    whose number of fields differs from the header are malformed (blank lines are skipped, like the reader does). The
+    split stage hands it every chunk of hits, the null values and the values not matching column_patterns are counted per
+    column, and parse_product_list counts the hits whose number of items or revenue is not numeric.
+    Rates over dq_thresholds fail the file, e.g. {"malformed_rate": 0.01, "null_rate": {"ip": 0}, "invalid_rate":
+    {"total_revenue": 0.001}}.
+    """
+    def __init__(self):
+        self.rows = 0
+        self.null_values = {}
+        self.invalid_values = {}
+        #number of lines by their number of tabs, and tabs and bytes of the line not ended yet
+        self.lines_by_tabs = []
+        self.line_tabs = 0
+        self.line_bytes = 0
+
+    def count_fields(self, data):
+        """
+        Counts the tabs of the lines ended in a block of the landing file.
+        Arguments:
+            data: bytes
+        """
+        import numpy as np
+        block = np.frombuffer(data, dtype=np.uint8)
+        newlines = np.flatnonzero(block == ord('\n'))
+        tabs = np.flatnonzero(block == ord('\t'))
+        if len(newlines) == 0:
+            self.line_tabs += len(tabs)
+            self.line_bytes += len(block)
+            return
+        tabs_before = np.searchsorted(tabs, newlines)
+        line_tabs = np.diff(tabs_before, prepend=0)
+        line_bytes = np.diff(newlines, prepend=-1) - 1
+        line_tabs[0] += self.line_tabs
+        line_bytes[0] += self.line_bytes
+        self.add_lines(line_tabs[(line_tabs > 0) | (line_bytes > 1)])
+        self.line_tabs = len(tabs) - tabs_before[-1]
+        self.line_bytes = len(block) - newlines[-1] - 1
+
+    def add_lines(self, line_tabs):
+        import numpy as np
+        for tabs, lines in enumerate(np.bincount(line_tabs).tolist()):
+            if tabs == len(self.lines_by_tabs):
+                self.lines_by_tabs.append(0)
+            self.lines_by_tabs[tabs] += lines
+
+    def profile_chunks(self, chunks):
+        """
+        Passes the chunks of hits through, counting their null and invalid values.
+        Arguments:
+            chunks: iterable of pandas dataframes, values as text
+        """
+        for chunk in chunks:
+            self.rows += len(chunk)
+            for column in chunk.columns:
+                nulls = chunk[column].isnull()
+                self.null_values[column] = self.null_values.get(column, 0) + int(nulls.sum())
+                if column in column_patterns:
+                    valid = chunk[column][~nulls].str.fullmatch(column_patterns[column]).astype(bool)
+                    self.count_invalid(column, int((~valid).sum()))
+            yield chunk
+
+    def count_invalid(self, column, count):
+        self.invalid_values[column] = self.invalid_values.get(column, 0) + count
+
+    def malformed_rows(self, columns):
+        """
+        Gives the number of data lines read and of those whose number of fields differs from the header.
+        Arguments:
+            columns: list, columns of the header
+        Returns:
+            lines: int
+            malformed: int
+        """
+        lines_by_tabs = self.lines_by_tabs + [0] * max(len(columns) - len(self.lines_by_tabs), 0)
+        if self.line_tabs > 0 or self.line_bytes > 1:
+            lines_by_tabs = lines_by_tabs + [0] * max(self.line_tabs + 1 - len(lines_by_tabs), 0)
+            lines_by_tabs[self.line_tabs] += 1
+        #the header is one of the lines with as many fields as columns
+        lines = max(sum(lines_by_tabs) - 1, 0)
+        return lines, lines - max(lines_by_tabs[len(columns) - 1] - 1, 0)
+
+    def rates(self, columns):
+        """
+        Gives the rates compared with dq_thresholds.
+        Arguments:
+            columns: list, columns of the header
+        Returns:
+            Dict, malformed_rate, and null_rate and invalid_rate by column
+        """
+        lines, malformed = self.malformed_rows(columns)
+        rows = max(self.rows, 1)
+        return {
+            'malformed_rate': malformed / max(lines, 1),
+            'null_rate': {column: count / rows for column, count in self.null_values.items()},
+            'invalid_rate': {column: count / rows for column, count in self.invalid_values.items()},
+        }
+
+    def violations(self, columns):
+        """
+        Lists the rates which are over their threshold in dq_thresholds.
+        Arguments:
+            columns: list, columns of the header
+        Returns:
+            violations: list of strings
+        """
+        rates = self.rates(columns)
+        violations = []
+        if rates['malformed_rate'] > dq_thresholds.get('malformed_rate', 1):
+            violations.append('malformed rows %.2f%% over %.2f%%' % (rates['malformed_rate'] * 100, dq_thresholds['malformed_rate'] * 100))
+        for name in ['null_rate', 'invalid_rate']:
+            for column, threshold in dq_thresholds.get(name, {}).items():
+                rate = rates[name].get(column, 0)
+                if rate > threshold:
+                    violations.append('%s %s %.2f%% over %.2f%%' % (column, name.replace('_', ' '), rate * 100, threshold * 100))
+        return violations
+
+    def report(self, columns):
+        """
+        Renders the profile for the DQ report.
+        Arguments:
+            columns: list, columns of the header
+        Returns:
+            msg: string
+        """
+        lines, malformed = self.malformed_rows(columns)
+        rates = self.rates(columns)
+        msg = '\nData quality profile: ' + str(lines) + ' rows, ' + str(malformed) + ' malformed (number of fields differs from the header).'
+        msg += '\nNull rate: ' + ', '.join('%s %.2f%%' % (column, rate * 100) for column, rate in rates['null_rate'].items()) + '.'
+        msg += '\nInvalid values: ' + ', '.join(column + ' ' + str(count) for column, count in self.invalid_values.items()) + '.'
+        return msg
+
+
+def send_dq_report():
+    """
+    Sends the buffered DQ reports of the invocation as one sns notification.
     """
     try:
-        sns_client.publish (
-          TargetArn = snstopicarn,
-          Message = msg
-       )
+        notifications.flush()
         logger.info ('SNS notification has been sent')
     except Exception as e:
         logger.error ('Failed! Issue with sending DQ report ' + str(e))
         raise e
 
-def transform_split_files(bucket_name, file_name, msg):
+
+def delete_splits(splits):
+    """
+    Deletes the splits of a file which failed the DQ profile or whose upload failed, so no split of a rejected file
+    is left next to the published ones for process_parsed_output to read with its day.
+    Arguments:
+        splits: list
+    """
+    try:
+        with metrics.stage('delete_splits') as stage:
+            storage.delete_objects(target_bucket, splits)
+            stage.counters['DeletedSplits'] = len(splits)
+    except Exception as e:
+        logger.error ('Failed! Deleting splits ' + ', '.join(splits) + ' has issue ' + str(e))
+        raise e
+
+
+def write_indicator_file(splits, msg):
+    """
+    Creates and uploads indicator file for next process, next to the splits. It lists the splits, how they were made
+    and holds the DQ report. Every landing file has its own indicator, named after its splits, e.g.
+    2022-07-08/data_Success.json for 2022-07-08/data_1.tsv, so files split on the same day don't overwrite each other's.
+    The split run names this split of the file by the time it was written, so the partial outputs of a file split again
+    on the same day are kept apart from the earlier ones. SplitPartitions tells which hash partition every split holds.
+    Arguments:
+        splits: list
+        msg: string
+    Returns:
+        resultfileName: string
+    """
+    try:
+        result_dict = {}
+        result_dict['Result'] = 'Success'
+        result_dict['Partitioned'] = split_partitions > 0
+        result_dict['Splits'] = splits
+        result_dict['SplitRun'] = str(time.time_ns())
+        result_dict['SplitPartitions'] = split_partitions
+        result_dict['Report'] = msg
+        resultfileName = splits[0].rsplit('_', 1)[0] + '_' + 'Success' + '.json'
+        uploadByteStream = bytes(json.dumps(result_dict).encode('UTF-8'))
+        with metrics.stage('write_indicator') as stage:
+            storage.put_object(target_bucket, resultfileName, uploadByteStream)
+            stage.bytes_written = len(uploadByteStream)
+        return resultfileName
+    except Exception as e:
+        logger.error ('Failed! Writing indicator file has issue ' + str(e))
+        raise e
+
+
+def result_cache_key(landing_object):
+    """
+    Gives the key of the result cache entry of a landing object, addressed by its content (ETag and size) and the
+    cache_version. There is no key when the cache is off or the object has no ETag.
+    Arguments:
+        landing_object: StoredObject
+    Returns:
+        key: string or None
+    """
+    if cache_ttl_seconds <= 0 or not landing_object.etag:
+        return None
+    content = json.dumps([landing_object.etag, landing_object.size, cache_version]).encode('UTF-8')
+    #no .json suffix, entries must not trigger the publish sqs function
+    return cache_prefix + hashlib.sha256(content).hexdigest()
+
+
+def read_cache_entry(cache_key):
+    """
+    Reads a result cache entry. Entries older than cache_ttl_seconds, or whose indicator file is gone or no longer lists
+    the splits of the entry, are misses.
+    Arguments:
+        cache_key: string or None
+    Returns:
+        cache_entry: Dict or None
+    """
+    try:
+        if cache_key is None or not storage.object_exists(target_bucket, cache_key):
+            return None
+        cache_entry = json.loads(storage.open_object(target_bucket, cache_key).body.read().decode('UTF-8'))
+        if time.time() - cache_entry['Created'] > cache_ttl_seconds:
+            logger.info ('Cache entry ' + cache_key + ' has expired.')
+            return None
+        if not storage.object_exists(target_bucket, cache_entry['Indicator']):
+            logger.info ('Indicator file of cache entry ' + cache_key + ' is gone.')
+            return None
+        indicator = json.loads(storage.open_object(target_bucket, cache_entry['Indicator']).body.read().decode('UTF-8'))
+        if indicator.get('Splits') != cache_entry['Splits']:
+            logger.info ('Indicator file of cache entry ' + cache_key + ' lists other splits.')
+            return None
+        return cache_entry
+    except Exception as e:
+        logger.error ('Failed! Reading result cache entry has issue ' + str(e))
+        raise e
+
+
+def write_cache_entry(cache_key, indicator_key, splits):
+    """
+    Records that the content of the cache key was split, once its indicator file is written.
+    Arguments:
+        cache_key: string or None
+        indicator_key: string
+        splits: list
+    """
+    try:
+        if cache_key is not None:
+            cache_entry = {'Created': time.time(), 'Version': cache_version, 'Indicator': indicator_key, 'Splits': splits}
+            storage.put_object(target_bucket, cache_key, json.dumps(cache_entry).encode('UTF-8'))
+    except Exception as e:
+        logger.error ('Failed! Writing result cache entry has issue ' + str(e))
+        raise e
+
+#arrow types of the columns typed in parquet splits, all other columns are written as strings. event_list stays a
+#string like in tsv splits, as a hit with several events, e.g. 1,200,201, is not a number
+parquet_column_types = {'date_time': 'timestamp[us]', 'number_of_items': 'double', 'total_revenue': 'double'}
+parquet_dictionary_columns = ['ip', 'referrer']
+
+
+class SplitSink(RawIOBase):
+    """
+    File like object handed to the parquet writer, it forwards the encoded bytes to a SplitWriter.
+    """
+    def __init__(self, split_writer):
+        self.split_writer = split_writer
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.split_writer.write(bytes(data), 0)
+        return len(data)
+
+    def tell(self):
+        return self.split_writer.bytes_written
+
+
+class UploadPool:
+    """
+    Bounded thread pool for the split uploads. Submitting blocks while twice the concurrency of uploads are in flight,
+    so buffered parts don't pile up in memory when s3 is slower than the file is read.
+    """
+    def __init__(self, concurrency):
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.slots = threading.BoundedSemaphore(concurrency * 2)
+
+    def submit(self, fn, *args, **kwargs):
+        self.slots.acquire()
+        future = self.executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(lambda f: self.slots.release())
+        return future
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class SplitUploadError(Exception):
+    """
+    Raised when some of the splits could not be uploaded, it holds the error of every failed split.
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        super().__init__('\n'.join('Upload of split ' + key + ' failed: ' + str(error) for key, error in failures.items()))
+
+
+class SplitWriter:
+    """
+    Uploads one split file to storage in the intermediate_format. Rendered rows are buffered until multipart_part_bytes,
+    a split growing beyond that is sent as a multipart upload so only one part is held in memory at a time.
+    Parquet splits get one row group per written frame, compressed with intermediate_compression. tsv splits compressed
+    with gzip are one gzip stream, the rendered rows go through the compressor before they are buffered. Uploads run on the upload pool and are confirmed by wait,
+    a failure is kept on the writer so every split reports its own error.
+    """
+    def __init__(self, key, upload_pool):
+        self.key = key
+        self.upload_pool = upload_pool
+        self.buffer = bytearray()
+        self.rows = 0
+        self.bytes_written = 0
+        self.upload_id = None
+        self.uploads = []
+        self.closed = False
+        self.error = None
+        self.parquet_writer = None
+        self.header_written = False
+        self.compressor = zlib.compressobj(wbits=31) if key.endswith('.gz') else None
+
+    def write(self, data, rows):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.buffer += data
+        self.rows += rows
+        self.bytes_written += len(data)
+        if len(self.buffer) >= multipart_part_bytes:
+            self.upload_part()
+
+    def write_frame(self, df):
+        if self.error is not None:
+            return
+        try:
+            if intermediate_format == 'parquet':
+                import pyarrow.parquet as pq
+                table = to_parquet_table(df)
+                if self.parquet_writer is None:
+                    self.parquet_writer = pq.ParquetWriter(SplitSink(self), table.schema, use_dictionary=parquet_dictionary_columns,
+                                                           compression=intermediate_compression)
+                self.parquet_writer.write_table(table)
+                self.rows += len(df)
+            else:
+                self.write(df.to_csv(sep='\t', index=False, header=not self.header_written).encode('UTF-8'), len(df))
+                self.header_written = True
+        except Exception as e:
+            self.fail(e)
+
+    def is_full(self):
+        return (split_target_rows > 0 and self.rows >= split_target_rows) or \
+            (split_target_bytes > 0 and self.bytes_written >= split_target_bytes)
+
+    def upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = storage.create_multipart_upload(target_bucket, self.key)
+        self.uploads.append(self.upload_pool.submit(self.send_part, len(self.uploads) + 1, bytes(self.buffer)))
+        self.buffer = bytearray()
+
+    def send_part(self, part_number, data):
+        return storage.upload_part(target_bucket, self.key, self.upload_id, part_number, data)
+
+    def close(self):
+        if self.error is not None:
+            return
+        try:
+            if self.parquet_writer is not None:
+                self.parquet_writer.close()
+            if self.compressor is not None:
+                data = self.compressor.flush()
+                self.buffer += data
+                self.bytes_written += len(data)
+            if self.upload_id is None:
+                self.uploads.append(self.upload_pool.submit(storage.put_object, target_bucket, self.key, bytes(self.buffer)))
+                self.buffer = bytearray()
+            elif self.buffer:
+                self.upload_part()
+        except Exception as e:
+            self.fail(e)
+
+    def wait(self):
+        """
+        Waits for the uploads of the split and completes its multipart upload.
+        Returns:
+            error: Exception, None when the upload is confirmed
+        """
+        if self.error is None and not self.closed:
+            try:
+                parts = [upload.result() for upload in self.uploads]
+                if self.upload_id is not None:
+                    storage.complete_multipart_upload(target_bucket, self.key, self.upload_id, parts)
+                self.closed = True
+            except Exception as e:
+                self.fail(e)
+        return self.error
+
+    def fail(self, e):
+        logger.error ('Failed! Upload of split ' + self.key + ' has issue ' + str(e))
+        self.error = e
+        self.abort()
+
+    def abort(self):
+        if self.upload_id is not None and not self.closed:
+            self.closed = True
+            try:
+                storage.abort_multipart_upload(target_bucket, self.key, self.upload_id)
+            except Exception as e:
+                logger.error ('Failed! Abort of multipart upload of split ' + self.key + ' has issue ' + str(e))
+
+
+def to_parquet_table(df):
+    """
+    Converts a transformed chunk to an arrow table with the typed parquet split schema.
+    Arguments:
+        df: pandas dataframe
+    Returns:
+        table: pyarrow table
+    """
+    import pandas as pd
+    import pyarrow as pa
+    df = df.copy()
+    df['date_time'] = pd.to_datetime(df['date_time'], errors='coerce')
+    fields = []
+    for column in df.columns:
+        column_type = pa.type_for_alias(parquet_column_types.get(column, 'string'))
+        if column_type == pa.float64():
+            df[column] = pd.to_numeric(df[column], errors='coerce')
+        elif column_type == pa.string():
+            df[column] = df[column].astype(object).where(df[column].notnull(), None)
+        fields.append(pa.field(column, column_type))
+    return pa.Table.from_pandas(df, schema=pa.schema(fields), preserve_index=False)
+
+
+#product_list fields summed over the products of a hit, category has the categories of all its products and the other
+#fields are taken from its first product
+product_list_sum_cols = ['number_of_items', 'total_revenue']
+#split column with the revenue of every product of a hit, in the order of its categories, so the revenue rollup can
+#share the revenue of a hit by category
+product_revenue_column = 'product_revenue'
+
+
+def parse_product_list(product_list, profile=None):
+    """
+    Parses product_list into one row per product. Products are separated by ',' and their attributes by ';' in the
+    order of product_list_split_cols (category, product name, quantity, price, events), a trailing merchandising eVar
+    field is dropped and missing fields are empty. The number of items and revenue are numeric, hits with a value
+    which is not are counted as invalid in the DQ profile.
+    Everything is done with vectorized string operations, there is no loop over the hits, and hits without products
+    are skipped.
+    Arguments:
+        product_list: pandas series
+        profile: DQProfile
+    Returns:
+        products_df: pandas dataframe, indexed by the position of the hit in product_list
+    """
+    import numpy as np
+    import pandas as pd
+    hit_positions = np.flatnonzero(product_list.notnull().to_numpy())
+    products = pd.Series(product_list.to_numpy()[hit_positions], index=hit_positions, dtype=str).str.split(',').explode()
+    products_df = products.str.split(';', n=len(product_list_split_cols), expand=True)
+    products_df = products_df.reindex(columns=range(len(product_list_split_cols)))
+    products_df.columns = product_list_split_cols
+    for column in product_list_sum_cols:
+        if column in products_df.columns:
+            values = pd.to_numeric(products_df[column], errors='coerce')
+            if profile is not None:
+                invalid = (products_df[column].notnull() & (products_df[column] != '') & values.isnull()).to_numpy()
+                profile.count_invalid(column, products_df.index[invalid].nunique())
+            products_df[column] = values
+    return products_df
+
+
+def transform_chunk(hit_data_df, profile=None):
+    """
+    Subsets a chunk of hits to the columns for analysis and unpacks product_list.
+    Hits keep one row each, the number of items and the revenue are summed over all their products. The categories of
+    all products are joined with ',' like in product_list, and product_revenue has the revenue of each of them.
+    Arguments:
+        hit_data_df: pandas dataframe
+        profile: DQProfile
+    Returns:
+        hit_data_df_subset: pandas dataframe
+    """
+    import pandas as pd
+    hit_data_df_subset = hit_data_df[cols_for_analysis].copy()
+    products_df = parse_product_list(hit_data_df_subset['product_list'], profile)
+    first_products = products_df[~products_df.index.duplicated()]
+    hit_positions = pd.RangeIndex(len(hit_data_df_subset))
+    for column in product_list_split_cols:
+        if column in product_list_sum_cols:
+            #min_count keeps hits without any value missing, as purchases are told apart by their revenue
+            values = products_df[column].groupby(level=0, sort=False).sum(min_count=1)
+        elif column == 'category':
+            values = join_products(products_df[column].fillna(''))
+        else:
+            values = first_products[column]
+        hit_data_df_subset[column] = values.reindex(hit_positions).to_numpy()
+    if 'category' in product_list_split_cols and 'total_revenue' in product_list_split_cols:
+        revenue = products_df['total_revenue']
+        values = join_products(revenue.astype(str).where(revenue.notnull(), ''))
+        hit_data_df_subset[product_revenue_column] = values.reindex(hit_positions).to_numpy()
+    return hit_data_df_subset
+
+
+def join_products(values):
+    """
+    Joins a field of the products of every hit with ',', in the order of product_list. Only the hits with several
+    products are grouped, the others keep the value of their only product.
+    Arguments:
+        values: pandas series of strings, indexed by the position of the hit like parse_product_list
+    Returns:
+        values: pandas series of strings, one per hit with products
+    """
+    import pandas as pd
+    several = values.index.duplicated(keep=False)
+    return pd.concat([values[~several], values[several].groupby(level=0, sort=False).agg(','.join)])
+
+
+def sort_hits(hit_data_df):
+    """
+    Sorts a chunk of hits by ip and date_time, keeping ties in file order, so every split is made of sorted runs which
+    process_parsed_output merges instead of sorting all hits. IPv4 addresses are ordered by their packed value as the
+    processor packs them, other addresses as strings, date_time strings of the landing format order like the times.
+    Arguments:
+        hit_data_df: pandas dataframe
+    Returns:
+        hit_data_df: pandas dataframe
+    """
+    import numpy as np
+    import pandas as pd
+    ip_codes, ip_uniques = pd.factorize(hit_data_df['ip'])
+    octets = pd.Series(np.asarray(ip_uniques, dtype=object)).str.split('.', expand=True)
+    try:
+        if octets.shape[1] != 4:
+            raise ValueError('not IPv4')
+        octets = octets.astype('uint32').to_numpy()
+        ip_key = octets[:, 0] << 24 | octets[:, 1] << 16 | octets[:, 2] << 8 | octets[:, 3]
+    except (ValueError, TypeError):
+        ip_key = np.argsort(np.argsort(np.asarray(ip_uniques, dtype=str), kind='stable'))
+    #missing ip and date_time go last
+    ip_key = np.append(ip_key.astype('uint64'), np.uint64(2 ** 32 - 1))[ip_codes]
+    date_codes, date_uniques = pd.factorize(hit_data_df['date_time'], sort=True)
+    date_codes[date_codes < 0] = len(date_uniques)
+    order = np.argsort(ip_key << np.uint64(32) | date_codes.astype('uint64'), kind='stable')
+    return hit_data_df.iloc[order].reset_index(drop=True)
+
+
+def write_sized_splits(chunks, split_prefix, empty_split, writers, upload_pool):
+    """
+    Writes the chunks to consecutive splits, a new split is started once split_target_rows or (approximately)
+    split_target_bytes is reached. Closed splits keep uploading on the pool while the next one is filled.
+    Arguments:
+        chunks: iterable of pandas dataframes
+        split_prefix: string
+        empty_split: pandas dataframe, used to write the header when there are no data rows
+        writers: list, the split writers are appended to it as they are created
+        upload_pool: UploadPool
+    """
+    writer = None
+    for chunk in chunks:
+        start = 0
+        while start < len(chunk):
+            if writer is None:
+                writer = SplitWriter(split_prefix + '_' + str(len(writers) + 1) + split_extension, upload_pool)
+                writers.append(writer)
+            rows = len(chunk) - start
+            if split_target_rows > 0:
+                rows = min(rows, split_target_rows - writer.rows)
+            writer.write_frame(chunk.iloc[start:start + rows])
+            start += rows
+            if writer.is_full():
+                writer.close()
+                writer = None
+    if not writers:
+        writer = SplitWriter(split_prefix + '_1' + split_extension, upload_pool)
+        writers.append(writer)
+        writer.write_frame(empty_split)
+    if writer is not None:
+        writer.close()
+
+
+def partition_count(landing_size, rows_read, bytes_read):
+    """
+    Gives the number of hash partitions of a landing file, split_partitions or a multiple of it so the splits are about
+    split_target_rows and split_target_bytes. The rows of the file are estimated from the rows and landing bytes read
+    for its first chunk, and its split bytes from its landing size, which is larger as only the columns for analysis
+    are kept. As the count is a multiple of split_partitions, the hits of a partition p are all in partition
+    p % split_partitions of a file with split_partitions partitions, whatever the size of the file.
+    Arguments:
+        landing_size: int, bytes of the landing object
+        rows_read: int, rows of the first chunk
+        bytes_read: int, landing bytes read for the first chunk
+    Returns:
+        partitions: int
+    """
+    splits = 1
+    if split_target_bytes > 0:
+        splits = max(splits, math.ceil(landing_size / split_target_bytes))
+    if split_target_rows > 0 and bytes_read > 0:
+        splits = max(splits, math.ceil(landing_size * rows_read / bytes_read / split_target_rows))
+    return split_partitions * math.ceil(splits / split_partitions)
+
+
+def write_partitioned_splits(chunks, split_prefix, empty_split, writers, upload_pool, landing_size=0, landing_body=None):
+    """
+    Writes the chunks to hash partitioned splits by a stable hash of ip, so all hits of a visitor land in the same split
+    and every split can be processed on its own. There are split_partitions splits, or a multiple of it for a landing
+    file larger than split_partitions splits of the split targets, from partition_count once the first chunk is read.
+    The partitions of a chunk are serialized in parallel on a pool of upload_concurrency threads.
+    Arguments:
+        chunks: iterable of pandas dataframes
+        split_prefix: string
+        empty_split: pandas dataframe, used to write the header of partitions without data rows
+        writers: list, the split writers are appended to it as they are created
+        upload_pool: UploadPool
+        landing_size: int, bytes of the landing object
+        landing_body: CountingStream, counts the landing bytes read
+    """
+    import pandas as pd
+    chunks = iter(chunks)
+    first_chunk = next(chunks, None)
+    if first_chunk is not None:
+        chunks = itertools.chain([first_chunk], chunks)
+        partitions = partition_count(landing_size, len(first_chunk), landing_body.bytes_read if landing_body is not None else 0)
+    else:
+        partitions = split_partitions
+    writers.extend(SplitWriter(split_prefix + '_' + str(i + 1) + split_extension, upload_pool) for i in range(partitions))
+    with ThreadPoolExecutor(max_workers=upload_concurrency) as serialize_pool:
+        for chunk in chunks:
+            partition = pd.util.hash_pandas_object(chunk['ip'], index=False).values % partitions
+            list(serialize_pool.map(lambda group: writers[group[0]].write_frame(group[1]), chunk.groupby(partition)))
+        for writer in writers:
+            if writer.rows == 0:
+                writer.write_frame(empty_split)
+        list(serialize_pool.map(SplitWriter.close, writers))
+
+
+def transform_split_files(bucket_name, file_name, msg, hit_data_stream, actual_columns, profile=None, landing_size=0, landing_body=None):
     """
     Unpacks some of the column as per required for analysis.
     Splits files into smaller files.
-    Creates and uploads indicator file for next process.
+    The file body is read from the stream already opened by the DQ checks, so the object is fetched only once.
+    It is read in chunks of read_chunk_rows, memory stays bounded by the chunk and upload part size, not the file size.
+    Every chunk is sorted by ip and date_time, so splits are written as sorted runs for process_parsed_output to merge.
+    With split_partitions set, rows are hash partitioned by ip, in more partitions for a large landing file, otherwise
+    they are split by size.
+    Splits are uploaded by upload_concurrency threads, they are returned only once every upload is confirmed and
+    SplitUploadError lists each split that failed. When the split fails, the splits already uploaded are deleted.
+    Rows, bytes read from the stream and bytes written to the splits are recorded in the split stage metrics.
+    With a DQ profile, the chunks are profiled as they are read, and the malformed rows and invalid values are added to
+    the split stage metrics.
     Arguments:
         bucket_name: string
         file_name: string
         msg: string
+        hit_data_stream: buffered landing object stream positioned after the header
+        actual_columns: list
+        profile: DQProfile
+        landing_size: int, bytes of the landing object
+        landing_body: CountingStream, counts the landing bytes read
     Returns:
         msg: string
+        splits: list, keys of the uploaded splits
     """
+    import pandas as pd
+    writers = []
+    upload_pool = UploadPool(upload_concurrency)
     try:
         target_file_name = file_name.split('.')[0]
-        s3_resource = boto3.resource('s3')
-        hit_data_df = wr.s3.read_csv(path=['s3://' + bucket_name + '/' + file_name], sep='\t')
-        hit_data_df_subset = hit_data_df[cols_for_analysis]
-        hit_data_df_subset[product_list_split_cols] = hit_data_df_subset['product_list'].str.split(';', expand=True)
-        file_num = 1
         today = date.today()
-        for chunk in np.array_split(hit_data_df_subset, 5):
-            csv_buffer = StringIO()
-            chunk.to_csv(csv_buffer, sep = '\t', index =False)
-            s3_resource.Object(target_bucket, str(today) + '/' + target_file_name + '_' + str(file_num) + '.tsv').put(Body=csv_buffer.getvalue())
-            file_num +=1
-        result_dict = {}
-        result_dict['Result'] = 'Success'
-        resultfileName = str(today) + '/' + 'Success' + '.json'
-        uploadByteStream = bytes(json.dumps(result_dict).encode('UTF-8'))
-        s3_client.put_object(Bucket=target_bucket, Key=resultfileName, Body=uploadByteStream)
-        msg += '\nSuccess! File has been split in ' + str(file_num - 1) + ' smaller files. Upload is complete.'
-        return msg
+        split_prefix = str(today) + '/' + target_file_name
+        with metrics.stage('split') as stage:
+            #the landing stream counts the bytes it pulls, streams of other callers may not
+            bytes_read_before = getattr(hit_data_stream.raw, 'bytes_read', None)
+            #only the columns for analysis are parsed, as text, they are typed when the splits are written
+            hit_data_chunks = pd.read_csv(hit_data_stream, sep='\t', header=None, names=actual_columns, usecols=cols_for_analysis,
+                                          dtype={column: str for column in cols_for_analysis}, chunksize=read_chunk_rows)
+            hit_data_chunks = stage.count_rows_in(hit_data_chunks)
+            if profile is not None:
+                hit_data_chunks = profile.profile_chunks(hit_data_chunks)
+            chunks = (sort_hits(transform_chunk(hit_data_df, profile)) for hit_data_df in hit_data_chunks)
+            empty_split = transform_chunk(pd.DataFrame(columns=actual_columns))
+            if split_partitions > 0:
+                write_partitioned_splits(chunks, split_prefix, empty_split, writers, upload_pool, landing_size, landing_body)
+            else:
+                write_sized_splits(chunks, split_prefix, empty_split, writers, upload_pool)
+            failures = {writer.key: writer.wait() for writer in writers}
+            failures = {key: error for key, error in failures.items() if error is not None}
+            stage.rows_out = sum(writer.rows for writer in writers)
+            stage.bytes_written = sum(writer.bytes_written for writer in writers)
+            if bytes_read_before is not None:
+                stage.bytes_read = hit_data_stream.raw.bytes_read - bytes_read_before
+            if profile is not None:
+                stage.counters['MalformedRows'] = profile.malformed_rows(actual_columns)[1]
+                stage.counters['InvalidValues'] = sum(profile.invalid_values.values())
+        if failures:
+            raise SplitUploadError(failures)
+        msg += '\nSuccess! File has been split in ' + str(len(writers)) + ' smaller files. Upload is complete.'
+        msg += '\nBytes per split: ' + ', '.join(str(writer.bytes_written) for writer in writers) + '.'
+        return msg, [writer.key for writer in writers]
     except Exception as e:
+        for writer in writers:
+            writer.abort()
+        #the uploads still in flight land before the splits already uploaded are deleted
+        upload_pool.shutdown()
+        try:
+            delete_splits([writer.key for writer in writers])
+        except Exception:
+            #already logged, the split error is the one raised
+            pass
         logger.error ('Failed! There has been an issue with splitting of file. The error is ' + str(e))
         raise e
+    finally:
+        upload_pool.shutdown()
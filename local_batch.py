@@ -0,0 +1,112 @@
+"""
+Runs the pipeline locally over a folder of hit files, for backfills that don't fit in the lambda time limit.
+Every file goes through DQ and is hash partitioned by ip into splits, then the splits of each partition are attributed
+in parallel on a process pool and the partial revenue is summed into the final output. Storage is the local filesystem,
+under work_dir, and notifications are logged.
+    python local_batch.py --input-dir hits/ --work-dir work/ --workers 8
+"""
+import argparse
+import json
+import logging
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+#same configuration as the lambda functions get from the CFT
+default_environment = {
+    'SQSURL': 'local',
+    'SNSTopicArn': 'local',
+    'target_bucket': 'intermediate',
+    'final_bucket': 'processed',
+    'final_output_file_name': '_SearchKeywordPerformance.tsv',
+    'file_type': 'text/tab-separated-values',
+    'cols_for_analysis': '["date_time", "ip", "event_list", "geo_country", "product_list", "referrer"]',
+    'expected_columns': '["hit_time_gmt", "date_time", "user_agent", "ip", "event_list", "geo_city", "geo_region", "geo_country" , "pagename", "page_url", "product_list", "referrer"]',
+    'product_list_split_cols': '["category", "product_name", "number_of_items", "total_revenue", "custom_event"]',
+    'intermediate_format': 'parquet',
+}
+
+
+def configure(input_dir, work_dir, workers):
+    """
+    Sets the environment read by the pipeline modules, it has to run before they are imported.
+    Arguments:
+        input_dir: string
+        work_dir: string
+        workers: int
+    """
+    for name, value in default_environment.items():
+        os.environ.setdefault(name, value)
+    os.environ.setdefault('split_partitions', str(workers))
+    os.environ['storage_backend'] = 'local'
+    os.environ['local_storage_root'] = os.path.abspath(work_dir)
+    os.environ['local_bucket_dirs'] = json.dumps({'landing': os.path.abspath(input_dir)})
+
+
+def run_dq(file_name):
+    """
+    Runs DQ and split of one landing file through the DQ lambda handler.
+    Arguments:
+        file_name: string
+    """
+    import dq_check_split_file
+    event = {'Records': [{'s3': {'bucket': {'name': 'landing'}, 'object': {'key': file_name}}}]}
+    dq_check_split_file.lambda_handler(event, None)
+
+
+def run_partition(split_files):
+    """
+    Calculates the partial revenue of the splits of one partition.
+    Arguments:
+        split_files: list
+    Returns:
+        final_df: rollup dataframe, or the summary dataframe in top_k mode
+    """
+    import process_parsed_output
+    df = process_parsed_output.read_files_s3(os.environ['target_bucket'], split_files)
+    return process_parsed_output.revenue_calc(df)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run DQ, split and revenue attribution over a folder of hit files.')
+    parser.add_argument('--input-dir', required=True)
+    parser.add_argument('--work-dir', required=True)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(processName)s %(message)s')
+    configure(args.input_dir, args.work_dir, args.workers)
+
+    import process_parsed_output
+    file_names = sorted(i for i in os.listdir(args.input_dir) if os.path.isfile(os.path.join(args.input_dir, i)))
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        list(pool.map(run_dq, file_names))
+        #splits of this run, grouped by partition number, a large file has a multiple of split_partitions partitions and
+        #its partition p holds hits of partition p % split_partitions of the other files
+        split_prefix = str(date.today()) + '/'
+        split_partitions = int(os.environ['split_partitions'])
+        target_file_names = set(i.split('.')[0] for i in file_names)
+        partitions = defaultdict(list)
+        for key in process_parsed_output.storage.list_objects(os.environ['target_bucket'], split_prefix):
+            if not process_parsed_output.is_split_file(key):
+                continue
+            split_name, split_number = key[len(split_prefix):].split('.')[0].rsplit('_', 1)
+            if split_name in target_file_names:
+                partitions[(int(split_number) - 1) % split_partitions].append(key)
+        logger.info ('Processing ' + str(len(partitions)) + ' partitions of ' + str(len(file_names)) + ' files.')
+        partials = list(pool.map(run_partition, partitions.values()))
+    if process_parsed_output.aggregation_mode == 'top_k':
+        final_df = process_parsed_output.merge_revenue_summaries(partials)
+    else:
+        final_df = process_parsed_output.merge_rollups(partials)
+    process_parsed_output.write_to_s3(final_df, str(date.today()))
+    process_parsed_output.notifications.add('Local batch run of ' + str(len(file_names)) + ' files in ' + str(len(partitions)) +
+                                            ' partitions, final file has been written to ' + args.work_dir + '.')
+    process_parsed_output.send_sns_update()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+#cloudwatch namespace of the metrics, every metric line has the function and stage as dimensions
+metrics_namespace = os.environ.get('metrics_namespace', 'HitLevelData')
+
+#metric name, unit and the stage attribute it is read from
+stage_metrics = [
+    ('WallTime', 'Milliseconds', 'wall_time_ms'),
+    ('RowsIn', 'Count', 'rows_in'),
+    ('RowsOut', 'Count', 'rows_out'),
+    ('BytesRead', 'Bytes', 'bytes_read'),
+    ('BytesWritten', 'Bytes', 'bytes_written'),
+    ('PeakRSS', 'Bytes', 'peak_rss_bytes'),
+]
+
+
+def read_peak_rss():
+    """
+    Gives the peak resident set size of the process, from /proc when it is there, otherwise from getrusage.
+    Returns:
+        int, bytes
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    #ru_maxrss is in kilobytes on linux and in bytes on mac
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident set size of the process so the next reading covers only what follows. Where the kernel
+    does not allow it, the reading stays the peak of the whole process so far.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+class Stage:
+    """
+    Measurements of one named stage of an invocation. Wall time and peak RSS are taken by Metrics.stage, rows and
+    bytes are set by the code running the stage and left out of the metric line when they are not known. Counters are
+    any other counts of the stage, by metric name.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.wall_time_ms = None
+        self.rows_in = None
+        self.rows_out = None
+        self.bytes_read = None
+        self.bytes_written = None
+        self.peak_rss_bytes = None
+        self.counters = {}
+
+    def count_rows_in(self, chunks):
+        """
+        Passes the chunks through, adding their rows to rows_in.
+        Arguments:
+            chunks: iterable of pandas dataframes
+        """
+        self.rows_in = self.rows_in or 0
+        for chunk in chunks:
+            self.rows_in += len(chunk)
+            yield chunk
+
+
+class Metrics:
+    """
+    Per stage metrics of a lambda function. start is called at the beginning of each invocation, stages are timed with
+    the stage context manager and emit prints one CloudWatch embedded metric format json line per stage to stdout,
+    plus one line for the whole invocation.
+    """
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.request_id = None
+        self.stages = []
+        self.started = None
+        self.depth = 0
+
+    def start(self, context=None):
+        """
+        Clears the stages of the previous invocation.
+        Arguments:
+            context: lambda context, its request id is added to the metric lines
+        """
+        self.request_id = getattr(context, 'aws_request_id', None)
+        self.stages = []
+        self.depth = 0
+        reset_peak_rss()
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the enclosed block as a named stage and takes the peak RSS reached in it. Nested stages are allowed,
+        the peak is reset only when an outermost stage starts.
+        Arguments:
+            name: string
+        Returns:
+            stage: Stage
+        """
+        stage = Stage(name)
+        self.stages.append(stage)
+        if self.depth == 0:
+            reset_peak_rss()
+        self.depth += 1
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.wall_time_ms = (time.perf_counter() - start) * 1000
+            stage.peak_rss_bytes = read_peak_rss()
+            self.depth -= 1
+
+    def metric_line(self, stage, status):
+        """
+        Renders a stage as an embedded metric format json object.
+        Arguments:
+            stage: Stage
+            status: string
+        Returns:
+            Dict
+        """
+        metrics = [(name, unit, getattr(stage, attribute)) for name, unit, attribute in stage_metrics]
+        metrics = [i for i in metrics if i[2] is not None] + [(name, 'Count', value) for name, value in stage.counters.items()]
+        line = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': metrics_namespace,
+                    'Dimensions': [['Function', 'Stage']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, unit, value in metrics]
+                }]
+            },
+            'Function': self.function_name,
+            'Stage': stage.name,
+            'Status': status,
+            'RequestId': self.request_id
+        }
+        line.update({name: value for name, unit, value in metrics})
+        return line
+
+    def emit(self, status='Succeeded'):
+        """
+        Prints the metric lines of the invocation to stdout, where lambda hands them to CloudWatch.
+        Metrics are best effort, an issue here is logged and never fails the invocation.
+        Arguments:
+            status: string, Succeeded or Failed
+        """
+        try:
+            invocation = Stage('invocation')
+            if self.started is not None:
+                invocation.wall_time_ms = (time.perf_counter() - self.started) * 1000
+            #stages reset the peak, so the invocation peak is the largest seen by any of them
+            invocation.peak_rss_bytes = max([read_peak_rss()] + [i.peak_rss_bytes for i in self.stages if i.peak_rss_bytes])
+            for stage in self.stages + [invocation]:
+                print(json.dumps(self.metric_line(stage, status)), file=sys.stdout, flush=True)
+        except Exception as e:
+            logger.error ('Failed! Emitting metrics has issue ' + str(e))
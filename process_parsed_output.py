@@ -1,102 +1,363 @@
 import json
-import boto3
 import logging
 import os
-import awswrangler as wr
-from urllib.parse import urlparse
+from urllib.parse import urlparse, parse_qsl
 import re
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 from datetime import date
+from functools import lru_cache
+from backends import get_storage, get_messaging, NotificationBuffer
+from metrics import Metrics
+from search_engines import default_search_engine_rules
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-#boto clients for aws services
+#storage and messaging backends, s3, sqs and sns unless run locally
 try:
-    sqs_client = boto3.client('sqs')
-    s3_resource = boto3.resource('s3')
-    sns_client = boto3.client('sns')
+    storage = get_storage()
+    messaging = get_messaging()
 except Exception as e:
     logger.error ('Failed! Issue in making boto client connections with AWS resources ' + str(e))
     raise e
 
+#dimensions of the revenue rollup of exact mode, date is the day of the hit, the search columns come from the referrer
+#and the other columns are read from the splits. The revenue of a hit is shared by the categories of its products
+default_rollup_dimensions = ['date', 'search_engine_domain', 'search_keyword', 'geo_country', 'category']
+#keys of the final output, it is summed from the rollup in exact mode
+output_keys = ['search_engine_domain', 'search_keyword']
+
+#weight of every touch of a conversion path per attribution model, from the rank of the touch in the path, the number of
+#touches of the path and the hours from the touch to the last touch, the weights of a purchase are scaled to add up to 1
+attribution_weights = {
+    'last': lambda rank, touches, hours: (rank == touches - 1).astype('float64'),
+    'first': lambda rank, touches, hours: (rank == 0).astype('float64'),
+    'linear': lambda rank, touches, hours: np.ones(len(rank)),
+    'time_decay': lambda rank, touches, hours: np.exp2(-hours / time_decay_half_life_hours),
+}
+
 #environment variables in lambda passed from CFT
 try:
-    queue_url = os.environ['SQSURL']
     final_bucket_name = os.environ['final_bucket']
     final_output_file_name = os.environ['final_output_file_name']
     snstopicarn = os.environ['SNSTopicArn']
+    referrer_cache_size = int(os.environ.get('referrer_cache_size', 0))
+    intermediate_format = os.environ.get('intermediate_format', 'tsv')
+    checkpoint_prefix = os.environ.get('checkpoint_prefix', '')
+    processing_chunk_rows = int(os.environ.get('processing_chunk_rows', 0))
+    search_engine_rules = json.loads(os.environ.get('search_engine_rules', json.dumps(default_search_engine_rules)))
+    aggregation_mode = os.environ.get('aggregation_mode', 'exact')
+    top_k = int(os.environ.get('top_k', 100))
+    sketch_capacity = max(int(os.environ.get('sketch_capacity', 10000)), top_k)
+    #last search attribution is always calculated, it is the revenue column of the output
+    attribution_models = ['last'] + [i for i in json.loads(os.environ.get('attribution_models', '["last"]')) if i != 'last']
+    for model in attribution_models:
+        if model not in attribution_weights:
+            raise ValueError('attribution_models should be among ' + ', '.join(attribution_weights) + ', got ' + model)
+    if len(attribution_models) > 1 and aggregation_mode != 'exact':
+        raise ValueError('attribution_models other than last need aggregation_mode exact')
+    if len(attribution_models) > 1 and processing_chunk_rows > 0:
+        raise ValueError('attribution_models other than last need all the searches of a visitor, processing_chunk_rows should be 0')
+    time_decay_half_life_hours = float(os.environ.get('time_decay_half_life_hours', 168))
+    rollup_dimensions = json.loads(os.environ.get('rollup_dimensions', json.dumps(default_rollup_dimensions)))
+    for column in output_keys:
+        if aggregation_mode == 'exact' and column not in rollup_dimensions:
+            raise ValueError('rollup_dimensions should have ' + ', '.join(output_keys) + ', the final output is summed from them, got ' + ', '.join(rollup_dimensions))
+    rollup_file_name = os.environ.get('rollup_file_name', '_RevenueRollup.parquet')
+    output_compression = os.environ.get('output_compression', 'none')
+    if output_compression not in ('none', 'gzip'):
+        raise ValueError('output_compression should be none or gzip, got ' + output_compression)
 except Exception as e:
     logger.error ('Failed! Issue with reading environment variables in Revenue Calcualtion Lambda function ' + str(e))
     raise e
 
+search_state_columns = ['search_engine_domain', 'search_keyword', 'date_time']
+#final output file name, it ends with .gz when the output is compressed
+final_file_name = final_output_file_name + ('.gz' if output_compression == 'gzip' else '')
+#columns of the split files the rollup is grouped by, there is no rollup in top_k mode
+rollup_hit_columns = [i for i in rollup_dimensions if i not in ['date'] + output_keys] if aggregation_mode == 'exact' else []
+#revenue column of every attribution model, revenue for last search attribution
+attribution_columns = ['revenue' if i == 'last' else 'revenue_' + i for i in attribution_models]
+rollup_measures = attribution_columns + ['orders', 'search_referrals']
+#revenue of every product of a hit, in the order of its categories, read when the rollup is grouped by category
+product_revenue_columns = ['product_revenue'] if 'category' in rollup_hit_columns else []
+#only these columns of the split files are needed for the revenue calculation
+processing_columns = ['date_time', 'ip', 'event_list', 'referrer', 'total_revenue'] + rollup_hit_columns + product_revenue_columns
+#purchases aggregated exactly at a time before they are merged into the summary in top_k mode
+summary_chunk_rows = 100000
+#types the tsv split columns are read with, compact_hits packs them further
+split_read_dtypes = {'date_time': str, 'ip': 'category', 'event_list': str, 'referrer': 'category', 'total_revenue': 'float64',
+                     **{column: 'category' for column in rollup_hit_columns}, **{column: str for column in product_revenue_columns}}
+#marker written in the partials folder of a landing file once all its splits have written their partial
+partials_complete_name = '_Complete'
+metrics = Metrics('process_parsed_output')
+notifications = NotificationBuffer(messaging, snstopicarn)
+
 
 def lambda_handler(event, context):
     """
     This acts as the main driver function, processing files to calculate best search keyword and search engine domain based on revenue.
     It accepts events and context as argument from the AWS services calling the lambda function.
+    Every message of the sqs batch is processed on its own, the ones that failed are returned in batchItemFailures so
+    only they are retried by the event source mapping (ReportBatchItemFailures). The event source mapping deletes the
+    others, a message is never deleted before its partial is merged, so a failed merge is retried. The summaries of the files whose final
+    output was written and the failed messages are sent as one notification at the end of the invocation.
+    Stage metrics are emitted at the end of every invocation.
     Arguments:
         event: Dict
         context: Dict
     Returns:
         Dict
     """
+    metrics.start(context)
+    status = 'Failed'
+    try:
+        batch_item_failures = []
+        for record in event['Records']:
+            try:
+                process_message(record)
+            except Exception as e:
+                logger.error ('Failed! Message ' + record['messageId'] + ' has issue ' + str(e))
+                notifications.add('Failed! Processing sqs message ' + record['messageId'] + ' has issue ' + str(e))
+                batch_item_failures.append({'itemIdentifier': record['messageId']})
+        status = 'PartiallyFailed' if batch_item_failures else 'Succeeded'
+        return {
+            'statusCode': 200,
+            'body': json.dumps(str(len(event['Records']) - len(batch_item_failures)) + ' of ' + str(len(event['Records'])) +
+                               ' messages processed, final output is uploaded to s3 once all splits are done.'),
+            'batchItemFailures': batch_item_failures
+        }
+    except Exception as e:
+        logger.error ('Failed! Process parsed output Lambda handler has issue ' + str(e))
+        raise e
+    finally:
+        with metrics.stage('notify'):
+            send_sns_update()
+        metrics.emit(status)
+
+
+def process_message(record):
+    """
+    Processes one sqs message.
+    A message carrying split_count is for one hash partitioned split, its partial revenue is written and the partials are
+    merged into the final output once all splits are done. Otherwise every split of the prefix is processed together.
+    With checkpoint_prefix set, attribution is seeded from the search state of the latest day before the prefix, and the
+    state after the prefix is saved as the checkpoint of its day, so processing a day again is seeded the same way.
+    A hash partitioned split is seeded from the shard of its hash partition and writes the searches of its hits as a
+    delta, the deltas are folded into the shards of the day by merge_partials.
+    Once the final output is written, the summary of the file, its DQ report from the message body and the output, is
+    buffered for the notification.
+    Arguments:
+        record: Dict, sqs record of the event
+    """
     try:
-        receipt_handle = event['Records'][0]['receiptHandle']
-        message_attributes = event['Records'][0]['messageAttributes']
+        message_attributes = record['messageAttributes']
         bucket_name = message_attributes['bucket_name']['stringValue']
         file_path = message_attributes['file_name']['stringValue']
         prefix = file_path.rsplit('/', 1)[0]
         logger.info ('Message has been received.')
         logger.info ('Message was received from bucket name is  ' +bucket_name)
         logger.info ('File prefix  is ' + prefix)
-        df = read_files_s3(bucket_name, prefix)
-        df = revenue_calc(df)
-        write_to_s3(df, prefix)
-        delete_sqs_msg(receipt_handle)
-        send_sns_update()
-        return {
-            'statusCode': 200,
-            'body': json.dumps('Successfully uploaded final output to s3.')
-        }
+        partitioned = 'split_count' in message_attributes
+        if partitioned:
+            split_count = int(message_attributes['split_count']['stringValue'])
+            #messages published before split runs and partitions were named belong to run 0, with a partition per split
+            split_run = message_attributes.get('split_run', {}).get('stringValue', '0')
+            split_partitions = int(message_attributes.get('split_partitions', {}).get('stringValue', split_count))
+            state_name = search_state_name(file_path, split_partitions)
+            search_state = read_search_state(previous_search_state_path(prefix, state_name))
+            df, searches = process_hits(bucket_name, file_path, search_state)
+            #the delta is written before the partial, so every delta of a split run is there once its partials are
+            with metrics.stage('write_search_state') as stage:
+                write_search_state(searches, search_delta_path(file_path, split_run, state_name))
+                stage.rows_out = len(searches)
+            with metrics.stage('write') as stage:
+                write_partial_to_s3(df, file_path, split_run)
+                stage.rows_in = len(df)
+        else:
+            state_name = search_state_name(file_path)
+            search_state = read_search_state(previous_search_state_path(prefix, state_name))
+            df, searches = process_hits(bucket_name, prefix + '/', search_state)
+            with metrics.stage('write') as stage:
+                write_to_s3(df, prefix)
+                stage.rows_in = len(df)
+            with metrics.stage('write_search_state') as stage:
+                search_state = merge_search_state(searches, search_state)
+                write_search_state(search_state, search_state_path(prefix, state_name))
+                stage.rows_out = len(search_state)
+        if not partitioned or merge_partials(prefix, file_path, split_count, split_run):
+            msg = record.get('body', '') + '\nFinal file has been uploaded to s3://' + final_bucket_name + '/' + prefix + '/' + \
+                str(date.today()) + final_file_name + '.'
+            if aggregation_mode == 'exact':
+                msg += '\nRevenue rollup has been uploaded to s3://' + final_bucket_name + '/' + prefix + '/' + str(date.today()) + rollup_file_name + '.'
+            notifications.add(msg)
     except Exception as e:
-        logger.error ('Failed! Process parsed output Lambda handler has issue ' + str(e))
+        logger.error ('Failed! Processing message has issue ' + str(e))
+        raise e
+
+
+class ChunkingError(Exception):
+    """
+    Raised when the hits can't be processed chunk by chunk with the same result as in memory, e.g. because the hits of a
+    visitor are not read in time order.
+    """
+
+
+def process_hits(bucket_name, path, search_state):
+    """
+    Calculates the revenue of the hits of a split or prefix, seeded by the search state, and gives the last search of
+    every visitor of the hits.
+    With processing_chunk_rows set the hits are processed chunk by chunk by revenue_calc_chunked, falling back to
+    reading them all in memory when that would not give the same result, with a warning and the ChunkingFallbacks metric.
+    Arguments:
+        bucket_name: string
+        path: string, a split file or a prefix ending with /
+        search_state: pandas dataframe indexed by ip
+    Returns:
+        final_df: rollup dataframe, or the summary dataframe in top_k mode
+        searches: pandas dataframe indexed by ip, last search of every visitor of the hits
+    """
+    try:
+        if processing_chunk_rows > 0:
+            try:
+                return revenue_calc_chunked(bucket_name, path, search_state)
+            except ChunkingError as e:
+                logger.warning ('Hits are read in memory, chunked processing is not possible. ' + str(e))
+                with metrics.stage('chunking_fallback') as stage:
+                    stage.counters['ChunkingFallbacks'] = 1
+        hits_df = read_files_s3(bucket_name, path)
+        final_df = revenue_calc(hits_df, search_state)
+        with metrics.stage('latest_searches') as stage:
+            searches = latest_searches(hits_df)
+            stage.rows_out = len(searches)
+        return final_df, searches
+    except Exception as e:
+        logger.error ('Failed! Processing hits has issue ' + str(e))
+        raise e
+
+
+def revenue_calc_chunked(bucket_name, path, search_state):
+    """
+    Calculates the same revenue as revenue_calc over the hits of a split or prefix, reading them processing_chunk_rows at
+    a time so memory depends on the number of visitors and keywords, not of hits.
+    The split files are read in order, and as dq_check_split_file writes them in the order of the landing file the hits
+    of a visitor come in time order across chunks. The last search of every visitor so far is carried from chunk to chunk
+    and attributes the purchases with no earlier search in their own chunk, the rollups of the chunks are added up.
+    The last time a search or purchase of every visitor was seen is kept too, a chunk holding an earlier one raises
+    ChunkingError, as does a search or purchase without date_time, so the result is never different from revenue_calc.
+    Visitors are keyed by their ip as dotted strings, so chunks of IPv4 and other ip can follow each other, and rollups
+    are summed in integer units by sum_rollup, so their sum doesn't depend on the chunks. In top_k mode the summaries of
+    the chunks are merged, their bounds hold but can be wider than in memory.
+    Arguments:
+        bucket_name: string
+        path: string, a split file or a prefix ending with /
+        search_state: pandas dataframe indexed by ip, last search of each visitor from earlier runs
+    Returns:
+        final_df: rollup dataframe, or the summary dataframe in top_k mode
+        searches: pandas dataframe indexed by ip, last search of every visitor of the hits
+    """
+    try:
+        logger.info ('Processing hits in chunks of ' + str(processing_chunk_rows) + ' rows.')
+        with metrics.stage('chunked_revenue_calc') as stage:
+            carried_search = pd.DataFrame(columns=search_state_columns, index=pd.Index([], dtype=object, name='ip'))
+            last_seen = pd.Series([], dtype='datetime64[ns]', index=pd.Index([], dtype=object, name='ip'))
+            revenue = None
+            stage.rows_in = 0
+            stage.counters['Chunks'] = 0
+            stage.counters['UnknownEngineReferrers'] = 0
+            for chunk in read_chunks_s3(bucket_name, path):
+                referrer_df = parse_referrers(chunk['referrer'])
+                for column in output_keys:
+                    chunk[column] = referrer_df[column]
+                stage.counters['UnknownEngineReferrers'] += int(referrer_df['unknown_engine'].sum())
+
+                is_search = chunk['search_keyword'].notnull()
+                relevant = chunk.loc[is_search | (chunk['total_revenue'].notnull() & (chunk['event_list'] == 1)), ['ip', 'date_time']]
+                if relevant['date_time'].isnull().any():
+                    raise ChunkingError('Searches or purchases have no date_time.')
+                relevant = relevant.assign(ip=unpack_ip(relevant['ip']).to_numpy())
+                first_seen = relevant.groupby('ip')['date_time'].min()
+                if (first_seen < last_seen.reindex(first_seen.index)).any():
+                    raise ChunkingError('Hits of a visitor are not in time order across chunks.')
+                chunk_last_seen = relevant.groupby('ip')['date_time'].max()
+                last_seen = pd.concat([last_seen[~last_seen.index.isin(chunk_last_seen.index)], chunk_last_seen])
+
+                order = hit_order(chunk)
+                output_df = attribute_revenue(chunk, order, search_state, carried_search)
+                searches = chunk.iloc[order][is_search.to_numpy()[order]]
+                latest = searches.drop_duplicates('ip', keep='last').set_index('ip')[search_state_columns]
+                latest.index = unpack_ip(latest.index)
+                carried_search = merge_search_state(latest.astype({'search_engine_domain': object, 'search_keyword': object}), carried_search)
+
+                if aggregation_mode == 'top_k':
+                    chunk_revenue = summarize_revenue(output_df)
+                    revenue = chunk_revenue if revenue is None else merge_revenue_summaries([revenue, chunk_revenue])
+                else:
+                    chunk_revenue = rollup_revenue(chunk, output_df)
+                    revenue = chunk_revenue if revenue is None else merge_rollups([revenue, chunk_revenue])
+                stage.rows_in += len(chunk)
+                stage.counters['Chunks'] += 1
+            if revenue is None:
+                #a file with only its header has no chunk, its revenue is empty as in memory
+                if aggregation_mode == 'top_k':
+                    revenue = summarize_revenue(pd.DataFrame(columns=output_keys + ['revenue']))
+                else:
+                    revenue = sum_rollup(pd.DataFrame(columns=rollup_dimensions + rollup_measures).astype(
+                        {**{i: 'float64' for i in attribution_columns}, 'orders': 'int64', 'search_referrals': 'int64'}))
+            final_df = revenue
+            stage.rows_out = len(final_df)
+        logger.info ('Referrer parse cache ' + str(cached_parse_referrer.cache_info()))
+        return final_df, carried_search
+    except ChunkingError as e:
+        raise e
+    except Exception as e:
+        logger.error ('Failed! Chunked revenue calculation has issue ' + str(e))
         raise e
 
 
-def revenue_calc(df):
+def revenue_calc(df, search_state=None):
     """
     This funtion processes the combined dataframe of all the files from s3 to unpack different columns which are then aggregated to caluclate
-    revenue per search keyword and search engine domain.
+    revenue per search keyword and search engine domain. In exact mode the purchases and searches are aggregated into the
+    rollup of rollup_revenue, the revenue per search keyword is derived from it. With aggregation_mode top_k the revenue
+    is kept in a space saving summary of at most sketch_capacity keywords instead of the exact sum of every keyword.
     Arguments:
         df: pandas dataframe
+        search_state: pandas dataframe indexed by ip, last search of each visitor from earlier runs
     Returns:
-        final_df: pandas dataframe
+        final_df: rollup dataframe, or the summary dataframe in top_k mode
     """
     try:
         logger.info ('Processing url.')
-        df['domain_name'], df['url_query'] = zip(*df.apply(url_parse, axis=1))
-        df['search_compound_string'] = [next((l[x] for x in range(len(l)) if 'p=' in l[x] or 'q=' in l[x]), None) for l in df['url_query']]
-        df['search_engine_domain'] = df['domain_name'].str.split('.', 1).str[-1]
-        df['search_keyword'] = df['search_compound_string'].str.split('=').str[-1]
-        df['search_keyword'] = df['search_keyword'].str.replace('+',' ')
-        df['search_keyword'] = df['search_keyword'].str.lower()
-        df_grouped_sorted = df.sort_values(by=['ip','date_time'], ascending=True)
-
-        output_df = pd.DataFrame(columns = ['search_engine_domain', 'search_keyword', 'revenue'])
-        current_domain_name = ''
-        current_search_keyword = ''
-        for index, row in df_grouped_sorted.iterrows():
-            if pd.notnull(row['search_keyword']):
-                current_domain_name = row['search_engine_domain']
-                current_search_keyword = row['search_keyword']
-            total_revenue = row['total_revenue']
-            if pd.notnull(row['total_revenue']) and row['event_list'] == 1:
-                output_df = output_df.append({'search_engine_domain' : current_domain_name, 'search_keyword' : current_search_keyword, 'revenue' : total_revenue},
-                  ignore_index = True)
-
-        final_df = output_df.groupby(['search_engine_domain', 'search_keyword'])['revenue'].sum().sort_values(ascending=[False])
+        with metrics.stage('parse_referrers') as stage:
+            referrer_df = parse_referrers(df['referrer'])
+            df['domain_name'] = referrer_df['domain_name']
+            df['search_engine_domain'] = referrer_df['search_engine_domain']
+            df['search_keyword'] = referrer_df['search_keyword']
+            stage.rows_in = len(df)
+            unknown_engines = referrer_df.loc[referrer_df['unknown_engine'], 'domain_name'].value_counts()
+            stage.counters['UnknownEngineReferrers'] = int(unknown_engines.sum())
+        if len(unknown_engines):
+            logger.info (str(unknown_engines.sum()) + ' hits are referred by unknown search engines, the most frequent are ' +
+                         ', '.join(str(domain) + ' ' + str(count) for domain, count in unknown_engines.head(10).items()))
+        logger.info ('Referrer parse cache ' + str(cached_parse_referrer.cache_info()))
+        with metrics.stage('sort') as stage:
+            order = hit_order(df)
+            stage.rows_in = len(df)
+        with metrics.stage('attribution') as stage:
+            output_df = attribute_revenue(df, order, search_state)
+            stage.rows_in = len(df)
+            stage.rows_out = len(output_df)
+        with metrics.stage('aggregate') as stage:
+            if aggregation_mode == 'top_k':
+                final_df = summarize_revenue(output_df)
+            else:
+                final_df = rollup_revenue(df, output_df)
+            stage.rows_in = len(output_df)
+            stage.rows_out = len(final_df)
         logger.info ('Final output DF consisting of revenue numbers haas been calculated.')
         return final_df
     except Exception as e:
@@ -104,73 +365,888 @@ def revenue_calc(df):
         raise e
 
 
-def url_parse(row):
-    return urlparse(row['referrer']).netloc, urlparse(row['referrer']).query.strip('&').split('&')
+def hit_order(df):
+    """
+    Gives the positions of the hits ordered by ip and date_time, ties kept in the order they were read.
+    dq_check_split_file writes every split as runs already sorted this way, so the stable sort of one combined
+    (ip, date_time) key is a merge of those runs (timsort finds and merges them) rather than a sort from scratch, and only
+    the order is built, not a sorted copy of the hits. Hits in any other order still come out sorted, only slower.
+    Arguments:
+        df: pandas dataframe of hits, compact or not
+    Returns:
+        order: numpy array of positions
+    """
+    try:
+        if isinstance(df['ip'].dtype, pd.CategoricalDtype):
+            #categories are sorted, missing ip go last like in sort_values
+            ip_key = df['ip'].cat.codes.to_numpy().astype('int64')
+            ip_key[ip_key < 0] = len(df['ip'].cat.categories)
+        elif pd.api.types.is_unsigned_integer_dtype(df['ip'].dtype):
+            ip_key = df['ip'].to_numpy()
+        else:
+            #ip which are not compacted are ordered like categories
+            ip_key, ip_uniques = pd.factorize(df['ip'], sort=True)
+            ip_key[ip_key < 0] = len(ip_uniques)
+        date_codes, date_uniques = pd.factorize(df['date_time'], sort=True)
+        date_codes[date_codes < 0] = len(date_uniques)
+        key = ip_key.astype('uint64') << np.uint64(32) | date_codes.astype('uint64')
+        return np.argsort(key, kind='stable')
+    except Exception as e:
+        logger.error ('Failed! Ordering hits has issue ' + str(e))
+        raise e
+
+
+def attribute_revenue(df, order, search_state=None, carried_search=None):
+    """
+    Attributes the revenue of every purchase to the last search keyword and search engine domain seen for the same visitor.
+    It is one pass over the hits in order: the position of the last search is carried forward, and a purchase (event_list 1
+    with a total_revenue) takes it when that search is of the same ip. Purchases are returned in order, ready to be grouped.
+    Purchases before the first search of a visitor take the carried search of that ip when there is one, otherwise they
+    are seeded from the search state when it holds an older search of that ip. Purchases with no earlier search get
+    empty strings. The date_time and the rollup columns of the purchases are kept for the rollup.
+    With attribution models other than last, the earlier searches of the conversion path of every purchase are found
+    from the same arrays and the revenue is shared among them by spread_revenue, one row per touch.
+    Arguments:
+        df: pandas dataframe of hits with parsed search columns
+        order: numpy array, positions of the hits ordered by ip and date_time from hit_order
+        search_state: pandas dataframe indexed by ip, last search of each visitor from earlier runs
+        carried_search: pandas dataframe indexed by ip, last search of each visitor in the chunks before this one
+    Returns:
+        output_df: pandas dataframe
+    """
+    try:
+        ip = df['ip'].to_numpy()[order]
+        is_search = df['search_keyword'].notnull().to_numpy()[order]
+        is_purchase = (df['total_revenue'].notnull() & (df['event_list'] == 1)).to_numpy()[order]
+        last_search = np.maximum.accumulate(np.where(is_search, np.arange(len(order)), -1))[is_purchase]
+        purchase_ip = ip[is_purchase]
+        has_search = (last_search >= 0) & (ip[np.maximum(last_search, 0)] == purchase_ip)
+        purchases = df.iloc[order[is_purchase]]
+        search_rows = order[last_search[has_search]]
+        #categories are dropped for the few purchase rows, so they can be filled with values of the state
+        output_df = pd.DataFrame({'search_engine_domain': None, 'search_keyword': None}, index=purchases.index, dtype=object)
+        for column in ['search_engine_domain', 'search_keyword']:
+            output_df.loc[has_search, column] = df[column].iloc[search_rows].astype(object).to_numpy()
+        if carried_search is not None and len(carried_search):
+            carried = carried_search.reindex(unpack_ip(purchases['ip']))
+            carried.index = purchases.index
+            output_df = output_df.fillna(carried[['search_engine_domain', 'search_keyword']])
+        if search_state is not None and len(search_state):
+            seed = search_state.reindex(unpack_ip(purchases['ip']))
+            seed.index = purchases.index
+            seed = seed.where(seed['date_time'] < pd.to_datetime(purchases['date_time']), axis=0)
+            output_df = output_df.fillna(seed[['search_engine_domain', 'search_keyword']])
+        output_df = output_df.fillna('')
+        output_df['revenue'] = purchases['total_revenue']
+        for column in ['date_time'] + rollup_hit_columns + product_revenue_columns:
+            output_df[column] = purchases[column].values
+        output_df = output_df.reset_index(drop=True)
+        output_df['orders'] = 1
+        if len(attribution_models) > 1:
+            touch_purchase, touch = earlier_touches(ip, is_search, is_purchase, last_search)
+            date_time = pd.to_datetime(df['date_time']).to_numpy()[order]
+            hours = (date_time[last_search[touch_purchase]] - date_time[touch]) / np.timedelta64(1, 'h')
+            touches = output_df.iloc[touch_purchase].reset_index(drop=True)
+            for column in output_keys:
+                touches[column] = df[column].iloc[order[touch]].astype(object).to_numpy()
+            output_df = spread_revenue(output_df, touches.assign(orders=0), touch_purchase, hours)
+        return output_df
+    except Exception as e:
+        logger.error ('Failed! Revenue attribution has issue ' + str(e))
+        raise e
+
+
+def earlier_touches(ip, is_search, is_purchase, last_search):
+    """
+    Finds the searches of the conversion path of every purchase that come before its last search. The conversion path of
+    a purchase is the searches of the visitor after their previous purchase, up to the purchase. A purchase with no
+    search since the previous one has only the last search before it, so no earlier touches.
+    Arguments:
+        ip: numpy array of the hits in order
+        is_search: numpy array of the hits in order
+        is_purchase: numpy array of the hits in order
+        last_search: numpy array, position of the last search at or before every purchase
+    Returns:
+        touch_purchase: numpy array, number of the purchase of every touch, in order
+        touch: numpy array, position of every touch in the hits in order
+    """
+    positions = np.arange(len(ip))
+    next_purchase = np.minimum.accumulate(np.where(is_purchase, positions, len(ip))[::-1])[::-1]
+    touch = positions[is_search & (next_purchase < len(ip))]
+    next_purchase = next_purchase[touch]
+    touch_purchase = (np.cumsum(is_purchase) - 1)[next_purchase]
+    earlier = (ip[touch] == ip[next_purchase]) & (touch < last_search[touch_purchase])
+    return touch_purchase[earlier], touch[earlier]
+
+
+def spread_revenue(output_df, touches, touch_purchase, hours):
+    """
+    Shares the revenue of every purchase among the touches of its conversion path, one revenue column per attribution
+    model. The weights of every model come from the same rank, path length and hours arrays, so a model costs an array
+    operation and a bincount rather than another pass over the hits. The revenue column stays the last search attribution.
+    Arguments:
+        output_df: pandas dataframe of attributed purchases, with their last touch
+        touches: pandas dataframe of the earlier touches, the search columns of the touch and the others of its purchase
+        touch_purchase: numpy array, row of output_df of the purchase of every touch, in order
+        hours: numpy array, hours from every touch to the last touch of its purchase
+    Returns:
+        output_df: pandas dataframe, one row per touch
+    """
+    try:
+        purchase = np.concatenate([touch_purchase, np.arange(len(output_df))])
+        path_touches = np.bincount(touch_purchase, minlength=len(output_df)) + 1
+        rank = np.concatenate([np.arange(len(touch_purchase)) - np.searchsorted(touch_purchase, touch_purchase), path_touches - 1])
+        hours = np.concatenate([hours, np.zeros(len(output_df))])
+        paths = pd.concat([touches, output_df], ignore_index=True)
+        revenue = paths['revenue'].to_numpy()
+        for model, column in zip(attribution_models, attribution_columns):
+            #touches without a date_time get no weight
+            weight = np.nan_to_num(attribution_weights[model](rank, path_touches[purchase], hours))
+            paths[column] = revenue * weight / np.bincount(purchase, weights=weight, minlength=len(output_df))[purchase]
+        return paths
+    except Exception as e:
+        logger.error ('Failed! Spreading revenue over conversion paths has issue ' + str(e))
+        raise e
+
+
+def revenue_cents(revenue):
+    """
+    Gives the revenue in int64 cents when every value is a whole number of cents, as floats are not exact.
+    Arguments:
+        revenue: pandas series
+    Returns:
+        cents: pandas series, None when some revenue is not in whole cents
+    """
+    cents = (revenue * 100).round()
+    if not np.allclose(cents, revenue * 100, rtol=0, atol=1e-6):
+        return None
+    return cents.astype('int64')
+
+
+def sum_revenue(output_df, column='revenue'):
+    """
+    Sums revenue per search engine domain and search keyword. Revenue in whole cents is summed as integer cents, so the
+    sums are the same whatever the order and grouping of the purchases (in memory, chunked or from partials) and have
+    no floating point residue. Other revenue is summed as floats.
+    Arguments:
+        output_df: pandas dataframe with search_engine_domain, search_keyword and revenue columns
+        column: string, revenue column to sum
+    Returns:
+        revenue: pandas series
+    """
+    cents = revenue_cents(output_df[column])
+    if cents is None:
+        return output_df.groupby(output_keys)[column].sum()
+    return output_df.assign(**{column: cents}).groupby(output_keys)[column].sum() / 100
+
+
+def rollup_revenue(df, output_df):
+    """
+    Aggregates the attributed purchases and the search hits into the rollup, one row per value of rollup_dimensions with
+    the revenue of every attribution model and number of orders of the purchases and the number of search referrals. It is one groupby over the
+    purchases and searches together, the revenue per search keyword of the final output is derived from it by
+    search_keyword_revenue, and other reports can be read from it instead of the hits.
+    Arguments:
+        df: pandas dataframe of hits with parsed search columns
+        output_df: pandas dataframe of attributed purchases from attribute_revenue
+    Returns:
+        rollup: pandas dataframe
+    """
+    try:
+        columns = ['date_time'] + output_keys + rollup_hit_columns + product_revenue_columns
+        searches = df.loc[df['search_keyword'].notnull().to_numpy(), columns]
+        events = pd.concat([output_df[columns + attribution_columns + ['orders']].assign(search_referrals=0),
+                            searches.assign(**{i: 0.0 for i in attribution_columns}, orders=0, search_referrals=1)], ignore_index=True)
+        if 'date' in rollup_dimensions:
+            #date_time is a string when the hits were not compacted
+            events['date'] = pd.to_datetime(events['date_time']).dt.normalize()
+        if product_revenue_columns:
+            events = split_categories(events)
+        return sum_rollup(events)
+    except Exception as e:
+        logger.error ('Failed! Revenue rollup has issue ' + str(e))
+        raise e
+
+
+def split_categories(events):
+    """
+    Gives every product category of a hit its own row, with the share of the revenue of the hit made by the products of
+    that category: the revenue of every attribution model is scaled by the revenue of the product over the revenue of
+    all products of the hit. The orders and search referrals stay on the row of the first product, so they are counted
+    once. Hits without products keep a missing category and all their revenue.
+    Arguments:
+        events: pandas dataframe with category and product_revenue columns, the categories and the revenue of the
+            products of every hit joined with ','
+    Returns:
+        events: pandas dataframe, one row per product
+    """
+    events = events.assign(category=events['category'].astype(object).str.split(','),
+                           product_revenue=events['product_revenue'].astype(object).str.split(',')).explode(['category', 'product_revenue'])
+    first = ~events.index.duplicated()
+    product_revenue = pd.to_numeric(events['product_revenue'], errors='coerce').fillna(0.0)
+    hit_revenue = product_revenue.groupby(level=0).transform('sum')
+    #a hit without revenue in its products keeps its measures on the first one
+    share = np.where(hit_revenue > 0, product_revenue / hit_revenue.where(hit_revenue > 0, 1.0), first)
+    events[attribution_columns] = events[attribution_columns].mul(share, axis=0)
+    for column in ['orders', 'search_referrals']:
+        events[column] = events[column].where(first, 0)
+    return events.reset_index(drop=True)
+
+
+def sum_rollup(events):
+    """
+    Sums the rollup measures per value of rollup_dimensions, missing values are kept as their own group. Revenue in
+    whole cents is summed as integer cents, like sum_revenue does, other revenue and the revenue shared by the other
+    attribution models as integer millionths, so the rollups of chunks and partials add up to the same as in memory.
+    Arguments:
+        events: pandas dataframe with the rollup dimensions and measures
+    Returns:
+        rollup: pandas dataframe
+    """
+    units = {'revenue': 100 if revenue_cents(events['revenue']) is not None else 10 ** 6, **{i: 10 ** 6 for i in attribution_columns[1:]}}
+    events = events.assign(**{column: (events[column] * unit).round().astype('int64') for column, unit in units.items()})
+    rollup = events.groupby(rollup_dimensions, dropna=False, observed=True)[rollup_measures].sum().reset_index()
+    for column, unit in units.items():
+        rollup[column] = rollup[column] / unit
+    return rollup
+
+
+def merge_rollups(rollups):
+    """
+    Adds up rollups of disjoint hits, e.g. of chunks or of hash partitioned splits.
+    Arguments:
+        rollups: list of pandas dataframes
+    Returns:
+        rollup: pandas dataframe
+    """
+    try:
+        return sum_rollup(pd.concat(rollups, ignore_index=True))
+    except Exception as e:
+        logger.error ('Failed! Merging rollups has issue ' + str(e))
+        raise e
+
+
+def search_keyword_revenue(rollup):
+    """
+    Derives the revenue per search engine domain and search keyword of the final output from the rollup, one column
+    per attribution model, from the rows with orders or with revenue of a model, sorted by revenue. The rows of the
+    categories other than the first of a purchase have revenue but no orders. The revenue shared
+    by the models other than last is rounded to cents.
+    Arguments:
+        rollup: pandas dataframe
+    Returns:
+        revenue: pandas dataframe
+    """
+    credited = rollup[(rollup[['orders'] + attribution_columns] != 0).any(axis=1)]
+    revenue = pd.concat([sum_revenue(credited, i) for i in attribution_columns], axis=1)
+    revenue[attribution_columns[1:]] = revenue[attribution_columns[1:]].round(2)
+    return revenue.sort_values('revenue', ascending=False)
+
+
+def summarize_revenue(output_df):
+    """
+    Streams the attributed purchases into a space saving summary of revenue per search engine domain and search keyword,
+    summary_chunk_rows purchases (or sketch_capacity when larger) at a time, so the keywords held at once are bounded
+    by the chunk and the summary whatever the number of distinct keywords.
+    Arguments:
+        output_df: pandas dataframe of attributed purchases
+    Returns:
+        summary: pandas dataframe
+    """
+    try:
+        summary = truncate_revenue_summary(pd.Series([], dtype='float64', index=pd.MultiIndex.from_tuples([], names=output_keys)))
+        chunk_rows = max(sketch_capacity, summary_chunk_rows)
+        for start in range(0, len(output_df), chunk_rows):
+            chunk = output_df.iloc[start:start + chunk_rows].groupby(output_keys, sort=False)['revenue'].sum()
+            summary = merge_revenue_summaries([summary, truncate_revenue_summary(chunk)])
+        return summary
+    except Exception as e:
+        logger.error ('Failed! Summarizing revenue has issue ' + str(e))
+        raise e
+
+
+def truncate_revenue_summary(revenue, revenue_error=None, revenue_floor=0.0):
+    """
+    Keeps the sketch_capacity keywords of highest revenue. The true revenue of a kept keyword is between revenue minus
+    revenue_error and revenue, the one of a keyword not kept is at most revenue_floor, which is raised to the highest
+    revenue dropped here. Revenue has to be non negative for these bounds to hold.
+    Arguments:
+        revenue: pandas series indexed by search_engine_domain and search_keyword
+        revenue_error: pandas series with the same index, 0 when the revenue is exact
+        revenue_floor: float
+    Returns:
+        summary: pandas dataframe with revenue, revenue_error and revenue_floor columns
+    """
+    if revenue_error is None:
+        revenue_error = pd.Series(0.0, index=revenue.index)
+    if len(revenue) > sketch_capacity:
+        order = np.argsort(-revenue.to_numpy(), kind='stable')
+        revenue_floor = max(revenue_floor, float(revenue.iloc[order[sketch_capacity]]))
+        revenue, revenue_error = revenue.iloc[order[:sketch_capacity]], revenue_error.iloc[order[:sketch_capacity]]
+    return pd.DataFrame({'revenue': revenue, 'revenue_error': revenue_error, 'revenue_floor': float(revenue_floor)},
+                        index=revenue.index).sort_values('revenue', ascending=False)
+
+
+def merge_revenue_summaries(summaries):
+    """
+    Merges space saving summaries, e.g. of the splits of a file. A keyword missing from a summary is counted at the
+    revenue_floor of that summary, in both its revenue and its revenue_error, so the bounds of every summary carry over
+    to the merged one.
+    Arguments:
+        summaries: list of pandas dataframes from truncate_revenue_summary, indexed by search_engine_domain and search_keyword
+    Returns:
+        summary: pandas dataframe
+    """
+    try:
+        floors = [float(i['revenue_floor'].iloc[0]) if len(i) else 0.0 for i in summaries]
+        merged = pd.concat([i.assign(revenue_floor=floor) for i, floor in zip(summaries, floors)])
+        merged = merged.groupby(level=[0, 1], sort=False).sum()
+        #floors of the summaries missing a keyword are the total floor minus the floors of the ones holding it
+        missing_floor = sum(floors) - merged['revenue_floor']
+        return truncate_revenue_summary(merged['revenue'] + missing_floor, merged['revenue_error'] + missing_floor, sum(floors))
+    except Exception as e:
+        logger.error ('Failed! Merging revenue summaries has issue ' + str(e))
+        raise e
+
+
+def final_output(df):
+    """
+    Lays out the final output. In exact mode the revenue of every keyword is derived from the rollup, with a revenue
+    column per attribution model, the columns of the original output when only last search attribution is used. In
+    top_k mode the top_k keywords of the summary are given with the revenue_error bounding how much their revenue can
+    be overstated, and an aggregation column stating the output is not exact.
+    Arguments:
+        df: rollup dataframe, or the summary dataframe in top_k mode
+    Returns:
+        df: pandas dataframe
+    """
+    if aggregation_mode == 'top_k':
+        if len(df):
+            logger.info ('Keywords missing from the summary have at most ' + str(df['revenue_floor'].iloc[0]) + ' revenue.')
+        return df.head(top_k)[['revenue', 'revenue_error']].assign(aggregation='top_k')
+    return search_keyword_revenue(df)
+
+
+def latest_searches(df):
+    """
+    Gives the last search of every visitor in the processed hits, merged into the search state of earlier runs by
+    merge_search_state.
+    Arguments:
+        df: pandas dataframe of hits with parsed search columns
+    Returns:
+        latest: pandas dataframe indexed by ip
+    """
+    try:
+        searches = df.loc[df['search_keyword'].notnull(), ['ip'] + search_state_columns]
+        searches = searches.assign(date_time=pd.to_datetime(searches['date_time'])).sort_values(by=['ip', 'date_time'])
+        latest = searches.drop_duplicates('ip', keep='last').set_index('ip')
+        latest = latest.astype({'search_engine_domain': object, 'search_keyword': object})
+        latest.index = unpack_ip(latest.index)
+        return latest
+    except Exception as e:
+        logger.error ('Failed! Finding latest searches has issue ' + str(e))
+        raise e
+
+
+def merge_search_state(latest, search_state):
+    """
+    Replaces the searches of the search state by the later ones of the same ip.
+    Arguments:
+        latest: pandas dataframe indexed by ip
+        search_state: pandas dataframe indexed by ip
+    Returns:
+        search_state: pandas dataframe indexed by ip
+    """
+    if not len(search_state):
+        return latest
+    return pd.concat([search_state[~search_state.index.isin(latest.index)], latest])
+
+
+def parse_referrers(referrer):
+    """
+    Parses the referrer column into domain name, search engine domain and search keyword, and flags the referrers that
+    look like searches on engines missing from search_engine_rules.
+    The column is factorized, or its categories are used when it is a category, so each distinct url is parsed only
+    once. The parsed values are then broadcast back to every row as category columns, by indexing with the codes.
+    Arguments:
+        referrer: pandas series
+    Returns:
+        referrer_df: pandas dataframe
+    """
+    try:
+        if isinstance(referrer.dtype, pd.CategoricalDtype):
+            codes, uniques = referrer.cat.codes.to_numpy(), referrer.cat.categories
+        else:
+            codes, uniques = pd.factorize(referrer)
+        #last slot holds the values for missing referrers, they are coded as -1
+        parsed = [cached_parse_referrer(url) for url in uniques] + [(None, None, None, False)]
+        domain_name, search_engine_domain, search_keyword, unknown_engine = zip(*parsed)
+        referrer_df = pd.DataFrame(index=referrer.index)
+        for column, values in [('domain_name', domain_name), ('search_engine_domain', search_engine_domain), ('search_keyword', search_keyword)]:
+            value_codes, value_uniques = pd.factorize(np.array(values, dtype=object))
+            referrer_df[column] = pd.Categorical.from_codes(value_codes[codes], value_uniques)
+        referrer_df['unknown_engine'] = np.array(unknown_engine, dtype=bool)[codes]
+        return referrer_df
+    except Exception as e:
+        logger.error ('Failed! Parsing of referrer has issue ' + str(e))
+        raise e
+
+
+def compile_search_engine_rules(rules):
+    """
+    Compiles the search engine rules into an index of domain suffix to keyword parameters, a referrer host is matched
+    by looking up its suffixes, one per label, so the cost doesn't grow with the number of rules.
+    Arguments:
+        rules: Dict of engine domain suffix to list of keyword query parameters
+    Returns:
+        search_engine_index: Dict
+        search_parameters: frozenset, keyword parameters of all engines
+    """
+    search_engine_index = {suffix.lower().strip('.'): tuple(parameters) for suffix, parameters in rules.items()}
+    search_parameters = frozenset(parameter for parameters in search_engine_index.values() for parameter in parameters)
+    return search_engine_index, search_parameters
+
+
+def match_search_engine(host):
+    """
+    Finds the engine of a referrer host, the longest rule suffix ending the host on a label boundary.
+    Arguments:
+        host: string
+    Returns:
+        search_engine_domain: string or None
+    """
+    labels = host.split('.')
+    for i in range(len(labels) - 1):
+        suffix = '.'.join(labels[i:])
+        if suffix in search_engine_index:
+            return suffix
+    return None
+
+
+def parse_referrer_url(url):
+    """
+    Parses a single referrer url. The search engine is the rule of search_engine_rules matching the host, and the search
+    keyword is the first non empty value of one of its keyword parameters. It is None when the referrer is not a search.
+    A referrer from a host without a rule is flagged as an unknown engine when its query has a keyword parameter of
+    any engine.
+    Arguments:
+        url: string
+    Returns:
+        Tuple of domain_name, search_engine_domain, search_keyword and unknown_engine
+    """
+    parsed_url = urlparse(url)
+    domain_name = parsed_url.netloc
+    host = (parsed_url.hostname or '').rstrip('.')
+    search_engine_domain = match_search_engine(host)
+    query = parse_qsl(parsed_url.query)
+    if search_engine_domain is None:
+        return domain_name, None, None, any(name in search_parameters and value for name, value in query)
+    parameters = search_engine_index[search_engine_domain]
+    search_keyword = next((value.strip().lower() for name, value in query if name in parameters and value.strip()), None)
+    return domain_name, search_engine_domain, search_keyword, False
+
 
+#search engine rules compiled once per cold start
+search_engine_index, search_parameters = compile_search_engine_rules(search_engine_rules)
+#bounded cache of parsed referrers, kept across warm invocations of the lambda
+cached_parse_referrer = lru_cache(maxsize=referrer_cache_size)(parse_referrer_url)
 
-def read_files_s3(bucket_name, prefix):
+
+def list_split_files(bucket_name, path):
     """
-    Read files from s3 and create a pandas dataframe
+    Lists the split files of a prefix in the order they were written, by file and split number.
     Arguments:
         bucket_name: string
-        prefix: string
+        path: string, a split file or a prefix ending with /, or a list of split files
+    Returns:
+        split_files: list
+    """
+    if isinstance(path, list):
+        return path
+    if not path.endswith('/'):
+        return [path]
+    split_files = [i for i in storage.list_objects(bucket_name, path) if is_split_file(i)]
+    return sorted(split_files, key=split_file_order)
+
+
+def is_split_file(key):
+    """
+    Tells if a key is a split file of the intermediate_format, tsv splits compressed with gzip end with .gz.
+    """
+    return key.endswith('.' + intermediate_format) or key.endswith('.' + intermediate_format + '.gz')
+
+
+def split_file_order(key):
+    """
+    Sort key of a split file, its name and split number, e.g. ('2022-07-08/data', 2) for 2022-07-08/data_2.tsv.
+    """
+    if key.endswith('.gz'):
+        key = key[:-len('.gz')]
+    name, _, number = key.rsplit('.', 1)[0].rpartition('_')
+    return (name, int(number)) if number.isdigit() else (key, 0)
+
+
+def read_files_s3(bucket_name, path):
+    """
+    Read files from s3 and create a pandas dataframe, only the processing columns are read and they are packed by
+    compact_hits. Split files are read in the order of list_split_files.
+    Arguments:
+        bucket_name: string
+        path: string, a split file or a prefix ending with /, or a list of split files
     Returns:
         df: pandas dataframe
     """
     try:
         logger.info ('Reading from bucket.')
-        df = wr.s3.read_csv('s3://' + bucket_name +'/' + prefix +'/', sep='\t')
+        path = list_split_files(bucket_name, path)
+        with metrics.stage('read') as stage:
+            if intermediate_format == 'parquet':
+                df = storage.read_parquet(bucket_name, path, columns=processing_columns)
+            else:
+                df = storage.read_csv(bucket_name, path, sep='\t', usecols=processing_columns, dtype=split_read_dtypes)
+            df = compact_hits(df)
+            stage.rows_out = len(df)
         return df
     except Exception as e:
         logger.error ('Failed! Reading from s3 has issue ' + str(e))
         raise e
 
-def write_to_s3(df, prefix):
+
+def read_chunks_s3(bucket_name, path):
+    """
+    Reads the split files of a path in order, processing_chunk_rows at a time, as read_files_s3 reads them at once.
+    Arguments:
+        bucket_name: string
+        path: string, a split file or a prefix ending with /, or a list of split files
+    Returns:
+        chunks: generator of pandas dataframes packed by compact_hits
+    """
+    for split_file in list_split_files(bucket_name, path):
+        if intermediate_format == 'parquet':
+            chunks = storage.read_parquet_chunks(bucket_name, split_file, processing_chunk_rows, columns=processing_columns)
+        else:
+            chunks = storage.read_csv_chunks(bucket_name, split_file, processing_chunk_rows, sep='\t', usecols=processing_columns,
+                                             dtype=split_read_dtypes)
+        for chunk in chunks:
+            yield compact_hits(chunk.reset_index(drop=True))
+
+
+def compact_hits(df):
+    """
+    Packs the hits into compact types, a million hits take about a fifth of the memory of the inferred types
+    (benchmarks/bench_memory.py).
+    ip is packed into uint32, date_time is parsed to datetime64 (an int64 epoch), event_list becomes an int16 with 0
+    for hits without a single event and referrer a category.
+    Arguments:
+        df: pandas dataframe
+    Returns:
+        df: pandas dataframe
+    """
+    try:
+        df['ip'] = pack_ip(df['ip'])
+        df['date_time'] = pd.to_datetime(df['date_time'], errors='coerce')
+        event_list = pd.to_numeric(df['event_list'], errors='coerce')
+        df['event_list'] = event_list.where(event_list.abs() < 2 ** 15, 0).fillna(0).astype('int16')
+        df['referrer'] = df['referrer'].astype('category')
+        return df
+    except Exception as e:
+        logger.error ('Failed! Compacting hits has issue ' + str(e))
+        raise e
+
+
+def pack_ip(ip):
+    """
+    Packs dotted IPv4 addresses into uint32, parsing each distinct address once. A column holding any other address
+    is kept as a category.
+    Arguments:
+        ip: pandas series or index
+    Returns:
+        packed_ip: pandas series or index
+    """
+    if pd.api.types.is_integer_dtype(ip.dtype):
+        return ip.astype('uint32')
+    codes, uniques = pd.factorize(ip)
+    try:
+        #split and cast by arrow, a python split of every distinct address is several times slower
+        octets = pc.split_pattern(pa.array(np.asarray(uniques, dtype=object), type=pa.string()), '.')
+        if (codes < 0).any() or not pc.all(pc.equal(pc.list_value_length(octets), 4)).as_py():
+            raise ValueError('not IPv4')
+        octets = pc.cast(pc.list_flatten(octets), pa.uint32()).to_numpy().reshape(-1, 4)
+        if (octets > 255).any():
+            raise ValueError('not IPv4')
+    except (ValueError, TypeError):
+        return ip.astype('category')
+    packed = (octets[:, 0] << 24 | octets[:, 1] << 16 | octets[:, 2] << 8 | octets[:, 3])[codes]
+    if isinstance(ip, pd.Index):
+        return pd.Index(packed, name=ip.name)
+    return pd.Series(packed, index=ip.index, name=ip.name)
+
+def unpack_ip(ip):
+    """
+    Gives ip as dotted strings, the form of the search state, from ip packed into uint32 by pack_ip or kept as strings.
+    Arguments:
+        ip: pandas series or index
+    Returns:
+        ip: pandas index of strings
+    """
+    if pd.api.types.is_integer_dtype(ip.dtype):
+        packed = pa.array(np.asarray(ip, dtype='uint32'))
+        octets = [pc.cast(pc.bit_wise_and(pc.shift_right(packed, shift), 255), pa.string()) for shift in (24, 16, 8, 0)]
+        return pd.Index(pc.binary_join_element_wise(*octets, '.').to_numpy(zero_copy_only=False), dtype=object, name='ip')
+    return pd.Index(np.asarray(ip, dtype=object), dtype=object, name='ip')
+
+def partials_prefix(file_path, split_run):
+    """
+    Gives the partials folder of the split run a split comes from, e.g. 2022-07-08/partials/data/1657267200000000000/
+    for 2022-07-08/data_1.tsv. Every time its landing file is split the DQ function names a new split run, so the
+    partials of an earlier split of the same file are never counted with the new ones.
+    Arguments:
+        file_path: string
+        split_run: string
+    Returns:
+        partials_prefix: string
+    """
+    prefix, split_file_name = file_path.rsplit('/', 1)
+    return prefix + '/partials/' + split_file_name.split('.')[0].rsplit('_', 1)[0] + '/' + split_run + '/'
+
+def write_partial_to_s3(df, file_path, split_run):
     """
-    Write final output file to s3
+    Write the partial revenue of one split to the partials folder of its split run in the final bucket, the rollup as
+    parquet in exact mode, the summary as tsv in top_k mode
     Arguments:
         df: dataframe
+        file_path: string
+        split_run: string
+    """
+    try:
+        logger.info ('Writing partial output to bucket.')
+        partial_name = partials_prefix(file_path, split_run) + file_path.rsplit('/', 1)[1].split('.')[0]
+        if aggregation_mode == 'top_k':
+            storage.to_csv(df, final_bucket_name, partial_name + '.tsv', sep='\t')
+        else:
+            storage.to_parquet(df, final_bucket_name, partial_name + '.parquet', index=False)
+    except Exception as e:
+        logger.error ('Failed! Writing partial output to s3 has issue ' + str(e))
+        raise e
+
+def merge_partials(prefix, file_path, split_count, split_run):
+    """
+    Sums the partial revenue into the final output once every split of the split run of file_path has written its
+    partial. Only the partials of that split run are counted. It is then marked as complete, and the final output of
+    the prefix is merged from the partials of the latest complete split run of every landing file of the prefix, as the
+    whole prefix is read in non partitioned mode. Splits hold disjoint sets of ip, so the sum is the same as processing
+    the whole prefix at once. The search state deltas of the same split runs are folded into the checkpoint of the day.
+    In exact mode the partials are rollups, added up by merge_rollups, in top_k mode they are summaries, merged by
+    merge_revenue_summaries.
+    Arguments:
         prefix: string
+        file_path: string, split whose partial was written
+        split_count: int, number of splits of its split run
+        split_run: string
+    Returns:
+        Boolean, True when the final output was written
     """
     try:
-        logger.info ('Writing final output to bucket.')
-        today = date.today()
-        file_name = str(today) + final_output_file_name
-        wr.s3.to_csv(df = df, path = 's3://' + final_bucket_name +'/' + prefix +'/' + file_name, sep='\t')
+        run_partials = partials_prefix(file_path, split_run)
+        partial_files = [i for i in storage.list_objects(final_bucket_name, run_partials) if not i.endswith(partials_complete_name)]
+        if len(partial_files) < split_count:
+            logger.info (str(len(partial_files)) + ' of ' + str(split_count) + ' partials of ' + run_partials + ' are ready, merge is skipped.')
+            return False
+        storage.put_object(final_bucket_name, run_partials + partials_complete_name, b'')
+        prefix_files = storage.list_objects(final_bucket_name, prefix + '/partials/')
+        #split runs are named by the time they were split, the latest complete one of every landing file is merged
+        latest_runs = {}
+        for i in prefix_files:
+            if i.endswith('/' + partials_complete_name):
+                file_partials, run = i[:-len('/' + partials_complete_name)].rsplit('/', 1)
+                latest_runs[file_partials] = max(latest_runs.get(file_partials, run), run)
+        complete = {file_partials + '/' + run + '/' for file_partials, run in latest_runs.items()}
+        partial_files = [i for i in prefix_files if i.rsplit('/', 1)[0] + '/' in complete and not i.endswith(partials_complete_name)]
+        logger.info ('Merging partial outputs of ' + str(len(complete)) + ' landing files.')
+        with metrics.stage('merge_partials') as stage:
+            if aggregation_mode == 'top_k':
+                partials = [storage.read_csv(final_bucket_name, i, sep='\t', keep_default_na=False,
+                                             dtype={'search_engine_domain': str, 'search_keyword': str, 'revenue': 'float64'}).set_index(output_keys)
+                            for i in partial_files]
+                final_df = merge_revenue_summaries(partials)
+                stage.rows_in = sum(len(i) for i in partials)
+            else:
+                partial_df = storage.read_parquet(final_bucket_name, partial_files)
+                final_df = merge_rollups([partial_df])
+                stage.rows_in = len(partial_df)
+            write_to_s3(final_df, prefix)
+            stage.rows_out = len(final_df)
+        merge_search_deltas(prefix, complete)
+        return True
     except Exception as e:
-        logger.error ('Failed! Writing to s3 has issue ' + str(e))
+        logger.error ('Failed! Merging partial outputs has issue ' + str(e))
+        raise e
+
+def search_state_name(file_path, split_partitions=0):
+    """
+    Gives the name of the search state checkpoint of a message. Hash partitioned splits use the shard of their hash
+    partition, e.g. search_state_2.parquet for split 5 of 3 partitions, whatever their landing file is named. Split n
+    holds the ip of partition (n - 1) % split_partitions of every landing file, so a visitor keeps the same shard from
+    file to file and day to day.
+    Arguments:
+        file_path: string
+        split_partitions: int, hash partitions of the DQ function, 0 when the splits are not hash partitioned
+    Returns:
+        state_name: string
+    """
+    if split_partitions:
+        split_number = int(file_path.rsplit('/', 1)[-1].split('.')[0].rsplit('_', 1)[1])
+        return 'search_state_' + str((split_number - 1) % split_partitions + 1) + '.parquet'
+    return 'search_state.parquet'
+
+def search_state_path(prefix, state_name):
+    """
+    Gives the key of the search state checkpoint of a day in the final bucket, e.g.
+    checkpoint/2022-07-08/search_state.parquet, the state of every visitor after the hits of the prefix of that day.
+    A day processed again overwrites its own checkpoint and never the ones it was seeded from.
+    Arguments:
+        prefix: string, day of the hits
+        state_name: string
+    Returns:
+        state_path: string, empty when checkpointing is disabled
+    """
+    if not checkpoint_prefix:
+        return ''
+    return checkpoint_prefix + prefix + '/' + state_name
+
+def previous_search_state_path(prefix, state_name):
+    """
+    Gives the key of the latest search state checkpoint of a day before the prefix, it seeds the attribution of the
+    prefix. The checkpoint of the prefix itself is not used, as it already holds the searches of the hits it is seeding.
+    Arguments:
+        prefix: string, day of the hits
+        state_name: string
+    Returns:
+        state_path: string, empty when checkpointing is disabled or there is no earlier checkpoint
+    """
+    if not checkpoint_prefix:
+        return ''
+    days = [i[len(checkpoint_prefix):-len('/' + state_name)] for i in storage.list_objects(final_bucket_name, checkpoint_prefix)
+            if i.endswith('/' + state_name)]
+    days = [i for i in days if '/' not in i and i < prefix]
+    return search_state_path(max(days), state_name) if days else ''
+
+def search_delta_path(file_path, split_run, state_name):
+    """
+    Gives the key of the search state delta of a hash partitioned split, the last searches of its own hits, next to the
+    partials of its split run under the checkpoint prefix, e.g.
+    checkpoint/2022-07-08/partials/data/1657267200000000000/search_state_2/data_5.parquet.
+    Arguments:
+        file_path: string
+        split_run: string
+        state_name: string, shard of the split
+    Returns:
+        delta_path: string, empty when checkpointing is disabled
+    """
+    if not checkpoint_prefix:
+        return ''
+    return checkpoint_prefix + partials_prefix(file_path, split_run) + state_name.split('.')[0] + '/' + \
+        file_path.rsplit('/', 1)[1].split('.')[0] + '.parquet'
+
+def merge_search_deltas(prefix, complete):
+    """
+    Folds the search state deltas of the complete split runs into the shards of the checkpoint of the day: every shard
+    of the day before the prefix keeps the latest search of each ip among its own and the ones of the deltas of that
+    shard. As the shards are rebuilt from the checkpoint of the day before, merging again gives the same state.
+    Arguments:
+        prefix: string, day of the hits
+        complete: set, partials folders of the latest complete split run of every landing file of the prefix
+    """
+    try:
+        if not checkpoint_prefix:
+            return
+        deltas = {}
+        for i in storage.list_objects(final_bucket_name, checkpoint_prefix + prefix + '/partials/'):
+            run_partials, shard, delta_file = i[len(checkpoint_prefix):].rsplit('/', 2)
+            if run_partials + '/' in complete:
+                deltas.setdefault(shard + '.parquet', []).append(i)
+        with metrics.stage('merge_search_deltas') as stage:
+            stage.rows_out = 0
+            for state_name, delta_files in sorted(deltas.items()):
+                search_state = read_search_state(previous_search_state_path(prefix, state_name))
+                states = [i for i in [search_state, read_search_state(delta_files)] if len(i)]
+                if states:
+                    search_state = pd.concat(states).sort_values('date_time', kind='stable', na_position='first')
+                    search_state = search_state[~search_state.index.duplicated(keep='last')]
+                write_search_state(search_state, search_state_path(prefix, state_name))
+                stage.rows_out += len(search_state)
+    except Exception as e:
+        logger.error ('Failed! Merging search state deltas has issue ' + str(e))
         raise e
 
+def read_search_state(state_path):
+    """
+    Reads the search state checkpoint in a single read, an empty state is returned when there is none.
+    The state is indexed by ip as dotted strings whatever the ip of a day are packed to, so IPv4 and IPv6 visitors can
+    be in it together. Checkpoints holding packed ip are read into dotted strings.
+    Arguments:
+        state_path: string, empty when there is no checkpoint to read, or a list of keys read together
+    Returns:
+        search_state: pandas dataframe indexed by ip
+    """
+    try:
+        if state_path:
+            logger.info ('Reading search state checkpoint ' + (state_path if isinstance(state_path, str) else ', '.join(state_path)) + '.')
+            with metrics.stage('read_search_state') as stage:
+                search_state = storage.read_parquet(final_bucket_name, state_path).set_index('ip')
+                search_state.index = unpack_ip(search_state.index)
+                stage.rows_out = len(search_state)
+            return search_state
+        return pd.DataFrame(columns=search_state_columns, index=pd.Index([], name='ip'))
+    except Exception as e:
+        logger.error ('Failed! Reading search state has issue ' + str(e))
+        raise e
 
-def delete_sqs_msg(receipt_handle):
+def write_search_state(search_state, state_path):
     """
-    Delete message from sqs queue
+    Writes the search state checkpoint back to s3
     Arguments:
-        receipt_handle: string
+        search_state: pandas dataframe indexed by ip
+        state_path: string
     """
     try:
-        logger.info ('Deleting msg from sqs.')
-        sqs_client.delete_message(
-            QueueUrl=queue_url,
-            ReceiptHandle=receipt_handle
-        )
-        logger.info ('Message has been deleted.')
+        if state_path:
+            logger.info ('Writing search state checkpoint.')
+            storage.to_parquet(search_state.reset_index(), final_bucket_name, state_path, index=False)
     except Exception as e:
-        logger.error ('Failed! Delete sqs msg has issue ' + str(e))
+        logger.error ('Failed! Writing search state has issue ' + str(e))
+        raise e
+
+def write_to_s3(df, prefix):
+    """
+    Write final output file to s3, laid out by final_output, compressed with gzip when output_compression is gzip.
+    In exact mode the rollup is written next to it as parquet.
+    Arguments:
+        df: dataframe
+        prefix: string
+    """
+    try:
+        logger.info ('Writing final output to bucket.')
+        today = date.today()
+        if aggregation_mode == 'exact':
+            storage.to_parquet(df, final_bucket_name, prefix + '/' + str(today) + rollup_file_name, index=False)
+        file_name = str(today) + final_file_name
+        if output_compression == 'gzip':
+            storage.to_csv(final_output(df), final_bucket_name, prefix +'/' + file_name, sep='\t', compression='gzip')
+        else:
+            storage.to_csv(final_output(df), final_bucket_name, prefix +'/' + file_name, sep='\t')
+    except Exception as e:
+        logger.error ('Failed! Writing to s3 has issue ' + str(e))
         raise e
 
 
 def send_sns_update():
     """
-    Sends an sns notification updating about completion of process.
+    Sends the buffered notifications of the invocation as one sns notification.
     """
     try:
-        msg = 'Final file has been uploaded to s3 and message has been deleted fromt eh sqs queue.'
-        response = sns_client.publish (
-          TargetArn = snstopicarn,
-          Message = msg
-       )
-        logger.info ('Final file has been uploaded to s3 and message has been deleted from the sqs queue.')
+        notifications.flush()
+        logger.info ('Notifications of processed files have been sent.')
     except Exception as e:
         logger.error ('Failed! Issue with sending sns notification of completion of final upload. ' + str(e))
         raise e
@@ -1,15 +1,16 @@
 import json
 import logging
 import os
-import boto3
+from backends import get_storage, get_messaging, NotificationBuffer
+from metrics import Metrics
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-#boto clients for aws services
+#storage and messaging backends, s3, sqs and sns unless run locally
 try:
-    sqs_client = boto3.client('sqs')
-    sns_client = boto3.client('sns')
+    storage = get_storage()
+    messaging = get_messaging()
 except Exception as e:
     logger.error ('Failed! Issue in making boto client connections with AWS resources ' + str(e))
     raise e
@@ -20,24 +21,46 @@ try:
 except Exception as e:
     logger.error ('Failed! Issue with reading environment variables in Publish SQS Lambda function ' + str(e))
     raise e
+metrics = Metrics('publish_sqs')
+notifications = NotificationBuffer(messaging, snstopicarn)
+#most entries a single send_message_batch call takes, and how often entries sqs failed to take are sent again
+sqs_batch_size = 10
+sqs_batch_retries = 3
 
 def lambda_handler(event, context):
     """
-    This acts as the main driver function, publishing messages to SQS and sending notification.
+    This acts as the main driver function, publishing messages to SQS.
     It accepts events and context as argument from the AWS services calling the lambda function.
+    When the indicator file says the splits are hash partitioned, one message is published per split.
+    Messages carry the DQ report on to the process parsed output function, which sends one summary per file, so
+    nothing is notified here unless publishing fails.
+    Every record of the event is published, the invocation fails once all records were tried if any of them failed.
+    Stage metrics are emitted at the end of every invocation.
     Arguments:
         event: Dict
         context: Dict
     Returns:
         Dict
     """
+    metrics.start(context)
+    status = 'Failed'
     try:
-        bucket_name = event['Records'][0]['s3']['bucket']['name']
-        file_name = event['Records'][0]['s3']['object']['key']
-        logger.info ('Calling to publish message to SQS')
-        MessageId = sqs_publish_msg(bucket_name, file_name)
+        MessageId = []
+        failures = {}
+        for record in event['Records']:
+            bucket_name = record['s3']['bucket']['name']
+            file_name = record['s3']['object']['key']
+            try:
+                MessageId += publish_indicator(bucket_name, file_name)
+            except Exception as e:
+                failures['s3://' + bucket_name + '/' + file_name] = e
         logger.info ('Message id of SQS is ' +str(MessageId))
-        send_sns_update(MessageId)
+        if failures:
+            notifications.add('Failed! Publishing to sqs has issue for ' + str(len(failures)) + ' of ' + str(len(event['Records'])) +
+                              ' indicator files.\n' + '\n'.join(key + ': ' + str(error) for key, error in failures.items()))
+            raise Exception(str(len(failures)) + ' of ' + str(len(event['Records'])) + ' indicator files failed. ' +
+                            ' '.join(key + ': ' + str(error) for key, error in failures.items()))
+        status = 'Succeeded'
         return {
             'statusCode': 200,
             'body': json.dumps('Successfully published sqs message.')
@@ -45,17 +68,71 @@ def lambda_handler(event, context):
     except Exception as e:
         logger.error ('Failed! Publish SQS Lambda handler has issue ' + str(e))
         raise e
+    finally:
+        with metrics.stage('notify'):
+            send_sns_update()
+        metrics.emit(status)
+
+
+def publish_indicator(bucket_name, file_name):
+    """
+    Publishes the sqs messages for one indicator file, one per split when they are hash partitioned.
+    Arguments:
+        bucket_name: string
+        file_name: string
+    Returns:
+        MessageId: list
+    """
+    try:
+        indicator = read_indicator_file(bucket_name, file_name)
+        logger.info ('Calling to publish message to SQS')
+        with metrics.stage('publish') as stage:
+            if indicator.get('Partitioned'):
+                MessageId = sqs_publish_msgs(bucket_name, indicator['Splits'], indicator.get('Report', ''), len(indicator['Splits']),
+                                             indicator.get('SplitRun', '0'), indicator.get('SplitPartitions'))
+            else:
+                MessageId = sqs_publish_msgs(bucket_name, [file_name], indicator.get('Report', ''))
+            stage.rows_out = len(MessageId)
+        return MessageId
+    except Exception as e:
+        logger.error ('Failed! Publishing indicator file has issue ' + str(e))
+        raise e
+
+
+def read_indicator_file(bucket_name, file_name):
+    """
+    Reads the indicator file written by the DQ process, it lists the splits and how they were made.
+    Arguments:
+        bucket_name: string
+        file_name: string
+    Returns:
+        indicator: Dict
+    """
+    try:
+        with metrics.stage('read_indicator') as stage:
+            indicator_object = storage.open_object(bucket_name, file_name)
+            body = indicator_object.body.read()
+            stage.bytes_read = len(body)
+            indicator = json.loads(body.decode('UTF-8'))
+            stage.rows_out = len(indicator.get('Splits', []))
+        return indicator
+    except Exception as e:
+        logger.error ('Failed! Reading indicator file has issue ' + str(e))
+        raise e
 
 
-def sqs_publish_msg(bucket_name, file_name):
+def sqs_message_attributes(bucket_name, file_name, split_count=None, split_run=None, split_partitions=None):
     """
-    Creates sqs msg dict of the bucket and filename to give information
+    Creates sqs msg attributes of the bucket and filename to give information
     to consumer about the data for next process
     Arguments:
         bucket_name: string
         file_name: string
+        split_count: int, total number of splits when the message is for one hash partitioned split
+        split_run: string, split run of the hash partitioned split, from the indicator file
+        split_partitions: int, hash partitions of the DQ function, split n holds partition (n - 1) % split_partitions
     Returns:
-        MessageId: string
+        message_attributes: Dict
     """
     message_attributes = {
         'bucket_name': {
@@ -67,33 +144,69 @@ def sqs_publish_msg(bucket_name, file_name):
             'StringValue':  file_name
         }
     }
-    message_body = 'The hit file has been DQed, split and published to s3 bucket. '
+    if split_count is not None:
+        message_attributes['split_count'] = {
+            'DataType': 'Number',
+            'StringValue': str(split_count)
+        }
+    if split_run is not None:
+        message_attributes['split_run'] = {
+            'DataType': 'String',
+            'StringValue': split_run
+        }
+    if split_partitions is not None:
+        message_attributes['split_partitions'] = {
+            'DataType': 'Number',
+            'StringValue': str(split_partitions)
+        }
+    return message_attributes
+
+
+def sqs_publish_msgs(bucket_name, file_names, report, split_count=None, split_run=None, split_partitions=None):
+    """
+    Publishes one sqs message per file with send_message_batch, sqs_batch_size messages per call. Entries sqs failed
+    to take are sent again up to sqs_batch_retries times before giving up.
+    Arguments:
+        bucket_name: string
+        file_names: list
+        report: string, DQ report of the landing file, it is the body of every message
+        split_count: int, total number of splits when the messages are for hash partitioned splits
+        split_run: string, split run of the hash partitioned splits
+        split_partitions: int, hash partitions of the DQ function
+    Returns:
+        MessageId: list
+    """
+    message_body = report + '\nThe hit file has been DQed, split and published to s3 bucket. '
+    entries = [{'Id': str(i), 'MessageBody': message_body,
+                'MessageAttributes': sqs_message_attributes(bucket_name, file_name, split_count, split_run, split_partitions)} for i, file_name in enumerate(file_names)]
     try:
-        logger.info ('Sending msg')
-        response = sqs_client.send_message(
-            QueueUrl=queue_url,
-            MessageBody=message_body,
-            MessageAttributes=message_attributes
-        )
-        return response['MessageId']
+        logger.info ('Sending ' + str(len(entries)) + ' msgs')
+        message_ids = {}
+        for attempt in range(sqs_batch_retries + 1):
+            failed = []
+            for start in range(0, len(entries), sqs_batch_size):
+                successful, batch_failed = messaging.send_message_batch(queue_url, entries[start:start + sqs_batch_size])
+                message_ids.update({i['Id']: i['MessageId'] for i in successful})
+                failed += batch_failed
+            if not failed:
+                break
+            failed_ids = set(i['Id'] for i in failed)
+            entries = [i for i in entries if i['Id'] in failed_ids]
+            logger.info (str(len(entries)) + ' msgs were not taken by sqs, attempt ' + str(attempt + 1) + ' of sending them again.')
+        if failed:
+            raise Exception(str(len(failed)) + ' msgs could not be sent: ' + '; '.join(i['Id'] + ' ' + i.get('Message', '') for i in failed))
+        return [message_ids[str(i)] for i in range(len(file_names))]
     except Exception as e:
         logger.error("Send sqs message failed " + str(e))
         raise e
 
 
-def send_sns_update(msgid):
+def send_sns_update():
     """
-    Sends an sns notification updating about SQS msg delivered.
-    Arguments:
-        msg: string
+    Sends the buffered notifications of the invocation as one sns notification.
     """
     try:
-        msg = 'A task is waiting in queue to be run, the sqs msg id is ' + str(msgid)
-        response = sns_client.publish (
-          TargetArn = snstopicarn,
-          Message = msg
-       )
-        logger.info ('SNS notification sent regarding task waiting in sqs')
+        notifications.flush()
     except Exception as e:
         logger.error ('Failed! Send sns update has issue ' + str(e))
         raise e
@@ -0,0 +1,11 @@
+"""
+Search engines recognized in the referrers by process_parsed_output, unless its search_engine_rules variable is set.
+It is also the search_engine_rules value create_cft_yaml.py puts in the template, so the code and the stack have
+the same engines.
+"""
+
+#search engine domain suffixes and the query parameters holding their keyword
+default_search_engine_rules = {
+    'google.com': ['q'], 'bing.com': ['q'], 'yahoo.com': ['p'], 'duckduckgo.com': ['q'], 'ask.com': ['q'],
+    'aol.com': ['q'], 'baidu.com': ['wd', 'word'], 'yandex.com': ['text'], 'yandex.ru': ['text']
+}
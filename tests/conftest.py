@@ -0,0 +1,41 @@
+"""
+Configuration shared by the tests. The pipeline modules read their configuration when they are imported, so it is set
+here, before the tests import them: the same environment as local_batch.py, on local storage in a temporary folder.
+Every test gets fresh storage and messaging from the backends fixture.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+from local_batch import default_environment
+
+for name, value in default_environment.items():
+    os.environ.setdefault(name, value)
+os.environ.setdefault('storage_backend', 'local')
+os.environ.setdefault('local_storage_root', tempfile.mkdtemp())
+
+import dq_check_split_file
+import process_parsed_output
+import publish_sqs
+from backends import LocalMessaging, LocalStorage
+
+
+@pytest.fixture
+def backends(tmp_path, monkeypatch):
+    """
+    Fresh local storage and messaging for the pipeline modules, and their configuration restored after the test.
+    """
+    storage = LocalStorage(str(tmp_path))
+    messaging = LocalMessaging()
+    for module in [dq_check_split_file, publish_sqs, process_parsed_output]:
+        monkeypatch.setattr(module, 'storage', storage)
+    monkeypatch.setattr(publish_sqs, 'messaging', messaging)
+    monkeypatch.setattr(dq_check_split_file, 'read_chunk_rows', dq_check_split_file.read_chunk_rows)
+    monkeypatch.setattr(dq_check_split_file, 'split_partitions', dq_check_split_file.split_partitions)
+    monkeypatch.setattr(process_parsed_output, 'processing_chunk_rows', process_parsed_output.processing_chunk_rows)
+    return storage, messaging
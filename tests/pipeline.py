@@ -0,0 +1,132 @@
+"""
+Helpers of the tests, they run hit files through the lambda handlers of the pipeline on the local storage and
+messaging of the backends fixture.
+"""
+import datetime
+import os
+
+import pandas as pd
+
+import dq_check_split_file
+import process_parsed_output
+import publish_sqs
+
+repository = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sample_output = os.path.join(repository, '2022-07-08_SearchKeywordPerformance.tsv')
+landing_columns = ['hit_time_gmt', 'date_time', 'user_agent', 'ip', 'event_list', 'geo_city', 'geo_region', 'geo_country',
+                   'pagename', 'page_url', 'product_list', 'referrer']
+
+
+def run_pipeline(storage, messaging, hits, mode, chunk_rows):
+    """
+    Lands a hit file, runs it through the lambda handlers and reads back the final output.
+    Arguments:
+        storage: LocalStorage
+        messaging: LocalMessaging
+        hits: bytes, hit file
+        mode: string, one of modes
+        chunk_rows: int, rows per chunk the file is read and processed in
+    Returns:
+        output_df: pandas dataframe
+    """
+    process_messages(split_and_publish(storage, messaging, hits, mode, chunk_rows))
+    return read_final_output(storage)
+
+
+def split_and_publish(storage, messaging, hits, mode, chunk_rows, file_name='data.tsv'):
+    """
+    Lands a hit file and runs it through the DQ and publish lambda handlers.
+    Arguments:
+        storage: LocalStorage
+        messaging: LocalMessaging
+        hits: bytes, hit file
+        mode: string, one of modes
+        chunk_rows: int, rows per chunk the file is read and processed in
+        file_name: string, landing file name
+    Returns:
+        messages: list, the sqs messages published
+    """
+    storage.put_object('landing', file_name, hits)
+    dq_check_split_file.read_chunk_rows = chunk_rows
+    dq_check_split_file.split_partitions = 3 if mode == 'partitioned' else 0
+    process_parsed_output.processing_chunk_rows = chunk_rows if mode == 'chunked' else 0
+    dq_check_split_file.lambda_handler({'Records': [{'s3': {'bucket': {'name': 'landing'}, 'object': {'key': file_name}}}]}, None)
+    indicator = [i for i in storage.list_objects(dq_check_split_file.target_bucket, str(dq_check_split_file.date.today()) + '/')
+                 if i.endswith('/' + file_name.split('.')[0] + '_Success.json')]
+    assert len(indicator) == 1
+    publish_sqs.lambda_handler({'Records': [{'s3': {'bucket': {'name': dq_check_split_file.target_bucket}, 'object': {'key': indicator[0]}}}]}, None)
+    messages, messaging.messages = messaging.messages, []
+    return messages
+
+
+def process_messages(messages):
+    """
+    Runs the sqs messages through the process_parsed_output lambda handler, one invocation each.
+    Arguments:
+        messages: list
+    """
+    for message in messages:
+        response = process_parsed_output.lambda_handler({'Records': [sqs_record(message)]}, None)
+        assert response['batchItemFailures'] == []
+
+
+def sqs_record(message):
+    """
+    Gives the record of an sqs message as the event source mapping hands it to the lambda.
+    Arguments:
+        message: Dict, message sent to LocalMessaging
+    Returns:
+        record: Dict
+    """
+    attributes = {name: {'stringValue': value['StringValue']} for name, value in message['MessageAttributes'].items()}
+    return {'messageId': message['MessageId'], 'body': message['Body'], 'messageAttributes': attributes}
+
+
+def read_final_output(storage):
+    """
+    Reads the final output written by process_parsed_output for the hits split today.
+    Arguments:
+        storage: LocalStorage
+    Returns:
+        output_df: pandas dataframe
+    """
+    today = str(process_parsed_output.date.today())
+    return read_output(storage.path(process_parsed_output.final_bucket_name, today + '/' + today + process_parsed_output.final_file_name))
+
+
+def read_output(path):
+    """
+    Reads a final output file, ordered by search engine domain and keyword.
+    Arguments:
+        path: string
+    Returns:
+        output_df: pandas dataframe
+    """
+    output_df = pd.read_csv(path, sep='\t', dtype={'search_engine_domain': str, 'search_keyword': str}, keep_default_na=False)
+    return output_df.sort_values(['search_engine_domain', 'search_keyword']).reset_index(drop=True)
+
+
+def hit_file(hits):
+    """
+    Renders hits as a landing file, the fields missing from a hit are empty.
+    Arguments:
+        hits: list of Dicts, fields of every hit
+    Returns:
+        bytes
+    """
+    return pd.DataFrame(hits, columns=landing_columns).to_csv(sep='\t', index=False).encode('UTF-8')
+
+
+def set_day(monkeypatch, day):
+    """
+    Makes the pipeline modules run on another day, the day hit files are split on and their output is named after.
+    Arguments:
+        monkeypatch: pytest MonkeyPatch
+        day: string, e.g. 2022-07-08
+    """
+    class Day(datetime.date):
+        @classmethod
+        def today(cls):
+            return cls.fromisoformat(day)
+    for module in [dq_check_split_file, process_parsed_output]:
+        monkeypatch.setattr(module, 'date', Day)
@@ -0,0 +1,40 @@
+"""
+Runs a conversion path through the pipeline with every attribution model and checks how the revenue of its purchases
+is shared among its searches.
+    python -m pytest -q tests
+"""
+import numpy as np
+import pandas as pd
+
+import process_parsed_output
+from pipeline import hit_file, run_pipeline
+
+models = ['last', 'first', 'linear', 'time_decay']
+#a visitor searches a then b an hour later, and buys twice without searching in between
+journey = [{'date_time': '2022-07-08 09:00:00', 'referrer': 'http://www.google.com/search?q=a'},
+           {'date_time': '2022-07-08 10:00:00', 'referrer': 'http://www.google.com/search?q=b'},
+           {'date_time': '2022-07-08 10:30:00', 'event_list': '1', 'product_list': 'Electronics;Ipod;1;100;'},
+           {'date_time': '2022-07-08 11:00:00', 'event_list': '1', 'product_list': 'Electronics;Case;1;30;'}]
+
+
+def test_earlier_touches():
+    ip = np.array([1, 1, 1, 1])
+    is_search = np.array([True, True, False, False])
+    is_purchase = np.array([False, False, True, True])
+    last_search = np.array([1, 1])
+    touch_purchase, touch = process_parsed_output.earlier_touches(ip, is_search, is_purchase, last_search)
+    #a is the only touch before the last search of the first purchase, the second purchase has b alone
+    assert touch_purchase.tolist() == [0]
+    assert touch.tolist() == [0]
+
+
+def test_attribution_models(backends, monkeypatch):
+    monkeypatch.setattr(process_parsed_output, 'attribution_models', models)
+    monkeypatch.setattr(process_parsed_output, 'attribution_columns', ['revenue'] + ['revenue_' + i for i in models[1:]])
+    monkeypatch.setattr(process_parsed_output, 'rollup_measures', process_parsed_output.attribution_columns + ['orders', 'search_referrals'])
+    monkeypatch.setattr(process_parsed_output, 'time_decay_half_life_hours', 1.0)
+    hits = hit_file([{'ip': '67.98.123.1', **hit} for hit in journey])
+    output_df = run_pipeline(*backends, hits, 'in_memory', chunk_rows=5)
+    expected_df = pd.DataFrame([('google.com', 'a', 0.0, 100.0, 50.0, 33.33), ('google.com', 'b', 130.0, 30.0, 80.0, 96.67)],
+                               columns=['search_engine_domain', 'search_keyword', 'revenue', 'revenue_first', 'revenue_linear', 'revenue_time_decay'])
+    pd.testing.assert_frame_equal(output_df, expected_df)
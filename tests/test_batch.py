@@ -0,0 +1,26 @@
+"""
+Runs a batch of sqs messages through the process_parsed_output lambda handler and checks a failing message is
+reported in batchItemFailures without failing the others.
+    python -m pytest -q tests
+"""
+import json
+import os
+
+import pandas as pd
+
+import process_parsed_output
+from pipeline import read_final_output, read_output, repository, sample_output, split_and_publish, sqs_record
+
+
+def test_partial_batch_failure(backends):
+    with open(os.path.join(repository, 'data.tsv'), 'rb') as f:
+        hits = f.read()
+    records = [sqs_record(i) for i in split_and_publish(*backends, hits, 'partitioned', chunk_rows=5)]
+    #a message of a split which is not there, e.g. deleted after it was published
+    bad_record = dict(records[0], messageId='bad-message')
+    bad_record['messageAttributes'] = dict(bad_record['messageAttributes'], file_name={'stringValue': 'missing/data_1.tsv'})
+    response = process_parsed_output.lambda_handler({'Records': records[:1] + [bad_record] + records[1:]}, None)
+    assert response['batchItemFailures'] == [{'itemIdentifier': 'bad-message'}]
+    assert json.loads(response['body']).startswith(str(len(records)) + ' of ' + str(len(records) + 1) + ' messages processed')
+    #the messages after the failed one were processed and the partials of all splits merged
+    pd.testing.assert_frame_equal(read_final_output(backends[0]), read_output(sample_output))
@@ -0,0 +1,49 @@
+"""
+Runs hit files of consecutive days through the pipeline with the search state checkpoint, and checks purchases are
+attributed to the searches of earlier days the same way however often a day is processed.
+"""
+import pandas as pd
+import pytest
+
+import process_parsed_output
+from pipeline import hit_file, process_messages, read_final_output, set_day, split_and_publish
+
+modes = ['in_memory', 'chunked', 'partitioned']
+purchase = {'event_list': '1', 'product_list': 'Electronics;Ipod - Touch - 32GB;1;100;',
+            'referrer': 'https://www.esshopzilla.com/checkout/?a=confirm'}
+
+
+@pytest.fixture
+def checkpoint(backends, monkeypatch):
+    monkeypatch.setattr(process_parsed_output, 'checkpoint_prefix', 'checkpoint/')
+    return backends
+
+
+def expected_output(rows):
+    return pd.DataFrame(rows, columns=['search_engine_domain', 'search_keyword', 'revenue'])
+
+
+@pytest.mark.parametrize('mode', modes)
+def test_day_processed_twice(checkpoint, monkeypatch, mode):
+    set_day(monkeypatch, '2022-07-07')
+    day_1 = hit_file([{'ip': '67.98.123.1', 'date_time': '2022-07-07 09:00:00', 'referrer': 'http://www.google.com/search?q=Ipod'}])
+    process_messages(split_and_publish(*checkpoint, day_1, mode, chunk_rows=5))
+    set_day(monkeypatch, '2022-07-08')
+    day_2 = hit_file([{'ip': '67.98.123.1', 'date_time': '2022-07-08 10:00:00', **purchase},
+                      {'ip': '67.98.123.1', 'date_time': '2022-07-08 11:00:00', 'referrer': 'http://www.bing.com/search?q=Zune'}])
+    messages = split_and_publish(*checkpoint, day_2, mode, chunk_rows=5)
+    #a redelivered message, or another message of the same day, is seeded from the checkpoint of the day before again
+    for delivery in range(2):
+        process_messages(messages)
+        pd.testing.assert_frame_equal(read_final_output(checkpoint[0]), expected_output([('google.com', 'ipod', 100.0)]))
+
+
+def test_landing_files_named_by_day(checkpoint, monkeypatch):
+    #the shards of the search state are kept by hash partition, not by the name of the landing file
+    set_day(monkeypatch, '2022-07-07')
+    day_1 = hit_file([{'ip': '67.98.123.1', 'date_time': '2022-07-07 09:00:00', 'referrer': 'http://www.google.com/search?q=Ipod'}])
+    process_messages(split_and_publish(*checkpoint, day_1, 'partitioned', chunk_rows=5, file_name='day1.tsv'))
+    set_day(monkeypatch, '2022-07-08')
+    day_2 = hit_file([{'ip': '67.98.123.1', 'date_time': '2022-07-08 10:00:00', **purchase}])
+    process_messages(split_and_publish(*checkpoint, day_2, 'partitioned', chunk_rows=5, file_name='day2.tsv'))
+    pd.testing.assert_frame_equal(read_final_output(checkpoint[0]), expected_output([('google.com', 'ipod', 100.0)]))
@@ -0,0 +1,104 @@
+"""
+Runs landing files through the DQ lambda handler on local storage and checks what is left for the next steps, the
+splits, the indicator file and the result cache entry.
+    python -m pytest -q tests
+"""
+import json
+import os
+
+import pytest
+
+import dq_check_split_file
+from pipeline import repository
+
+
+def land(storage, file_name='data.tsv'):
+    """
+    Puts data.tsv in the landing bucket and runs the DQ lambda handler on it.
+    Arguments:
+        storage: LocalStorage
+        file_name: string, landing file name
+    Returns:
+        response: Dict
+    """
+    with open(os.path.join(repository, 'data.tsv'), 'rb') as f:
+        storage.put_object('landing', file_name, f.read())
+    return dq_check_split_file.lambda_handler({'Records': [{'s3': {'bucket': {'name': 'landing'}, 'object': {'key': file_name}}}]}, None)
+
+
+def test_threshold_violation(backends, monkeypatch, caplog):
+    #most hits of data.tsv have no product_list, far over a null rate of 10%
+    monkeypatch.setattr(dq_check_split_file, 'dq_thresholds', {'null_rate': {'product_list': 0.1}})
+    monkeypatch.setattr(dq_check_split_file, 'read_chunk_rows', 5)
+    monkeypatch.setattr(dq_check_split_file, 'split_target_rows', 5)
+    response = land(backends[0])
+    assert response['statusCode'] == 200
+    #the splits were uploaded while the file was read, they are all deleted and no indicator file is written
+    assert backends[0].list_objects(dq_check_split_file.target_bucket, '') == []
+    assert 'File has been split in 5 smaller files.' in caplog.text
+    assert 'Data quality profile has issue: product_list null rate 66.67% over 10.00%. The splits are deleted' in caplog.text
+
+
+@pytest.fixture
+def cache(backends, monkeypatch):
+    monkeypatch.setattr(dq_check_split_file, 'cache_ttl_seconds', 3600)
+    return backends[0]
+
+
+def cached_split(storage):
+    """
+    Lands data.tsv with the result cache on.
+    Arguments:
+        storage: LocalStorage
+    Returns:
+        cache_key: string, key of the cache entry written for it
+    """
+    land(storage)
+    cache_keys = storage.list_objects(dq_check_split_file.target_bucket, dq_check_split_file.cache_prefix)
+    assert len(cache_keys) == 1
+    return cache_keys[0]
+
+
+def target_objects(storage):
+    """
+    Reads every object of the target bucket, the splits, indicator files and cache entries.
+    Arguments:
+        storage: LocalStorage
+    Returns:
+        objects: Dict of key to bytes
+    """
+    return {i: storage.open_object(dq_check_split_file.target_bucket, i).body.read() for i in storage.list_objects(dq_check_split_file.target_bucket, '')}
+
+
+def test_cache_hit_on_reupload(cache, caplog):
+    cache_key = cached_split(cache)
+    objects = target_objects(cache)
+    #s3 gives the same content the same ETag, the local ETag is the modification time and size of the file
+    landing_path = cache.path('landing', 'data.tsv')
+    modified = os.stat(landing_path).st_mtime_ns
+    with open(os.path.join(repository, 'data.tsv'), 'rb') as f:
+        cache.put_object('landing', 'data.tsv', f.read())
+    os.utime(landing_path, ns=(modified, modified))
+    caplog.clear()
+    dq_check_split_file.lambda_handler({'Records': [{'s3': {'bucket': {'name': 'landing'}, 'object': {'key': 'data.tsv'}}}]}, None)
+    assert 'Cache hit' in caplog.text
+    assert dq_check_split_file.read_cache_entry(cache_key) is not None
+    #neither the splits nor the indicator file are written again, so nothing downstream is triggered
+    assert target_objects(cache) == objects
+
+
+def test_cache_entry_expired(cache, caplog):
+    cache_key = cached_split(cache)
+    cache_entry = json.loads(cache.open_object(dq_check_split_file.target_bucket, cache_key).body.read())
+    cache_entry['Created'] -= dq_check_split_file.cache_ttl_seconds + 1
+    cache.put_object(dq_check_split_file.target_bucket, cache_key, json.dumps(cache_entry).encode('UTF-8'))
+    assert dq_check_split_file.read_cache_entry(cache_key) is None
+    assert 'has expired' in caplog.text
+
+
+def test_cache_indicator_missing(cache, caplog):
+    cache_key = cached_split(cache)
+    cache_entry = json.loads(cache.open_object(dq_check_split_file.target_bucket, cache_key).body.read())
+    cache.delete_objects(dq_check_split_file.target_bucket, [cache_entry['Indicator']])
+    assert dq_check_split_file.read_cache_entry(cache_key) is None
+    assert 'is gone' in caplog.text
@@ -0,0 +1,99 @@
+"""
+Runs hit files through the whole pipeline, DQ and split, publish and process_parsed_output, on local storage, with the
+hits processed in memory, in chunks and in hash partitions, and checks the final output is the same in every mode:
+the sample output for data.tsv, and the revenue of the row by row loop revenue_calc used to have for generated hits.
+    python -m pytest -q tests
+"""
+import io
+import os
+from collections import defaultdict
+
+import pandas as pd
+import pytest
+
+import dq_check_split_file
+import process_parsed_output
+from generate_hit_data import generate_hits, to_tsv
+from pipeline import process_messages, read_final_output, read_output, repository, run_pipeline, sample_output, split_and_publish
+
+modes = ['in_memory', 'chunked', 'partitioned']
+
+
+def last_search_loop(hits):
+    """
+    Attributes revenue the way revenue_calc did before it was vectorized: hits sorted by ip and date_time are walked row
+    by row, the last search is remembered and every purchase adds its revenue to it. The last search is forgotten when
+    the visitor changes, and referrers are parsed by parse_referrers, like the pipeline does.
+    Arguments:
+        hits: bytes, hit file
+    Returns:
+        output_df: pandas dataframe
+    """
+    hits = dq_check_split_file.transform_chunk(pd.read_csv(io.BytesIO(hits), sep='\t', dtype=str))
+    referrer_df = process_parsed_output.parse_referrers(hits['referrer'])
+    hits['search_engine_domain'] = referrer_df['search_engine_domain'].astype(object)
+    hits['search_keyword'] = referrer_df['search_keyword'].astype(object)
+    hits['event_list'] = pd.to_numeric(hits['event_list'], errors='coerce')
+    revenue = defaultdict(float)
+    current_ip = None
+    for row in hits.sort_values(['ip', 'date_time'], kind='stable').itertuples():
+        if row.ip != current_ip:
+            current_ip = row.ip
+            current_search = ('', '')
+        if pd.notnull(row.search_keyword):
+            current_search = (row.search_engine_domain, row.search_keyword)
+        if pd.notnull(row.total_revenue) and row.event_list == 1:
+            revenue[current_search] += row.total_revenue
+    output_df = pd.DataFrame([(domain, keyword, value) for (domain, keyword), value in revenue.items()],
+                             columns=['search_engine_domain', 'search_keyword', 'revenue'])
+    return output_df.sort_values(['search_engine_domain', 'search_keyword']).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('mode', modes)
+def test_sample_output(backends, mode, caplog):
+    with open(os.path.join(repository, 'data.tsv'), 'rb') as f:
+        hits = f.read()
+    output_df = run_pipeline(*backends, hits, mode, chunk_rows=5)
+    pd.testing.assert_frame_equal(output_df, read_output(sample_output))
+    assert 'chunked processing is not possible' not in caplog.text
+
+
+@pytest.mark.parametrize('mode', modes)
+def test_generated_hits(backends, mode, caplog):
+    hits = to_tsv(generate_hits(scale=0.3, seed=1))
+    output_df = run_pipeline(*backends, hits, mode, chunk_rows=2000)
+    pd.testing.assert_frame_equal(output_df, last_search_loop(hits), check_exact=False)
+    assert 'chunked processing is not possible' not in caplog.text
+
+
+@pytest.mark.parametrize('mode', modes)
+def test_header_only(backends, mode, caplog):
+    with open(os.path.join(repository, 'data.tsv'), 'rb') as f:
+        header = f.readline()
+    output_df = run_pipeline(*backends, header, mode, chunk_rows=5)
+    assert list(output_df.columns) == ['search_engine_domain', 'search_keyword', 'revenue']
+    assert len(output_df) == 0
+    assert 'chunked processing is not possible' not in caplog.text
+
+
+def test_split_again(backends):
+    first_output_df = run_pipeline(*backends, to_tsv(generate_hits(scale=0.05, seed=2)), 'partitioned', chunk_rows=500)
+    with open(os.path.join(repository, 'data.tsv'), 'rb') as f:
+        hits = f.read()
+    messages = split_and_publish(*backends, hits, 'partitioned', chunk_rows=5)
+    #the partials of the first split of the file are not merged with the ones of the second
+    process_messages(messages[:-1])
+    pd.testing.assert_frame_equal(read_final_output(backends[0]), first_output_df)
+    process_messages(messages[-1:])
+    pd.testing.assert_frame_equal(read_final_output(backends[0]), read_output(sample_output))
+
+
+def test_partition_count(backends, monkeypatch):
+    monkeypatch.setattr(dq_check_split_file, 'split_target_rows', 5)
+    with open(os.path.join(repository, 'data.tsv'), 'rb') as f:
+        hits = f.read()
+    #21 hits in splits of about 5 hits are 6 partitions, the multiple of split_partitions above 5
+    messages = split_and_publish(*backends, hits, 'partitioned', chunk_rows=100)
+    assert len(messages) == 6
+    process_messages(messages)
+    pd.testing.assert_frame_equal(read_final_output(backends[0]), read_output(sample_output))
@@ -0,0 +1,32 @@
+"""
+Runs hits through the pipeline and checks the revenue rollup of exact mode, with the revenue of a purchase of several
+products shared by their categories.
+    python -m pytest -q tests
+"""
+import pandas as pd
+import pytest
+
+import process_parsed_output
+from pipeline import hit_file, process_messages, read_final_output, split_and_publish
+
+modes = ['in_memory', 'chunked', 'partitioned']
+
+
+@pytest.mark.parametrize('mode', modes)
+def test_category_rollup(backends, mode):
+    hits = hit_file([{'ip': '67.98.123.1', 'date_time': '2022-07-08 09:00:00', 'geo_country': 'US',
+                      'referrer': 'http://www.google.com/search?q=Ipod'},
+                     {'ip': '67.98.123.1', 'date_time': '2022-07-08 10:00:00', 'geo_country': 'US', 'event_list': '1',
+                      'product_list': 'Electronics;Ipod - Touch - 32GB;1;290;,Accessories;Ipod Case;2;10;,Electronics;Earbuds;1;20;'}])
+    process_messages(split_and_publish(*backends, hits, mode, chunk_rows=1))
+    today = str(process_parsed_output.date.today())
+    rollup = backends[0].read_parquet(process_parsed_output.final_bucket_name, today + '/' + today + process_parsed_output.rollup_file_name)
+    rollup = rollup.sort_values('category', na_position='first').reset_index(drop=True)
+    assert rollup['category'].tolist()[1:] == ['Accessories', 'Electronics']
+    assert pd.isnull(rollup['category'].iloc[0])
+    assert rollup['revenue'].tolist() == [0.0, 10.0, 310.0]
+    #the purchase is one order, the search one referral, whatever the number of categories
+    assert rollup['orders'].sum() == 1
+    assert rollup['search_referrals'].sum() == 1
+    pd.testing.assert_frame_equal(read_final_output(backends[0]), pd.DataFrame(
+        [('google.com', 'ipod', 320.0)], columns=['search_engine_domain', 'search_keyword', 'revenue']))
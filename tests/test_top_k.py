@@ -0,0 +1,28 @@
+"""
+Runs generated hits through the pipeline in top_k mode with a summary much smaller than the number of keywords, and
+checks the bounds of the top keywords hold against the exact revenue once the summaries of the chunks or splits are
+truncated and merged.
+    python -m pytest -q tests
+"""
+import pytest
+
+import process_parsed_output
+from generate_hit_data import generate_hits, to_tsv
+from pipeline import run_pipeline
+
+
+@pytest.mark.parametrize('mode', ['chunked', 'partitioned'])
+def test_top_k_bounds(backends, monkeypatch, mode):
+    hits = to_tsv(generate_hits(scale=0.1, seed=3))
+    exact_df = run_pipeline(*backends, hits, mode, chunk_rows=500).set_index(['search_engine_domain', 'search_keyword'])['revenue']
+    monkeypatch.setattr(process_parsed_output, 'aggregation_mode', 'top_k')
+    monkeypatch.setattr(process_parsed_output, 'sketch_capacity', 5)
+    monkeypatch.setattr(process_parsed_output, 'top_k', 5)
+    top_k_df = run_pipeline(*backends, hits, mode, chunk_rows=500).set_index(['search_engine_domain', 'search_keyword'])
+    assert len(exact_df) > 2 * process_parsed_output.sketch_capacity
+    assert len(top_k_df) == process_parsed_output.top_k
+    #keywords were dropped from the summaries, so the merged revenue is overstated by up to revenue_error
+    assert (top_k_df['revenue_error'] > 0).any()
+    true_revenue = exact_df.reindex(top_k_df.index, fill_value=0.0)
+    assert (true_revenue <= top_k_df['revenue'] + 1e-6).all()
+    assert (true_revenue >= top_k_df['revenue'] - top_k_df['revenue_error'] - 1e-6).all()